@@ -0,0 +1,271 @@
+"""Native asyncio counterparts of the PipeElement read and write APIs
+
+Built on Django's async ORM (async iteration, asave(), adelete()),
+so async views need not wrap each call in sync_to_async:
+
+    async with acache(fitting_type=1, lazy=True):
+        async for record in element.aiter_descendants():
+            ...
+    await element.apipe_to(other)
+
+Independent queries (the content types being hydrated, the batches of
+a traversal frontier) are issued concurrently with asyncio.gather(),
+so they overlap wherever the database backend runs async queries
+concurrently. Content types are resolved from ContentType's cache,
+only falling back to a thread on a cache miss, and the mutation hooks
+only hop to a thread when the closure table or the shared cache needs
+the database.
+"""
+import asyncio, logging
+from asgiref.sync import sync_to_async
+from django.contrib.contenttypes.models import ContentType
+from fitting import models, traversal, closure, shared, orphans, stats
+log = logging.getLogger(__name__)
+
+def _cached_content_type(key):
+    """Get a ContentType from ContentTypeManager's cache without querying
+
+    key -- model class or content type id
+
+    The cache is private to Django, so returns None if it is unavailable
+    as well as on a cache miss, the callers then query in a thread.
+    """
+    manager = ContentType.objects
+    try:
+        if isinstance(key, int):
+            return manager._cache[manager.db][key]
+        return manager._get_from_cache(key._meta.concrete_model._meta)
+    except (AttributeError, KeyError):
+        return None
+
+async def acontent_type_id(model):
+    """Async ContentType.objects.get_for_model(model).id"""
+    content_type = _cached_content_type(model)
+    if content_type is None:
+        content_type = await sync_to_async(ContentType.objects.get_for_model)(model)
+    return content_type.id
+
+async def amodel_class(contenttype_id):
+    """Async ContentType.objects.get_for_id(contenttype_id).model_class()"""
+    content_type = _cached_content_type(contenttype_id)
+    if content_type is None:
+        try:
+            content_type = await sync_to_async(ContentType.objects.get_for_id)(contenttype_id)
+        except ContentType.DoesNotExist:
+            return None
+    return content_type.model_class()
+
+async def anode_keys(instances):
+    """Async node_keys()"""
+    cts = {}
+    keys = []
+    for instance in instances:
+        if isinstance(instance, tuple):
+            keys.append(instance)
+            continue
+        ct_id = cts.get(instance.__class__)
+        if ct_id is None:
+            ct_id = cts[instance.__class__] = await acontent_type_id(instance.__class__)
+        keys.append((ct_id, instance.pk))
+    return keys
+
+async def ahydrate(keys, hydrator=None):
+    """Async Fitting.hydrate(), loading each content type concurrently"""
+    hydrator = hydrator or models.Fitting.hydrator
+    type_map = {}
+    for (contenttype_id, id) in keys:
+        type_map.setdefault(contenttype_id, set()).add(id)
+    async def load(contenttype_id, ids):
+        model_cls = await amodel_class(contenttype_id)
+        if model_cls is None:
+            log.warning("Fitting references a deleted content-type")
+            return []
+        query = hydrator.queryset(model_cls)
+        ids = sorted(ids)
+        loaded = []
+        for i in range(0,len(ids),hydrator.chunk_size):
+            async for target in query.filter(pk__in = ids[i:i+hydrator.chunk_size]):
+                loaded.append(((contenttype_id,target.pk), target))
+        return loaded
+    object_map = {}
+    for loaded in await asyncio.gather(*[
+        load(contenttype_id, ids) for (contenttype_id, ids) in sorted(type_map.items())
+    ]):
+        object_map.update(loaded)
+    return object_map
+
+async def _amapping(fitting_type, mapping=None):
+    """Get the active mapping, loading its edges in a thread if necessary"""
+    mapping = traversal._mapping(fitting_type, mapping)
+    if mapping is not None and not mapping.loaded:
+        await sync_to_async(mapping._load)()
+    return mapping
+
+async def _ainstances(mapping, keys):
+    """Async mapping._instances()"""
+    missing = [key for key in keys if key not in mapping._objects]
+    if missing:
+        mapping._objects.update(await ahydrate(missing))
+    return [mapping._objects[key] for key in keys if key in mapping._objects]
+
+async def aneighbours(record, end, fitting_type=None):
+    """Async record.sources() (end='sources') or record.sinks() (end='sinks')"""
+    fitting_type = fitting_type or record.DEFAULT_FITTING_TYPE
+    prefetched = record.__dict__.get('_prefetched_fittings')
+    if prefetched and (fitting_type,end) in prefetched:
+        return prefetched[(fitting_type,end)]
+    if not record.pk:
+        return []
+    mapping = await _amapping(fitting_type)
+    models._cache_used(mapping, fitting_type)
+    if mapping is not None:
+        if end == 'sources':
+            return await _ainstances(mapping, mapping.source_keys(record))
+        return await _ainstances(mapping, mapping.sink_keys(record))
+    (ct_id, pk), = await anode_keys([record])
+    this, other = ('sink','source') if end == 'sources' else ('source','sink')
+    rows = [row async for row in models.Fitting.objects.filter(**{
+        'fitting_type': fitting_type,
+        '%s_type_id'%(this,): ct_id,
+        '%s_id'%(this,): pk,
+    }).order_by(
+        '%s_type_id'%(other,), '%s_id'%(other,)
+    ).values_list('pk', '%s_type_id'%(other,), '%s_id'%(other,))]
+    object_map = await ahydrate([(row[1],row[2]) for row in rows])
+    result, dangling = [], []
+    for (fitting_id, contenttype_id, id) in rows:
+        target = object_map.get((contenttype_id,id))
+        if target is not None:
+            result.append(target)
+        else:
+            dangling.append(fitting_id)
+    if dangling and orphans.delete_on_read():
+        # dangling references, see fitting.orphans
+        await models.Fitting.objects.filter(pk__in=dangling).adelete()
+        for fitting_id in dangling:
+            stats.report('orphan_delete', fitting_type)
+    return result
+
+async def aexpand(frontier, fitting_type=None, direction='down', mapping=None):
+    """Async traversal.expand(), querying the batches of the frontier concurrently"""
+    if direction not in traversal.DIRECTIONS:
+        raise ValueError("Unrecognized direction: %r"%(direction,))
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    mapping = await _amapping(fitting_type, mapping)
+    if mapping is not None:
+        return traversal.expand(frontier, fitting_type, direction, mapping)
+    frontier = set(frontier)
+    result = dict([(key,[]) for key in frontier])
+    async def rows(batch):
+        return [row async for row in traversal._edge_query(batch, fitting_type, direction)]
+    for batch_rows in await asyncio.gather(*[
+        rows(batch) for batch in traversal._batches(frontier)
+    ]):
+        traversal._collect(result, frontier, direction, batch_rows)
+    return result
+
+async def alevels(start, fitting_type=None, direction='down', max_depth=None, mapping=None):
+    """Async traversal.levels()"""
+    if not isinstance(start, (list,set,frozenset)):
+        start = [start]
+    state = traversal._Levels(await anode_keys(start), fitting_type, direction, max_depth)
+    try:
+        while state.more():
+            level = state.advance(await aexpand(state.frontier, fitting_type, direction, mapping))
+            if level:
+                yield state.depth, level
+    finally:
+        state.report()
+
+async def aiter_related(record, direction, fitting_type=None, seen=None, max_depth=None):
+    """Async record._iter_related(), loading each level's records concurrently"""
+    fitting_type = fitting_type or record.DEFAULT_FITTING_TYPE
+    seen = seen if seen is not None else set()
+    mapping = await _amapping(fitting_type)
+    async for (depth, keys) in alevels(
+        record, fitting_type, direction, max_depth=max_depth, mapping=mapping,
+    ):
+        if mapping is not None:
+            records = await _ainstances(mapping, keys)
+        else:
+            object_map = await ahydrate(keys)
+            records = [object_map[key] for key in keys if key in object_map]
+        for related in records:
+            if related not in seen:
+                seen.add(related)
+                yield related
+
+async def arelated(record, direction, fitting_type=None, max_depth=None):
+    """Async record.ancestors() (direction 'up') or record.descendants() ('down')"""
+    fitting_type = fitting_type or record.DEFAULT_FITTING_TYPE
+    if closure.enabled(fitting_type):
+        keys = await sync_to_async(closure.related)(record, fitting_type, direction, max_depth)
+        object_map = await ahydrate(keys)
+        return [object_map[key] for key in keys if key in object_map]
+    return [
+        related async for related in aiter_related(
+            record, direction, fitting_type, max_depth=max_depth,
+        )
+    ]
+
+async def afittings_changed(fitting_type, **changes):
+    """Async models._fittings_changed()
+
+    Only runs in a thread when the shared cache or closure table
+    (which use the database connection) are in use, otherwise the
+    active mappings changed are loaded first (in a thread) so that
+    writing the change through to them performs no queries.
+    """
+    if fitting_type is None:
+        closure_enabled = bool(closure.fitting_types())
+    else:
+        closure_enabled = closure.enabled(fitting_type)
+    if shared.enabled() or closure_enabled:
+        await sync_to_async(models._fittings_changed)(fitting_type, **changes)
+        return
+    if fitting_type is None:
+        fitting_types = list(models._pipe_mappings.get())
+    else:
+        fitting_types = [fitting_type]
+    for changed in fitting_types:
+        await _amapping(changed)
+    models._fittings_changed(fitting_type, **changes)
+
+async def adetach(record, end, fitting_type=None):
+    """Async record.detach_sources() (end='sources') or record.detach_sinks()"""
+    fitting_type = fitting_type or record.DEFAULT_FITTING_TYPE
+    record._forget_prefetched(fitting_type)
+    (ct_id, pk), = await anode_keys([record])
+    this = 'sink' if end == 'sources' else 'source'
+    deleted, _ = await models.Fitting.objects.filter(**{
+        'fitting_type': fitting_type,
+        '%s_type_id'%(this,): ct_id,
+        '%s_id'%(this,): pk,
+    }).adelete()
+    if not deleted:
+        return
+    if end == 'sources':
+        await afittings_changed(fitting_type, cleared_sources=[record])
+    else:
+        await afittings_changed(fitting_type, cleared_sinks=[record])
+
+async def apipe(source, sink, clear=True, fitting_type=None):
+    """Async source.pipe_to(sink)"""
+    fitting_type = fitting_type or source.DEFAULT_FITTING_TYPE
+    if clear:
+        await adetach(source, 'sinks', fitting_type)
+    (source_type_id, source_id), (sink_type_id, sink_id) = await anode_keys([source, sink])
+    fitting = models.Fitting(
+        fitting_type = fitting_type,
+        source_type_id = source_type_id,
+        source_id = source_id,
+        sink_type_id = sink_type_id,
+        sink_id = sink_id,
+    )
+    fitting._notified = True
+    await fitting.asave(force_insert=True, using=models.Fitting.objects.db)
+    source._forget_prefetched(fitting_type)
+    if isinstance(sink, models.PipeElement):
+        sink._forget_prefetched(fitting_type)
+    await afittings_changed(fitting_type, added=[(source,sink)])
+    return fitting
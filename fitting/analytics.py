@@ -0,0 +1,318 @@
+"""Vectorized analytics over the fittings of a fitting_type
+
+Requires NumPy, SciPy (if installed) is used for the sparse matrix and
+the component algorithms:
+
+    adj = analytics.adjacency(fitting_type=1)
+    in_degree, out_degree = analytics.degrees(adj)
+    analytics.hotspots(adj, count=10)
+    labels = analytics.components(adj)
+
+Node i of an Adjacency is the i-th (content_type_id,pk) key in sorted
+order (the order CompactPipeMapping uses), so the index of a node only
+depends on the set of fitted nodes.
+"""
+import logging
+from fitting import models
+log = logging.getLogger(__name__)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from scipy import sparse
+    from scipy.sparse import csgraph
+except ImportError:
+    sparse = csgraph = None
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("fitting.analytics requires numpy")
+
+class Adjacency(object):
+    """Edge arrays of a fitting graph over a stable node index
+
+    nodes -- sorted int64 array of packed (content_type_id,pk) keys
+    sources, sinks -- int64 arrays of the node indices of each edge
+    """
+    def __init__(self, nodes, sources, sinks, fitting_type=None):
+        self.nodes = nodes
+        self.sources = sources
+        self.sinks = sinks
+        self.fitting_type = fitting_type
+        self._csr = {}
+    def __len__(self):
+        return len(self.nodes)
+    def keys(self, indices=None):
+        """Get the (content_type_id,pk) keys of node indices (default all nodes)"""
+        packed = self.nodes if indices is None else self.nodes[indices]
+        return [models._unpack(int(value)) for value in packed]
+    def index(self, keys):
+        """Get the node indices of (content_type_id,pk) keys or instances
+
+        raises KeyError if any of the keys is not a fitted node
+        """
+        packed = numpy.array([models._pack(key) for key in models.node_keys(keys)], dtype=numpy.int64)
+        indices = numpy.searchsorted(self.nodes, packed)
+        found = indices < len(self.nodes)
+        found[found] = self.nodes[indices[found]] == packed[found]
+        if not found.all():
+            raise KeyError([models._unpack(int(value)) for value in packed[~found]])
+        return indices
+    def csr(self, direction='down'):
+        """Get (offsets,indices) arrays, the sinks (direction 'down') or
+        sources ('up') of node i are indices[offsets[i]:offsets[i+1]]"""
+        if direction not in self._csr:
+            if direction == 'down':
+                rows, columns = self.sources, self.sinks
+            elif direction == 'up':
+                rows, columns = self.sinks, self.sources
+            else:
+                raise ValueError("Unrecognized direction: %r"%(direction,))
+            offsets = numpy.zeros(len(self.nodes)+1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(rows, minlength=len(self.nodes)), out=offsets[1:])
+            self._csr[direction] = offsets, columns[numpy.argsort(rows, kind='stable')]
+        return self._csr[direction]
+    def matrix(self):
+        """Get the SciPy CSR adjacency matrix (row source, column sink)"""
+        if sparse is None:
+            raise ImportError("Adjacency.matrix() requires scipy")
+        offsets, indices = self.csr('down')
+        return sparse.csr_matrix(
+            (numpy.ones(len(indices), dtype=numpy.int8), indices, offsets),
+            shape=(len(self.nodes), len(self.nodes)),
+        )
+
+def _readonly(values):
+    result = numpy.frombuffer(values, dtype=numpy.int64)
+    result.setflags(write=False)
+    return result
+
+def adjacency(fitting_type=None, mapping=None):
+    """Export the fittings of fitting_type (or of mapping) as an Adjacency
+
+    mapping -- PipeMapping or CompactPipeMapping to export, default an
+        id-only CompactPipeMapping loaded with a single query, an
+        unedited CompactPipeMapping's arrays are used without copying
+    """
+    _require_numpy()
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    if mapping is None:
+        mapping = models.CompactPipeMapping(fitting_type=fitting_type)
+    if isinstance(mapping, models.CompactPipeMapping) and not (
+        mapping._overrides['forward'] or mapping._overrides['reverse']
+    ):
+        nodes, (offsets, indices), reverse = mapping.arrays()
+        nodes, offsets = _readonly(nodes), _readonly(offsets)
+        sources = numpy.repeat(numpy.arange(len(nodes), dtype=numpy.int64), numpy.diff(offsets))
+        result = Adjacency(nodes, sources, _readonly(indices), fitting_type=mapping.fitting_type)
+        result._csr['down'] = offsets, result.sinks
+        return result
+    sources, sinks = [], []
+    for key in mapping.nodes():
+        for sink in mapping.sink_keys(key):
+            sources.append(models._pack(key))
+            sinks.append(models._pack(sink))
+    sources = numpy.array(sources, dtype=numpy.int64)
+    sinks = numpy.array(sinks, dtype=numpy.int64)
+    nodes = numpy.union1d(sources, sinks)
+    return Adjacency(
+        nodes,
+        numpy.searchsorted(nodes, sources),
+        numpy.searchsorted(nodes, sinks),
+        fitting_type=mapping.fitting_type,
+    )
+
+def degrees(adj):
+    """Get (in_degree,out_degree) arrays indexed by node"""
+    return (
+        numpy.bincount(adj.sinks, minlength=len(adj)),
+        numpy.bincount(adj.sources, minlength=len(adj)),
+    )
+
+def _degree(adj, direction):
+    if direction == 'out':
+        return degrees(adj)[1]
+    elif direction == 'in':
+        return degrees(adj)[0]
+    raise ValueError("Unrecognized direction: %r"%(direction,))
+
+def degree_distribution(adj, direction='out'):
+    """Get (degrees,counts) arrays, counts[i] nodes have degrees[i] sinks ('out') or sources ('in')"""
+    return numpy.unique(_degree(adj, direction), return_counts=True)
+
+def hotspots(adj, count=10, direction='out'):
+    """Get [(key,degree),...] for the count nodes with the most sinks ('out') or sources ('in')"""
+    degree = _degree(adj, direction)
+    count = min(count, len(degree))
+    if not count:
+        return []
+    top = numpy.argpartition(-degree, count-1)[:count]
+    top = top[numpy.lexsort((top, -degree[top]))]
+    return list(zip(adj.keys(top), [int(value) for value in degree[top]]))
+
+def components(adj):
+    """Get the (weakly) connected component label of each node
+
+    Components are numbered from 0 in the order of their lowest node index
+    """
+    if csgraph is not None:
+        _, labels = csgraph.connected_components(adj.matrix(), directed=True, connection='weak')
+    else:
+        # min-label propagation with pointer jumping, labels are always
+        # the index of a node in the same component
+        labels = numpy.arange(len(adj), dtype=numpy.int64)
+        while True:
+            previous = labels
+            lowest = numpy.minimum(labels[adj.sources], labels[adj.sinks])
+            labels = labels.copy()
+            numpy.minimum.at(labels, adj.sources, lowest)
+            numpy.minimum.at(labels, adj.sinks, lowest)
+            labels = labels[labels]
+            if numpy.array_equal(labels, previous):
+                break
+    _, first, inverse = numpy.unique(labels, return_index=True, return_inverse=True)
+    return numpy.argsort(numpy.argsort(first))[inverse]
+
+def component_sizes(adj):
+    """Get the number of nodes in each (weakly) connected component"""
+    return numpy.bincount(components(adj))
+
+def cyclic_nodes(adj):
+    """Get the keys of the nodes which lie on a cycle (requires SciPy)"""
+    if csgraph is None:
+        raise ImportError("cyclic_nodes() requires scipy")
+    _, labels = csgraph.connected_components(adj.matrix(), directed=True, connection='strong')
+    cyclic = numpy.bincount(labels)[labels] > 1
+    cyclic[adj.sources[adj.sources == adj.sinks]] = True
+    return adj.keys(numpy.flatnonzero(cyclic))
+
+def has_cycle(adj):
+    """Does the graph contain a cycle?
+
+    Peels nodes without (remaining) sources level by level, which only
+    leaves nodes if there is a cycle.
+    """
+    in_degree = degrees(adj)[0]
+    removed = numpy.zeros(len(adj), dtype=bool)
+    remaining = numpy.ones(len(adj.sources), dtype=bool)
+    frontier = in_degree == 0
+    while frontier.any():
+        removed |= frontier
+        leaving = remaining & frontier[adj.sources]
+        remaining &= ~leaving
+        in_degree = in_degree - numpy.bincount(adj.sinks[leaving], minlength=len(adj))
+        frontier = (in_degree == 0) & ~removed
+    return not removed.all()
+
+def _expand(offsets, indices, frontier):
+    """Get the neighbours of all of the frontier nodes"""
+    starts = offsets[frontier]
+    lengths = offsets[frontier+1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return indices[numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(total)]
+
+#: bytes of reachability bitsets held at once by reachability_counts()
+REACHABILITY_MEMORY = 64*1024*1024
+
+def _condensed(adj, direction):
+    """Get (labels, cyclic, sources, sinks) of the condensation of adj
+
+    Nodes are collapsed into their strongly connected components (which
+    requires SciPy unless the graph is acyclic), cyclic marks the
+    components whose nodes lie on a cycle, sources and sinks are the
+    distinct edges between components in the direction followed.
+    """
+    if direction == 'down':
+        sources, sinks = adj.sources, adj.sinks
+    elif direction == 'up':
+        sources, sinks = adj.sinks, adj.sources
+    else:
+        raise ValueError("Unrecognized direction: %r"%(direction,))
+    if csgraph is not None:
+        count, labels = csgraph.connected_components(adj.matrix(), directed=True, connection='strong')
+    elif not has_cycle(adj):
+        count, labels = len(adj), numpy.arange(len(adj), dtype=numpy.int64)
+    else:
+        raise ImportError("reachability_counts() of a cyclic graph requires scipy")
+    cyclic = numpy.bincount(labels, minlength=count) > 1
+    cyclic[labels[sources[sources == sinks]]] = True
+    sources, sinks = labels[sources], labels[sinks]
+    between = sources != sinks
+    edges = numpy.unique(numpy.stack([sources[between], sinks[between]], axis=1), axis=0)
+    return labels.astype(numpy.int64), cyclic, edges[:,0].astype(numpy.int64), edges[:,1].astype(numpy.int64)
+
+def _heights(count, sources, sinks):
+    """Get the height of each node of a DAG (0 for nodes without sinks)"""
+    remaining = numpy.bincount(sources, minlength=count)
+    order = numpy.argsort(sinks, kind='stable')
+    offsets = numpy.zeros(count+1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(sinks, minlength=count), out=offsets[1:])
+    predecessors = sources[order]
+    heights = numpy.zeros(count, dtype=numpy.int64)
+    frontier, height = numpy.flatnonzero(remaining == 0), 0
+    while len(frontier):
+        heights[frontier] = height
+        found = _expand(offsets, predecessors, frontier)
+        remaining -= numpy.bincount(found, minlength=count)
+        found = numpy.unique(found)
+        frontier, height = found[remaining[found] == 0], height + 1
+    return heights
+
+def _popcount(words):
+    """Count the set bits of each row of a uint64 array"""
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(words).sum(axis=1, dtype=numpy.int64)
+    return numpy.unpackbits(words.view(numpy.uint8), axis=1).sum(axis=1, dtype=numpy.int64)
+
+def reachability_counts(adj, nodes=None, direction='down'):
+    """Count the nodes reachable from each of nodes (keys, default all nodes)
+
+    As for traverse(), a node only counts itself if it is on a cycle.
+    Strongly connected components are collapsed (requires SciPy for
+    cyclic graphs), then the bitset of components reachable from each
+    component is OR-ed together from those of its successors in reverse
+    topological order, one topological level at a time. The cost is
+    still proportional to the number of components squared, so the
+    bitsets are built for blocks of target components holding at most
+    REACHABILITY_MEMORY bytes.
+
+    returns an array of counts in the order of nodes
+    """
+    labels, cyclic, sources, sinks = _condensed(adj, direction)
+    count = len(cyclic)
+    sizes = numpy.bincount(labels, minlength=count)
+    totals = numpy.where(cyclic, sizes, 0).astype(numpy.int64)
+    heights = _heights(count, sources, sinks)
+    # edges grouped by the height of their source, then by source
+    order = numpy.lexsort((sources, heights[sources]))
+    sources, sinks = sources[order], sinks[order]
+    bounds = numpy.searchsorted(heights[sources], numpy.arange(int(heights.max(initial=0))+2))
+    words = int(max(1, min(-(-count//64), REACHABILITY_MEMORY // (8*max(count, 1)))))
+    step = max(1, REACHABILITY_MEMORY // (8*words))
+    one = numpy.uint64(1)
+    for low in range(0, count, 64*words):
+        high = min(count, low+64*words)
+        reached = numpy.zeros((count, words), dtype=numpy.uint64)
+        for height in range(1, len(bounds)-1):
+            for start in range(bounds[height], bounds[height+1], step):
+                stop = min(bounds[height+1], start+step)
+                group, targets = sources[start:stop], sinks[start:stop]
+                values = reached[targets]
+                inside = numpy.flatnonzero((targets >= low) & (targets < high))
+                offsets = targets[inside]-low
+                values[inside, offsets//64] |= one << (offsets%64).astype(numpy.uint64)
+                starts = numpy.flatnonzero(numpy.r_[True, group[1:] != group[:-1]])
+                reached[group[starts]] |= numpy.bitwise_or.reduceat(values, starts, axis=0)
+        totals += _popcount(reached)
+        # components of more than one node count their other nodes
+        larger = numpy.flatnonzero(sizes[low:high] > 1)
+        for first in range(0, len(larger), 64):
+            offsets = larger[first:first+64]
+            bits = (reached[:, offsets//64] >> (offsets%64).astype(numpy.uint64)) & one
+            totals += bits.astype(numpy.int64) @ (sizes[low+offsets]-1)
+    if nodes is None:
+        return totals[labels]
+    return totals[labels[adj.index(nodes)]]
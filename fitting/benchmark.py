@@ -0,0 +1,211 @@
+"""Benchmarks for the queries behind the Fitting access paths
+
+    python manage.py fitting_benchmark --edges 200000
+
+Running it before and after `migrate fitting 0002` compares the query 
+plans and timings of the hot queries using the single-column indexes
+with those using the composite indexes. The benchmark edges are created
+in a transaction which is rolled back afterwards.
+
+The suite (run_suite(), or `fitting_benchmark --suite --model app.Model`)
+builds chains, fan-out/fan-in graphs and random DAGs of real records,
+of one or several content types, and measures the wall time, peak 
+memory and query count of the public operations on each of them.
+"""
+import random, time, tracemalloc
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import Q, Max
+from django.test.utils import CaptureQueriesContext
+from fitting import models
+
+def populate_edges(edges, nodes, fitting_types=1, seed=0, batch_size=5000):
+    """Bulk-create random fittings between synthetic node keys
+    
+    Node keys use the content types of ContentType and Fitting, the 
+    fitted records do not need to exist for the edge lookups.
+    
+    returns the list of node keys used
+    """
+    rng = random.Random(seed)
+    cts = [
+        ContentType.objects.get_for_model(ContentType).id,
+        ContentType.objects.get_for_model(models.Fitting).id,
+    ]
+    keys = [(rng.choice(cts), i+1) for i in range(nodes)]
+    created = 0
+    while created < edges:
+        count = min(batch_size, edges-created)
+        for fitting_type in range(1, fitting_types+1):
+            models.Fitting.objects.bulk_pipe(
+                [(rng.choice(keys), rng.choice(keys)) for i in range(count//fitting_types or 1)],
+                fitting_type=fitting_type,
+                batch_size=batch_size,
+            )
+        created += count
+    return keys
+
+def analyze():
+    """Update the planner statistics where the backend supports it"""
+    connection = connections[models.Fitting.objects.db]
+    if connection.vendor in ('sqlite','postgresql'):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+def hot_queries(key, fitting_type=None):
+    """Get (name, queryset) for each of the queries on the hot paths for key"""
+    ct_id, pk = key
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    return [
+        ('sources', models.Fitting.sources(key, fitting_type=fitting_type)),
+        ('sinks', models.Fitting.sinks(key, fitting_type=fitting_type)),
+        ('mapping', models.Fitting.objects.filter(fitting_type=fitting_type).values_list(
+            'source_type_id','source_id','sink_type_id','sink_id'
+        )),
+        ('unlink', models.Fitting.objects.filter(
+            Q(source_type_id=ct_id, source_id__in=[pk]) |
+            Q(sink_type_id=ct_id, sink_id__in=[pk])
+        )),
+    ]
+
+def explain_hot_queries(key, fitting_type=None):
+    """Get (name, query plan) for each of the hot queries"""
+    return [
+        (name, query.explain())
+        for (name, query) in hot_queries(key, fitting_type)
+    ]
+
+def time_hot_queries(keys, fitting_type=None):
+    """Get (name, average seconds) running each of the hot queries for keys"""
+    timings = []
+    for (i,(name,query)) in enumerate(hot_queries(keys[0], fitting_type)):
+        start = time.perf_counter()
+        for key in keys:
+            list(hot_queries(key, fitting_type)[i][1])
+        timings.append((name, (time.perf_counter()-start)/len(keys)))
+    return timings
+
+def create_nodes(model_classes, count):
+    """Bulk-create count records spread round-robin over model_classes
+    
+    The models must be creatable without arguments, returns the 
+    records in round-robin order
+    """
+    created = [
+        list(model_cls.objects.bulk_create([
+            model_cls() for i in range(position,count,len(model_classes))
+        ]))
+        for (position,model_cls) in enumerate(model_classes)
+    ]
+    return [created[i%len(model_classes)][i//len(model_classes)] for i in range(count)]
+
+def chain(nodes, seed=0):
+    """Get the (source,sink) edges of a chain through nodes"""
+    return list(zip(nodes[:-1], nodes[1:]))
+
+def fan_out_in(nodes, seed=0):
+    """Get edges from the first node to every middle node and from those to the last node"""
+    return [(nodes[0],node) for node in nodes[1:-1]] + [(node,nodes[-1]) for node in nodes[1:-1]]
+
+def random_dag(nodes, seed=0, edges=None):
+    """Get edges (default twice as many as nodes) of a random DAG, each from an earlier to a later node"""
+    rng = random.Random(seed)
+    edges = edges or 2*len(nodes)
+    result = set()
+    for i in range(min(edges, len(nodes)*(len(nodes)-1)//2)):
+        while True:
+            source, sink = sorted(rng.sample(range(len(nodes)), 2))
+            if (source,sink) not in result:
+                result.add((source,sink))
+                break
+    return [(nodes[source],nodes[sink]) for (source,sink) in sorted(result)]
+
+GRAPHS = [
+    ('chain', chain),
+    ('fan', fan_out_in),
+    ('dag', random_dag),
+]
+
+def measure(function, *args, **named):
+    """Call function(*args,**named) measuring wall time, peak memory and queries
+    
+    returns (result, {'seconds':...,'peak_memory': bytes,'queries': count})
+    """
+    connection = connections[models.Fitting.objects.db]
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = function(*args, **named)
+        seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - base
+    if not tracing:
+        tracemalloc.stop()
+    return result, {
+        'seconds': seconds,
+        'peak_memory': peak,
+        'queries': len(queries),
+    }
+
+def operations(nodes, fitting_type):
+    """Get (name, callable) for the public operations measured on a graph of nodes"""
+    root, leaf = nodes[0], nodes[-1]
+    return [
+        ('Fitting.mapping', lambda: models.Fitting.mapping(fitting_type)),
+        ('PipeMapping', lambda: models.PipeMapping(fitting_type=fitting_type)),
+        ('CompactPipeMapping', lambda: models.CompactPipeMapping(fitting_type=fitting_type).arrays()),
+        ('sinks', lambda: root.sinks(fitting_type)),
+        ('sources', lambda: leaf.sources(fitting_type)),
+        ('iter_descendants', lambda: list(root.iter_descendants(fitting_type))),
+        ('descendants(single_query)', lambda: root.descendants(fitting_type, single_query=True)),
+        ('cached iter_descendants', lambda: _cached(fitting_type, lambda: list(root.iter_descendants(fitting_type)))),
+        ('pipe_to', lambda: leaf.pipe_to(root, clear=False, fitting_type=fitting_type)),
+        ('delete', lambda: leaf.delete()),
+    ]
+
+def _cached(fitting_type, function):
+    with models.cache(fitting_type=fitting_type):
+        return function()
+
+def run_suite(model_classes, sizes=(100,1000), graphs=None, seed=0, progress=None):
+    """Measure the public operations on each generated graph
+    
+    model_classes -- PipeElement models (creatable without arguments) to
+        create the nodes from, graphs are generated with the first model
+        only and, if there are several, with all of them
+    graphs -- (name, generator) pairs, default GRAPHS
+    progress -- optional callable(record) called as each record is measured
+    
+    Each graph uses its own fitting_type (starting after the existing 
+    ones), run it in a transaction which is rolled back afterwards.
+    
+    returns [{'graph','content_types','size','operation','seconds','peak_memory','queries'}]
+    """
+    model_classes = list(model_classes)
+    variants = [model_classes[:1]]
+    if len(model_classes) > 1:
+        variants.append(model_classes)
+    fitting_type = models.Fitting.objects.aggregate(top=Max('fitting_type'))['top'] or 0
+    records = []
+    for size in sizes:
+        for (name, generator) in (graphs or GRAPHS):
+            for classes in variants:
+                fitting_type += 1
+                nodes = create_nodes(classes, size)
+                edges = generator(nodes, seed=seed)
+                setup = [('bulk_pipe', lambda: models.Fitting.objects.bulk_pipe(edges, fitting_type=fitting_type))]
+                for (operation, function) in setup + operations(nodes, fitting_type):
+                    _, stats = measure(function)
+                    stats.update({
+                        'graph': name,
+                        'content_types': len(classes),
+                        'size': size,
+                        'operation': operation,
+                    })
+                    records.append(stats)
+                    if progress is not None:
+                        progress(stats)
+    return records
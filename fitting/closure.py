@@ -0,0 +1,296 @@
+"""Optional transitive-closure table for O(1) reachability queries
+
+For the fitting_types listed in settings:
+
+    FITTING_CLOSURE_TYPES = [1]
+
+a FittingClosure record is kept for every (ancestor,descendant) pair, 
+maintained incrementally by the mutation APIs (pipe_to, pipe_many, 
+sync, detach, deletion...). ancestors(), descendants() and 
+is_reachable() then become a single indexed lookup. Fittings written 
+by other means (raw SQL, Fitting.objects.create) require a rebuild:
+
+    python manage.py fitting_closure --fitting-type 1
+
+Batched writes (imports, restores) can defer the maintenance to a 
+single rebuild per fitting_type:
+
+    with closure.deferred():
+        for batch in batches:
+            Fitting.objects.bulk_pipe(batch)
+"""
+import contextlib, contextvars
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from fitting import models
+
+#: adding more edges than this at once, if they are also more than
+#: REBUILD_FRACTION of the fitting_type's fittings, rebuilds the whole
+#: fitting_type rather than adding each edge
+REBUILD_THRESHOLD = 100
+REBUILD_FRACTION = 0.25
+BATCH_SIZE = 500
+
+# set of fitting_types changed within a deferred() block
+_deferred = contextvars.ContextVar('fitting_closure_deferred', default=None)
+
+@contextlib.contextmanager
+def deferred():
+    """Defer the closure maintenance of the block to one rebuild per fitting_type
+    
+    Within the block fittings_changed() only records the fitting_types
+    changed, each is rebuilt when the block exits. If the block raises
+    nothing is rebuilt, run a rebuild if its writes were not rolled back.
+    Nested blocks join the outermost one.
+    """
+    if _deferred.get() is not None:
+        yield
+        return
+    changed = set()
+    token = _deferred.set(changed)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+    for fitting_type in sorted(changed):
+        rebuild(fitting_type)
+
+def fitting_types():
+    """Get the fitting_types the closure table is maintained for"""
+    return getattr(settings, 'FITTING_CLOSURE_TYPES', ())
+
+def enabled(fitting_type=None):
+    """Is the closure table maintained for fitting_type?"""
+    return (fitting_type or models.Fitting.DEFAULT_FITTING_TYPE) in fitting_types()
+
+def _key_filters(prefix, keys):
+    """Yield Q objects matching records whose prefix is one of keys (in batches)"""
+    type_map = {}
+    for (contenttype_id, id) in keys:
+        type_map.setdefault(contenttype_id, []).append(id)
+    for (contenttype_id, ids) in sorted(type_map.items()):
+        ids = sorted(ids)
+        for i in range(0,len(ids),BATCH_SIZE):
+            yield Q(**{
+                '%s_type_id'%(prefix,): contenttype_id,
+                '%s_id__in'%(prefix,): ids[i:i+BATCH_SIZE],
+            })
+
+def _depths(fitting_type, key, direction):
+    """Get {key: depth} for the closure ancestors ('up') or descendants ('down') of key"""
+    near, far = ('descendant','ancestor') if direction == 'up' else ('ancestor','descendant')
+    return dict([
+        ((type_id,id),depth)
+        for (type_id,id,depth) in models.FittingClosure.objects.filter(**{
+            'fitting_type': fitting_type,
+            '%s_type_id'%(near,): key[0],
+            '%s_id'%(near,): key[1],
+        }).values_list('%s_type_id'%(far,),'%s_id'%(far,),'depth')
+    ])
+
+def related(instance, fitting_type=None, direction='down', max_depth=None):
+    """Get keys of instance's descendants ('down') or ancestors ('up') 
+    
+    returns [(content_type_id,pk),...] ordered by depth, content type and pk
+    """
+    if direction not in ('up','down'):
+        raise ValueError("Unrecognized direction: %r"%(direction,))
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    near, far = ('descendant','ancestor') if direction == 'up' else ('ancestor','descendant')
+    key = models.node_key(instance)
+    query = models.FittingClosure.objects.filter(**{
+        'fitting_type': fitting_type,
+        '%s_type_id'%(near,): key[0],
+        '%s_id'%(near,): key[1],
+    })
+    if max_depth is not None:
+        query = query.filter(depth__lte=max_depth)
+    return [
+        (type_id,id) for (type_id,id) in query.order_by(
+            'depth','%s_type_id'%(far,),'%s_id'%(far,)
+        ).values_list('%s_type_id'%(far,),'%s_id'%(far,))
+    ]
+
+def is_reachable(source, sink, fitting_type=None):
+    """Is sink downstream of source?"""
+    source, sink = models.node_key(source), models.node_key(sink)
+    return models.FittingClosure.objects.filter(
+        fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE,
+        ancestor_type_id = source[0], ancestor_id = source[1],
+        descendant_type_id = sink[0], descendant_id = sink[1],
+    ).exists()
+
+def _subgraph(fitting_type, roots):
+    """Load {key: [sink keys]} for everything reachable from roots
+    
+    Performs one query (per batch) for each level of the graph
+    """
+    adjacency = {}
+    frontier = set(roots)
+    while frontier:
+        for key in frontier:
+            adjacency[key] = []
+        for query in _key_filters('source', frontier):
+            for (source_type_id,source_id,sink_type_id,sink_id) in models.Fitting.objects.filter(
+                query, fitting_type=fitting_type,
+            ).values_list('source_type_id','source_id','sink_type_id','sink_id'):
+                adjacency[(source_type_id,source_id)].append((sink_type_id,sink_id))
+        frontier = set([
+            sink for key in frontier for sink in adjacency[key] 
+            if sink not in adjacency
+        ])
+    return adjacency
+
+def _shortest(adjacency, root):
+    """Get {key: depth} for everything reachable from root (breadth-first)"""
+    depths, frontier, depth = {}, [root], 0
+    while frontier:
+        depth += 1
+        following = []
+        for key in frontier:
+            for sink in adjacency.get(key, ()):
+                if sink not in depths:
+                    depths[sink] = depth
+                    following.append(sink)
+        frontier = following
+    return depths
+
+def _records(fitting_type, ancestor, depths):
+    return [
+        models.FittingClosure(
+            fitting_type = fitting_type,
+            ancestor_type_id = ancestor[0], ancestor_id = ancestor[1],
+            descendant_type_id = descendant[0], descendant_id = descendant[1],
+            depth = depth,
+        )
+        for (descendant,depth) in sorted(depths.items())
+    ]
+
+def _write(fitting_type, ancestors, adjacency):
+    """Write the closure records of each of ancestors"""
+    pending = []
+    for ancestor in sorted(ancestors):
+        pending.extend(_records(fitting_type, ancestor, _shortest(adjacency, ancestor)))
+        if len(pending) >= BATCH_SIZE:
+            models.FittingClosure.objects.bulk_create(pending, batch_size=BATCH_SIZE)
+            pending = []
+    if pending:
+        models.FittingClosure.objects.bulk_create(pending, batch_size=BATCH_SIZE)
+
+def rebuild(fitting_type=None):
+    """Rebuild the whole closure table for fitting_type from its fittings
+    
+    returns the number of closure records
+    """
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    adjacency = {}
+    for (source_type_id,source_id,sink_type_id,sink_id) in models.Fitting.objects.filter(
+        fitting_type=fitting_type
+    ).values_list('source_type_id','source_id','sink_type_id','sink_id'):
+        adjacency.setdefault((source_type_id,source_id),[]).append((sink_type_id,sink_id))
+    with transaction.atomic(using=models.FittingClosure.objects.db):
+        models.FittingClosure.objects.filter(fitting_type=fitting_type).delete()
+        _write(fitting_type, adjacency.keys(), adjacency)
+        return models.FittingClosure.objects.filter(fitting_type=fitting_type).count()
+
+def recompute(fitting_type, roots):
+    """Recompute the closure records of roots and all of their ancestors
+    
+    Used after fittings are removed, as any ancestor of the source of 
+    a removed fitting may have lost descendants.
+    """
+    affected = set(roots)
+    for query in _key_filters('descendant', roots):
+        affected.update(
+            models.FittingClosure.objects.filter(
+                query, fitting_type=fitting_type,
+            ).values_list('ancestor_type_id','ancestor_id')
+        )
+    adjacency = _subgraph(fitting_type, affected)
+    with transaction.atomic(using=models.FittingClosure.objects.db):
+        for query in _key_filters('ancestor', affected):
+            models.FittingClosure.objects.filter(query, fitting_type=fitting_type).delete()
+        _write(fitting_type, affected, adjacency)
+
+def add_edge(fitting_type, source, sink):
+    """Add the closure records for a new fitting from source to sink
+    
+    Every ancestor of source (and source) now reaches every descendant
+    of sink (and sink), existing records are kept unless the new path 
+    is shorter.
+    """
+    source, sink = models.node_key(source), models.node_key(sink)
+    ancestors = _depths(fitting_type, source, 'up')
+    ancestors[source] = 0
+    descendants = _depths(fitting_type, sink, 'down')
+    descendants[sink] = 0
+    wanted = {}
+    for (ancestor,up) in ancestors.items():
+        for (descendant,down) in descendants.items():
+            wanted[(ancestor,descendant)] = up+1+down
+    existing = {}
+    for ancestor_query in _key_filters('ancestor', ancestors):
+        for descendant_query in _key_filters('descendant', descendants):
+            for record in models.FittingClosure.objects.filter(
+                ancestor_query, descendant_query, fitting_type=fitting_type,
+            ):
+                existing[(
+                    (record.ancestor_type_id,record.ancestor_id),
+                    (record.descendant_type_id,record.descendant_id),
+                )] = record
+    shorter = []
+    for (pair,record) in existing.items():
+        if wanted[pair] < record.depth:
+            record.depth = wanted[pair]
+            shorter.append(record)
+    if shorter:
+        models.FittingClosure.objects.bulk_update(shorter, ['depth'], batch_size=BATCH_SIZE)
+    models.FittingClosure.objects.bulk_create([
+        models.FittingClosure(
+            fitting_type = fitting_type,
+            ancestor_type_id = ancestor[0], ancestor_id = ancestor[1],
+            descendant_type_id = descendant[0], descendant_id = descendant[1],
+            depth = depth,
+        )
+        for ((ancestor,descendant),depth) in sorted(wanted.items())
+        if (ancestor,descendant) not in existing
+    ], batch_size=BATCH_SIZE)
+
+def _rebuild_cheaper(fitting_type, added):
+    """Is rebuilding fitting_type cheaper than adding each of the added edges?"""
+    if len(added) <= REBUILD_THRESHOLD:
+        return False
+    return len(added) > REBUILD_FRACTION * models.Fitting.objects.filter(
+        fitting_type=fitting_type
+    ).count()
+
+def fittings_changed(fitting_type, added=(), removed=(), cleared=()):
+    """Maintain the closure records after a change through the mutation APIs
+    
+    fitting_type -- fitting_type changed, None for all fitting_types
+    added, removed -- (source,sink) edges
+    cleared -- records which lost all their sources and/or sinks
+    """
+    if fitting_type is None:
+        changed = fitting_types()
+    elif enabled(fitting_type):
+        changed = [fitting_type]
+    else:
+        return
+    pending = _deferred.get()
+    if pending is not None:
+        pending.update(changed)
+        return
+    for fitting_type in changed:
+        with transaction.atomic(using=models.FittingClosure.objects.db):
+            roots = models.node_keys(cleared) + models.node_keys(
+                [source for (source,sink) in removed]
+            )
+            if roots:
+                recompute(fitting_type, roots)
+            if _rebuild_cheaper(fitting_type, added):
+                rebuild(fitting_type)
+            else:
+                for (source,sink) in added:
+                    add_edge(fitting_type, source, sink)
@@ -0,0 +1,106 @@
+"""Query-bounded export of fittings
+
+Records have the same format as Fitting.__json__, but are built from
+.values_list() rows and a single content-type lookup table, so the
+number of queries does not depend on the number of fittings:
+
+    for record in iter_fittings(fitting_type=1):
+        ...
+    records, after = fitting_page(fitting_type=1, after=after)
+    StreamingHttpResponse(stream_fittings(fitting_type=1), content_type='application/json')
+"""
+import json
+from django.contrib.contenttypes.models import ContentType
+from fitting import models
+
+FIELDS = ('pk','fitting_type','source_type_id','source_id','sink_type_id','sink_id')
+
+def content_type_table():
+    """Get {content_type_id: (app_label,model)} for all content types"""
+    return dict([
+        (id,(app_label,model))
+        for (id,app_label,model) in ContentType.objects.values_list('id','app_label','model')
+    ])
+
+def _record(row, types, cls=models.Fitting):
+    (pk,fitting_type,source_type_id,source_id,sink_type_id,sink_id) = row
+    source_app, source_model = types.get(source_type_id, (None,None))
+    sink_app, sink_model = types.get(sink_type_id, (None,None))
+    return {
+        'pk': pk, 
+        'type': cls.__name__, 
+        'fitting_type': fitting_type, 
+        'source': {
+            'app': source_app, 
+            'type': source_model, 
+            'pk': source_id, 
+        }, 
+        'sink': {
+            'app': sink_app, 
+            'type': sink_model, 
+            'pk': sink_id, 
+        }
+    }
+
+def _query(fitting_type=None, cls=models.Fitting):
+    fittings = cls.objects.all()
+    if fitting_type:
+        fittings = fittings.filter(
+            fitting_type=fitting_type, 
+        )
+    return fittings.order_by('pk').values_list(*FIELDS)
+
+def iter_fittings(fitting_type=None, cls=models.Fitting, chunk_size=2000):
+    """Iterate over the records for all fittings (of fitting_type) in pk order
+    
+    Memory use is bounded by chunk_size, the fittings are read with
+    a single (server-side cursor, where supported) query
+    """
+    types = content_type_table()
+    for row in _query(fitting_type, cls).iterator(chunk_size=chunk_size):
+        yield _record(row, types, cls)
+
+def fitting_page(fitting_type=None, after=None, limit=1000, cls=models.Fitting, types=None):
+    """Get a page of fitting records using keyset pagination by pk
+    
+    after -- pk of the last record of the previous page (None for the first page)
+    types -- optional content_type_table() to re-use across pages
+    
+    returns (records, after) where after is None on the last page
+    """
+    types = types if types is not None else content_type_table()
+    query = _query(fitting_type, cls)
+    if after is not None:
+        query = query.filter(pk__gt=after)
+    records = [_record(row, types, cls) for row in query[:limit]]
+    if len(records) < limit:
+        return records, None
+    return records, records[-1]['pk']
+
+def stream_fittings(fitting_type=None, cls=models.Fitting, chunk_size=2000):
+    """Yield a JSON array of all fitting records as text chunks
+    
+    Suitable for use as the content of a StreamingHttpResponse, each
+    chunk holds up to chunk_size records.
+    """
+    yield '['
+    batch, first = [], True
+    for record in iter_fittings(fitting_type, cls, chunk_size=chunk_size):
+        batch.append(json.dumps(record))
+        if len(batch) >= chunk_size:
+            yield ('' if first else ',') + ','.join(batch)
+            batch, first = [], False
+    if batch:
+        yield ('' if first else ',') + ','.join(batch)
+    yield ']'
+
+def fitting_map(fitting_type=None, cls=models.Fitting, chunk_size=2000):
+    """Get {(source app,source model,source pk): [records]} for all fittings"""
+    mapping = {}
+    for record in iter_fittings(fitting_type, cls, chunk_size=chunk_size):
+        source = record['source']
+        mapping.setdefault(
+            (source['app'], source['type'], source['pk']),
+            []
+        ).append( record )
+    return mapping
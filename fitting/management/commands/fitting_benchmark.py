@@ -0,0 +1,49 @@
+"""Time the hot Fitting queries and show their query plans
+
+With --suite, measure the public operations on generated graphs instead
+"""
+import random
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from fitting import benchmark, models
+
+class Command(BaseCommand):
+    help = 'Benchmark the hot Fitting queries against synthetic (rolled back) edges'
+    def add_arguments(self, parser):
+        parser.add_argument('--edges', type=int, default=100000)
+        parser.add_argument('--nodes', type=int, default=20000)
+        parser.add_argument('--fitting-types', type=int, default=4)
+        parser.add_argument('--samples', type=int, default=200,
+            help='number of nodes to time the per-node queries on')
+        parser.add_argument('--suite', action='store_true',
+            help='run the graph generator suite (see fitting.benchmark.run_suite)')
+        parser.add_argument('--model', action='append', default=[],
+            help='app_label.Model PipeElement to build the suite graphs from (repeatable)')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100,1000])
+    def handle(self, *args, **options):
+        if options['suite']:
+            return self.suite(options)
+        with transaction.atomic(using=models.Fitting.objects.db):
+            keys = benchmark.populate_edges(
+                options['edges'], options['nodes'], options['fitting_types'],
+            )
+            benchmark.analyze()
+            for (name, plan) in benchmark.explain_hot_queries(keys[0]):
+                self.stdout.write('%s:\n    %s'%(name, plan.replace('\n','\n    ')))
+            samples = random.Random(1).sample(keys, min(options['samples'], len(keys)))
+            for (name, seconds) in benchmark.time_hot_queries(samples):
+                self.stdout.write('%-8s %9.3fms'%(name, seconds*1000))
+            transaction.set_rollback(True, using=models.Fitting.objects.db)
+    def suite(self, options):
+        if not options['model']:
+            raise CommandError('--suite requires at least one --model')
+        try:
+            model_classes = [apps.get_model(label) for label in options['model']]
+        except (LookupError, ValueError) as err:
+            raise CommandError(str(err))
+        def progress(record):
+            self.stdout.write('%(graph)-6s %(content_types)2s %(size)7s %(operation)-26s %(queries)6s queries %(seconds)9.4fs %(peak_memory)10s bytes'%record)
+        with transaction.atomic(using=models.Fitting.objects.db):
+            benchmark.run_suite(model_classes, sizes=options['sizes'], progress=progress)
+            transaction.set_rollback(True, using=models.Fitting.objects.db)
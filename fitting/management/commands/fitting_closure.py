@@ -0,0 +1,15 @@
+"""Rebuild the transitive-closure table"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from fitting import closure
+
+class Command(BaseCommand):
+    help = 'Rebuild the FittingClosure records from the current fittings'
+    def add_arguments(self, parser):
+        parser.add_argument('--fitting-type', type=int, action='append', dest='fitting_types',
+            help='fitting_type to rebuild (repeatable), default all FITTING_CLOSURE_TYPES')
+    def handle(self, *args, **options):
+        fitting_types = options['fitting_types'] or getattr(settings, 'FITTING_CLOSURE_TYPES', ())
+        for fitting_type in fitting_types:
+            count = closure.rebuild(fitting_type)
+            self.stdout.write('fitting_type %s: %s closure records'%(fitting_type, count))
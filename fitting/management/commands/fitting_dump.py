@@ -0,0 +1,17 @@
+"""Write the fittings of a fitting_type to a compact snapshot file"""
+from django.core.management.base import BaseCommand
+from fitting import snapshot
+
+class Command(BaseCommand):
+    help = 'Dump the fittings of a fitting_type as a columnar snapshot (see fitting.snapshot)'
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='snapshot file to write')
+        parser.add_argument('--fitting-type', type=int, default=None)
+        parser.add_argument('--chunk-size', type=int, default=10000)
+    def handle(self, *args, **options):
+        dumped = snapshot.dump(
+            options['fitting_type'], options['path'], chunk_size=options['chunk_size'],
+        )
+        self.stdout.write('Wrote %s fittings of fitting_type %s to %s'%(
+            len(dumped), dumped.fitting_type, options['path'],
+        ))
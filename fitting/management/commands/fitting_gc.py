@@ -0,0 +1,26 @@
+"""Delete fittings whose source or sink no longer exists"""
+from django.core.management.base import BaseCommand
+from fitting import orphans
+
+class Command(BaseCommand):
+    help = 'Find and delete orphaned fittings (whose source or sink record is gone)'
+    def add_arguments(self, parser):
+        parser.add_argument('--fitting-type', type=int, default=None,
+            help='only sweep this fitting_type (default all)')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+            help='report the orphans without deleting them')
+    def handle(self, *args, **options):
+        verb = 'found' if options['dry_run'] else 'deleted'
+        def progress(fitting_type, end, contenttype_id, count):
+            if options['verbosity'] > 1:
+                self.stdout.write('fitting_type %s %s content type %s: %s %s'%(
+                    fitting_type, end, contenttype_id, verb, count,
+                ))
+        total = orphans.collect_orphans(
+            fitting_type=options['fitting_type'],
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'],
+            progress=progress,
+        )
+        self.stdout.write('%s orphaned fittings %s'%(total, verb))
@@ -0,0 +1,33 @@
+"""Create fittings from a compact snapshot file"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from fitting import snapshot
+
+class Command(BaseCommand):
+    help = 'Load the fittings of a snapshot written by fitting_dump'
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='snapshot file to read')
+        parser.add_argument('--fitting-type', type=int, default=None,
+            help='load as this fitting_type (default the dumped one)')
+        parser.add_argument('--replace', action='store_true',
+            help='delete the fittings of the fitting_type which are not in the snapshot')
+        parser.add_argument('--batch-size', type=int, default=5000)
+    def handle(self, *args, **options):
+        try:
+            loaded = snapshot.load(options['path'], mmap=True)
+        except (OSError, snapshot.SnapshotError) as err:
+            raise CommandError(str(err))
+        try:
+            count = snapshot.restore(
+                loaded, 
+                fitting_type=options['fitting_type'], 
+                replace=options['replace'], 
+                batch_size=options['batch_size'],
+            )
+        except ContentType.DoesNotExist:
+            raise CommandError('Snapshot references content types missing here: %s'%(
+                loaded.content_types,
+            ))
+        self.stdout.write('Loaded %s fittings into fitting_type %s'%(
+            count, options['fitting_type'] or loaded.fitting_type,
+        ))
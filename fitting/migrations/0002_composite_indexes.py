@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Replace the single-column indexes with composite ones for the real access paths"""
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('fitting', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fitting',
+            index=models.Index(fields=['fitting_type', 'sink_type', 'sink_id', 'source_type', 'source_id'], name='fitting_sink_lookup'),
+        ),
+        migrations.AddIndex(
+            model_name='fitting',
+            index=models.Index(fields=['source_type', 'source_id'], name='fitting_source_node'),
+        ),
+        migrations.AddIndex(
+            model_name='fitting',
+            index=models.Index(fields=['sink_type', 'sink_id'], name='fitting_sink_node'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fitting',
+            unique_together=set([('fitting_type', 'source_type', 'source_id', 'sink_type', 'sink_id')]),
+        ),
+        migrations.AlterField(
+            model_name='fitting',
+            name='fitting_type',
+            field=models.IntegerField(default=1, verbose_name='Pipe Type'),
+        ),
+        migrations.AlterField(
+            model_name='fitting',
+            name='source_type',
+            field=models.ForeignKey(db_index=False, related_name='fitting_source_types', to='contenttypes.ContentType', on_delete=models.CASCADE),
+        ),
+        migrations.AlterField(
+            model_name='fitting',
+            name='source_id',
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='fitting',
+            name='sink_type',
+            field=models.ForeignKey(db_index=False, related_name='fitting_sink_types', to='contenttypes.ContentType', on_delete=models.CASCADE),
+        ),
+        migrations.AlterField(
+            model_name='fitting',
+            name='sink_id',
+            field=models.PositiveIntegerField(),
+        ),
+    ]
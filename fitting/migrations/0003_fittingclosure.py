@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('fitting', '0002_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FittingClosure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('fitting_type', models.IntegerField(default=1, verbose_name='Pipe Type')),
+                ('ancestor_id', models.PositiveIntegerField()),
+                ('descendant_id', models.PositiveIntegerField()),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor_type', models.ForeignKey(db_index=False, related_name='+', to='contenttypes.ContentType', on_delete=models.CASCADE)),
+                ('descendant_type', models.ForeignKey(db_index=False, related_name='+', to='contenttypes.ContentType', on_delete=models.CASCADE)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['fitting_type', 'descendant_type', 'descendant_id', 'ancestor_type', 'ancestor_id'], name='fitting_closure_ancestors')],
+                'unique_together': set([('fitting_type', 'ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id')]),
+            },
+        ),
+    ]
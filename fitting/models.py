@@ -1,12 +1,154 @@
-from django.db import models, transaction
+from django.db import models, transaction, connections
+from django.db.models import functions
 from django.contrib.contenttypes.models import ContentType
-import logging, contextlib, functools
+from asgiref.sync import sync_to_async
+import logging, contextlib, contextvars, functools, bisect
+from array import array
 log = logging.getLogger(__name__)
 try:
     from django.contrib.contenttypes import fields as generic, models as ct_models
 except ImportError:
     from django.contrib.contenttypes import generic, models as ct_models
 
+def node_key(instance):
+    """Get the (content_type_id, pk) key used to identify instance in a graph"""
+    if isinstance(instance, tuple):
+        return instance
+    return (ContentType.objects.get_for_model(instance).id, instance.pk)
+
+def node_keys(instances):
+    """Get node_key() for each of instances, resolving content types once per model"""
+    cts = {}
+    keys = []
+    for instance in instances:
+        if isinstance(instance, tuple):
+            keys.append(instance)
+            continue
+        ct_id = cts.get(instance.__class__)
+        if ct_id is None:
+            ct_id = cts[instance.__class__] = ContentType.objects.get_for_model(instance).id
+        keys.append((ct_id, instance.pk))
+    return keys
+
+class Hydrator(object):
+    """Loads the records for (content_type_id,pk) keys
+    
+    Performs one query per content type (per chunk_size distinct pks),
+    honouring hints declared on the record's model:
+    
+        default_prefetch -- prefetch_related() lookups
+        default_select_related -- select_related() lookups
+        default_only -- only() fields
+        default_defer -- defer() fields
+    
+    Override queryset() to customize the loading, and install the 
+    result as Fitting.hydrator (or pass it as hydrator=).
+    """
+    chunk_size = 500
+    def __init__(self, chunk_size=None):
+        if chunk_size:
+            self.chunk_size = chunk_size
+    def queryset(self, model_cls):
+        """Get the base queryset used to load records of model_cls"""
+        query = model_cls.objects.all()
+        if getattr(model_cls,'default_select_related',None):
+            query = query.select_related( *model_cls.default_select_related )
+        if getattr(model_cls,'default_only',None):
+            query = query.only( *model_cls.default_only )
+        if getattr(model_cls,'default_defer',None):
+            query = query.defer( *model_cls.default_defer )
+        if getattr(model_cls,'default_prefetch',None):
+            query = query.prefetch_related( *model_cls.default_prefetch )
+        return query
+    def load(self, keys):
+        """Get {(content_type_id,pk): instance} for keys"""
+        type_map = {}
+        for (contenttype_id, id) in keys:
+            type_map.setdefault(contenttype_id, set()).add(id)
+        object_map = {}
+        for (contenttype_id,ids) in type_map.items():
+            try:
+                # get_for_id is cached, so repeated hydration is cheap
+                model_cls = ct_models.ContentType.objects.get_for_id(contenttype_id).model_class()
+            except ct_models.ContentType.DoesNotExist:
+                model_cls = None
+            if model_cls is None:
+                log.warning("Fitting references a deleted content-type")
+                continue
+            query = self.queryset(model_cls)
+            ids = sorted(ids)
+            for i in range(0,len(ids),self.chunk_size):
+                for target in query.filter(pk__in = ids[i:i+self.chunk_size]):
+                    object_map[(contenttype_id,target.pk)] = target 
+        return object_map
+
+class FittingManager(models.Manager):
+    """Manager providing bulk edge manipulations for Fittings"""
+    def bulk_pipe(self, edges, fitting_type=None, batch_size=None):
+        """Create fittings for (source,sink) edges in bulk
+        
+        edges -- iterable of (source,sink) where each is a model instance
+            or a (content_type_id,pk) key
+        
+        Edges which already exist are ignored (via the unique_together
+        constraint), returns the (unsaved) Fitting instances created
+        """
+        fitting_type = fitting_type or self.model.DEFAULT_FITTING_TYPE
+        edges = list(edges)
+        sources = node_keys([source for (source,sink) in edges])
+        sinks = node_keys([sink for (source,sink) in edges])
+        fittings = [
+            self.model(
+                fitting_type = fitting_type, 
+                source_type_id = source_type_id, 
+                source_id = source_id, 
+                sink_type_id = sink_type_id, 
+                sink_id = sink_id, 
+            )
+            for ((source_type_id,source_id),(sink_type_id,sink_id)) in zip(sources,sinks)
+        ]
+        if fittings:
+            with stats.measured('bulk_pipe', fitting_type, using=self.db, edges=len(fittings)):
+                self.bulk_create(fittings, batch_size=batch_size, ignore_conflicts=True)
+            _fittings_changed(fitting_type, added=edges)
+        return fittings
+    def pipe_many(self, source, sinks, clear=True, fitting_type=None):
+        """Pipe source into each of sinks in a single transaction
+        
+        clear -- if True, delete all current outgoing pipes of source
+        """
+        fitting_type = fitting_type or self.model.DEFAULT_FITTING_TYPE
+        source_type_id, source_id = node_key(source)
+        with transaction.atomic(using=self.db):
+            if clear and self.filter(
+                source_type_id=source_type_id, 
+                source_id=source_id,
+                fitting_type=fitting_type,
+            ).delete()[0]:
+                _fittings_changed(fitting_type, cleared_sinks=[source])
+            return self.bulk_pipe(
+                [(source,sink) for sink in sinks], 
+                fitting_type=fitting_type,
+            )
+    def pipe_from_many(self, sink, sources, clear=True, fitting_type=None):
+        """Pipe each of sources into sink in a single transaction
+        
+        clear -- if True, delete all current incoming pipes of sink
+        """
+        fitting_type = fitting_type or self.model.DEFAULT_FITTING_TYPE
+        sink_type_id, sink_id = node_key(sink)
+        with transaction.atomic(using=self.db):
+            if clear and self.filter(
+                sink_type_id=sink_type_id, 
+                sink_id=sink_id,
+                fitting_type=fitting_type,
+            ).delete()[0]:
+                _fittings_changed(fitting_type, cleared_sources=[sink])
+            return self.bulk_pipe(
+                [(source,sink) for source in sources], 
+                fitting_type=fitting_type,
+            )
+
 class Fitting(models.Model):
     """A directional fitting in a pipeline
     
@@ -20,25 +162,37 @@ class Fitting(models.Model):
     the whole pipe-space into memory to optimize operations.
     """
     class Meta:
+        # indexes match the real access paths, the unique constraint 
+        # covers sinks() (and mapping()), fitting_sink_lookup covers 
+        # sources(), the node indexes cover unlinking deleted records
+        # whatever their fitting_type
         unique_together = [
-            ('fitting_type','source_id','source_type', 'sink_id', 'sink_type'), 
+            ('fitting_type','source_type','source_id', 'sink_type', 'sink_id'), 
+        ]
+        indexes = [
+            models.Index(
+                fields=['fitting_type','sink_type','sink_id','source_type','source_id'],
+                name='fitting_sink_lookup',
+            ),
+            models.Index(fields=['source_type','source_id'], name='fitting_source_node'),
+            models.Index(fields=['sink_type','sink_id'], name='fitting_sink_node'),
         ]
     DEFAULT_FITTING_TYPE = 1
+    objects = FittingManager()
+    hydrator = Hydrator()
     fitting_type = models.IntegerField(
         verbose_name='Pipe Type', 
         default = DEFAULT_FITTING_TYPE,
-        db_index=True,
     )
     source_type = models.ForeignKey(
         ContentType,
         null=False,blank=False,
-        db_index=True,
+        db_index=False,
         related_name="fitting_source_types",
         on_delete=models.CASCADE,
     )
     source_id = models.PositiveIntegerField(
         null=False,blank=False,
-        db_index=True,
     )
     source = generic.GenericForeignKey(
         'source_type', 'source_id', 
@@ -47,118 +201,528 @@ class Fitting(models.Model):
         ContentType,
         null=False,
         blank=False,
-        db_index=True,
+        db_index=False,
         related_name="fitting_sink_types",
         on_delete=models.CASCADE,
     )
     sink_id = models.PositiveIntegerField(
         null=False,blank=False,
-        db_index=True,
     )
     sink = generic.GenericForeignKey(
         'sink_type', 'sink_id', 
     )
     def __json__(self):
+        # get_for_id is cached, avoiding two queries per fitting
+        source_type = ContentType.objects.get_for_id(self.source_type_id)
+        sink_type = ContentType.objects.get_for_id(self.sink_type_id)
         return {
             'pk':self.pk, 
             'type': self.__class__.__name__, 
             'fitting_type':self.fitting_type, 
             'source': {
-                'app': self.source_type.app_label, 
-                'type': self.source_type.model, 
+                'app': source_type.app_label, 
+                'type': source_type.model, 
                 'pk': self.source_id, 
             }, 
             'sink': {
-                'app': self.sink_type.app_label, 
-                'type': self.sink_type.model, 
+                'app': sink_type.app_label, 
+                'type': sink_type.model, 
                 'pk': self.sink_id, 
             }
         }
     @classmethod
     def sources(cls, instance,  fitting_type=None):
-        """Retrieve fittings for all currently fitted sources"""
-        ct = ContentType.objects.get_for_model(instance)
+        """Retrieve fittings for all currently fitted sources
+        
+        instance -- model instance or (content_type_id,pk) key
+        """
+        ct_id, pk = node_key(instance)
         return cls.objects.filter(
-            sink_type=ct,
-            sink_id = instance.pk, 
+            sink_type_id=ct_id,
+            sink_id = pk, 
             fitting_type=fitting_type or cls.DEFAULT_FITTING_TYPE 
         ).order_by('source_type__id', 'source_id')
     @classmethod
     def sinks(cls, instance, fitting_type=None):
-        """Retrieve fittings for all current fitted sinks"""
-        ct = ContentType.objects.get_for_model(instance)
+        """Retrieve fittings for all current fitted sinks
+        
+        instance -- model instance or (content_type_id,pk) key
+        """
+        ct_id, pk = node_key(instance)
         return cls.objects.filter(
-            source_type=ct,
-            source_id = instance.pk, 
+            source_type_id=ct_id,
+            source_id = pk, 
             fitting_type=fitting_type or cls.DEFAULT_FITTING_TYPE 
         ).order_by('sink_type__id', 'sink_id' )
     @classmethod 
-    def mapping(cls, fitting_type=None):
+    def mapping(cls, fitting_type=None, content_types=None, hydrator=None):
         """Get an in-memory source:[sinks] mapping
         
         Note: this does a lot of internal book-keeping to minimize the 
         number of queries performed by loading all targets of a particular
-        type at once, then doing a source:sink mapping from that set.
-        """
-        records = cls.objects.filter(
-            fitting_type=fitting_type or cls.DEFAULT_FITTING_TYPE
-        ).values( 'sink_type_id','sink_id', 'source_type_id','source_id' )
-        type_map = {}
-        for record in records:
-            type_map.setdefault( record['sink_type_id'],[]).append(record['sink_id'])
-            type_map.setdefault( record['source_type_id'],[]).append(record['source_id'])
-        cts = dict([(ct.id,ct) for ct in ct_models.ContentType.objects.filter(
-            id__in = type_map.keys()
-        ).all()])
+        type at once (see hydrate()), then doing a source:sink mapping 
+        from that set.
         
-        object_map = {}
-        for (contenttype_id,ids) in type_map.items():
-            ct = cts.get(contenttype_id)
-            if not ct:
-                log.warn("Fitting references a deleted content-type")
-                continue
-            model_cls = ct.model_class()
-            query = model_cls.objects.filter(
-                pk__in = ids 
-            )
-            if getattr(model_cls,'default_prefetch',None):
-                query = query.prefetch_related( *model_cls.default_prefetch )
-            for target in list(query.all()):
-                object_map[(contenttype_id,target.id)] = target 
+        content_types -- if not None, only load records of these content 
+            types (models or content type ids), fittings to or from 
+            other records are omitted
+        hydrator -- Hydrator used to load the records
+        """
+        fitting_type = fitting_type or cls.DEFAULT_FITTING_TYPE
+        with stats.measured('mapping', fitting_type) as metrics:
+            records = list(cls.objects.filter(
+                fitting_type=fitting_type
+            ).values_list( 'source_type_id','source_id', 'sink_type_id','sink_id' ))
+            keys = set()
+            for (source_type_id,source_id,sink_type_id,sink_id) in records:
+                keys.add((source_type_id,source_id))
+                keys.add((sink_type_id,sink_id))
+            object_map = cls.hydrate(keys, content_types=content_types, hydrator=hydrator)
+            metrics.update(edges=len(records), nodes=len(keys))
         
         final_mapping = {}
-        for record in records:
-            source = object_map.get((record['source_type_id'],record['source_id']))
-            sink = object_map.get((record['sink_type_id'],record['sink_id']))
+        for (source_type_id,source_id,sink_type_id,sink_id) in records:
+            source = object_map.get((source_type_id,source_id))
+            sink = object_map.get((sink_type_id,sink_id))
             if source and sink:
                 final_mapping.setdefault( source,[]).append( sink )
         return final_mapping
 
-class PipeMapping( object ):
-    """Cache for in-memory hierarchic structure handling"""
-    def __init__(self,mapping=None,fitting_type=None):
+    @classmethod
+    def sync(cls, fitting_type, edges, batch_size=500):
+        """Make the fittings of fitting_type match the given edges
+        
+        edges -- iterable of (source,sink) where each is a model instance
+            or a (content_type_id,pk) key
+        
+        Reads the current fittings once, then only inserts the missing 
+        and deletes the unwanted fittings (in batches of batch_size), 
+        all within a single transaction.
+        
+        returns (added,removed) counts
+        """
+        fitting_type = fitting_type or cls.DEFAULT_FITTING_TYPE
+        edges = list(edges)
+        desired = set(zip(
+            node_keys([source for (source,sink) in edges]),
+            node_keys([sink for (source,sink) in edges]),
+        ))
+        with stats.measured('sync', fitting_type) as metrics, transaction.atomic(using=cls.objects.db):
+            current = {}
+            for (pk,source_type_id,source_id,sink_type_id,sink_id) in cls.objects.filter(
+                fitting_type=fitting_type
+            ).values_list('pk','source_type_id','source_id','sink_type_id','sink_id'):
+                current[((source_type_id,source_id),(sink_type_id,sink_id))] = pk
+            removed = sorted([edge for edge in current if edge not in desired])
+            added = sorted([edge for edge in desired if edge not in current])
+            stale = [current[edge] for edge in removed]
+            for i in range(0,len(stale),batch_size):
+                cls.objects.filter(pk__in=stale[i:i+batch_size]).delete()
+            if removed:
+                _fittings_changed(fitting_type, removed=removed)
+            cls.objects.bulk_pipe(added, fitting_type=fitting_type, batch_size=batch_size)
+            if added or removed:
+                # the edges were changed as keys, the instances passed in may
+                # still hold prefetched results
+                _forget_prefetched([node for edge in edges for node in edge], fitting_type)
+            metrics.update(added=len(added), removed=len(removed))
+        return len(added), len(removed)
+
+    @classmethod
+    def unlink(cls, model, pks, batch_size=500):
+        """Delete all fittings to or from the given pks of model
+        
+        Runs one delete query per batch_size pks, regardless of 
+        fitting_type (plus one query per batch reading the fitting_types 
+        affected, when the closure table is enabled).
+        
+        returns the number of fittings deleted
+        """
+        ct = ContentType.objects.get_for_model(model)
+        pks = list(pks)
+        count = 0
+        # None (all fitting_types) unless the closure table needs narrowing down
+        changed = set() if closure.fitting_types() else None
+        with stats.measured('unlink', None, model=model, records=len(pks)) as metrics:
+            for i in range(0,len(pks),batch_size):
+                batch = pks[i:i+batch_size]
+                query = cls.objects.filter(
+                    models.Q(source_type=ct, source_id__in=batch) |
+                    models.Q(sink_type=ct, sink_id__in=batch)
+                )
+                if changed is not None:
+                    changed.update(query.order_by().values_list('fitting_type', flat=True).distinct())
+                count += query.delete()[0]
+            metrics['fittings'] = count
+        if count:
+            keys = [(ct.id,pk) for pk in pks]
+            for fitting_type in (sorted(changed) if changed is not None else [None]):
+                _fittings_changed(fitting_type, cleared_sinks=keys, cleared_sources=keys)
+        return count
+
+    @classmethod
+    def reachable(cls, instance, fitting_type=None, direction='down', max_depth=None):
+        """Get the (content_type_id,pk) keys reachable from instance
+        
+        Uses a single recursive (WITH RECURSIVE) query to walk the 
+        graph, so the cost is one round trip regardless of depth.
+        
+        instance -- model instance or (content_type_id,pk) key
+        direction -- 'down' to follow sinks, 'up' to follow sources
+        max_depth -- if not None, only follow this many fittings
+        
+        returns [(content_type_id,pk),...] ordered by depth (when 
+        max_depth is given) then content type and pk
+        """
+        if direction == 'down':
+            near, far = 'source', 'sink'
+        elif direction == 'up':
+            near, far = 'sink', 'source'
+        else:
+            raise ValueError("Unrecognized direction: %r"%(direction,))
+        ct_id, pk = node_key(instance)
+        if pk is None:
+            return []
+        fitting_type = fitting_type or cls.DEFAULT_FITTING_TYPE
+        connection = connections[cls.objects.db]
+        qn = connection.ops.quote_name
+        names = {
+            'table': qn(cls._meta.db_table),
+            'fitting_type': qn('fitting_type'),
+            'near_type': qn('%s_type_id'%(near,)),
+            'near_id': qn('%s_id'%(near,)),
+            'far_type': qn('%s_type_id'%(far,)),
+            'far_id': qn('%s_id'%(far,)),
+        }
+        if max_depth is None:
+            # without a depth column UNION discards revisited nodes,
+            # which is what terminates the recursion on cycles
+            sql = (
+                'WITH RECURSIVE reach(node_type, node_id) AS ('
+                ' SELECT {far_type}, {far_id} FROM {table}'
+                ' WHERE {fitting_type} = %s AND {near_type} = %s AND {near_id} = %s'
+                ' UNION'
+                ' SELECT f.{far_type}, f.{far_id} FROM {table} f'
+                ' INNER JOIN reach r ON f.{near_type} = r.node_type AND f.{near_id} = r.node_id'
+                ' WHERE f.{fitting_type} = %s'
+                ') SELECT node_type, node_id FROM reach'
+                ' ORDER BY node_type, node_id'
+            ).format(**names)
+            params = [fitting_type, ct_id, pk, fitting_type]
+        else:
+            if max_depth < 1:
+                return []
+            sql = (
+                'WITH RECURSIVE reach(node_type, node_id, depth) AS ('
+                ' SELECT {far_type}, {far_id}, 1 FROM {table}'
+                ' WHERE {fitting_type} = %s AND {near_type} = %s AND {near_id} = %s'
+                ' UNION'
+                ' SELECT f.{far_type}, f.{far_id}, r.depth + 1 FROM {table} f'
+                ' INNER JOIN reach r ON f.{near_type} = r.node_type AND f.{near_id} = r.node_id'
+                ' WHERE f.{fitting_type} = %s AND r.depth < %s'
+                ') SELECT node_type, node_id, MIN(depth) FROM reach'
+                ' GROUP BY node_type, node_id'
+                ' ORDER BY 3, node_type, node_id'
+            ).format(**names)
+            params = [fitting_type, ct_id, pk, fitting_type, max_depth]
+        with stats.measured('reachable', fitting_type, direction=direction) as metrics:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                result = [(row[0], row[1]) for row in cursor.fetchall()]
+            metrics['nodes'] = len(result)
+        return result
+
+    @classmethod
+    def hydrate(cls, keys, content_types=None, hydrator=None):
+        """Load instances for (content_type_id,pk) keys
+        
+        content_types -- if not None, only load keys of these content 
+            types (models or content type ids)
+        hydrator -- Hydrator to use, default Fitting.hydrator
+        
+        returns {(content_type_id,pk): instance}, keys whose record 
+        (or content type) no longer exists are omitted
+        """
+        if content_types is not None:
+            wanted = set([
+                ct if isinstance(ct, int) else ContentType.objects.get_for_model(ct).id
+                for ct in content_types
+            ])
+            keys = [key for key in keys if key[0] in wanted]
+        with stats.measured('hydrate', keys=len(keys)) as metrics:
+            object_map = (hydrator or cls.hydrator).load(keys)
+            metrics['records'] = len(object_map)
+        return object_map
+
+class FittingClosure(models.Model):
+    """Transitive closure of the fittings of a fitting_type
+    
+    One record for each (ancestor,descendant) pair connected by a path
+    of fittings, with the length of the shortest such path. Only 
+    maintained for the fitting_types in settings.FITTING_CLOSURE_TYPES,
+    see fitting.closure.
+    """
+    class Meta:
+        unique_together = [
+            ('fitting_type','ancestor_type','ancestor_id','descendant_type','descendant_id'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['fitting_type','descendant_type','descendant_id','ancestor_type','ancestor_id'],
+                name='fitting_closure_ancestors',
+            ),
+        ]
+    fitting_type = models.IntegerField(
+        verbose_name='Pipe Type', 
+        default = Fitting.DEFAULT_FITTING_TYPE,
+    )
+    ancestor_type = models.ForeignKey(
+        ContentType,
+        null=False,blank=False,
+        db_index=False,
+        related_name="+",
+        on_delete=models.CASCADE,
+    )
+    ancestor_id = models.PositiveIntegerField(
+        null=False,blank=False,
+    )
+    descendant_type = models.ForeignKey(
+        ContentType,
+        null=False,blank=False,
+        db_index=False,
+        related_name="+",
+        on_delete=models.CASCADE,
+    )
+    descendant_id = models.PositiveIntegerField(
+        null=False,blank=False,
+    )
+    depth = models.PositiveIntegerField(
+        null=False,blank=False,
+    )
+
+class BasePipeMapping( object ):
+    """Common operations for in-memory graphs keyed by (content_type_id,pk)
+    
+    Subclasses provide _neighbour_keys(direction,key) and _editable(direction,key),
+    where direction is 'forward' (sinks) or 'reverse' (sources), and 
+    _editable returns the mutable set of neighbour keys.
+    
+    Edge additions/removals are O(degree) so that the mutation APIs 
+    can keep an active cache() mapping up to date.
+    """
+    def __init__(self,fitting_type=None):
         self.fitting_type = fitting_type or Fitting.DEFAULT_FITTING_TYPE
-        if mapping is None:
-            mapping = Fitting.mapping(fitting_type=self.fitting_type)
-        self.mapping = mapping
-        self.reverse = {}
-        for source,sinks in mapping.items():
-            for sink in sinks:
-                self.reverse.setdefault(sink,[]).append(source)
+        self._objects = {}
+    loaded = True
+    def _instances(self, keys):
+        missing = [key for key in keys if key not in self._objects]
+        if missing:
+            self._objects.update(Fitting.hydrate(missing))
+        return [self._objects[key] for key in keys if key in self._objects]
+    def _remember(self, record):
+        """Get the key for record, tracking record as its instance"""
+        key = node_key(record)
+        if not isinstance(record, tuple):
+            self._objects[key] = record
+        return key
+    def source_keys(self,record):
+        """Get (content_type_id,pk) keys of record's sources without loading them"""
+        return self._neighbour_keys('reverse', node_key(record))
+    def sink_keys(self,record):
+        """Get (content_type_id,pk) keys of record's sinks without loading them"""
+        return self._neighbour_keys('forward', node_key(record))
     def sources(self,record):
-        return self.reverse.get(record,[]) if record.id else []
+        return self._instances(self.source_keys(record)) if record.pk else []
     def sinks(self,record):
-        return self.mapping.get(record,[]) if record.id else []
+        return self._instances(self.sink_keys(record)) if record.pk else []
     def replace(self,record):
         """Replace the given record in our mappings"""
-        for source in [self.mapping,self.reverse]:
-            for key,value in source.items():
-                if key.id == record.id and isinstance(record,key.__class__):
-                    del source[key]
-                    source[record] = value
-                for i,v in enumerate(value):
-                    if v.id == record.id and isinstance(record,v.__class__):
-                        value[i] = record
+        self._objects[node_key(record)] = record
+    def add_edge(self,source,sink):
+        """Record a fitting from source to sink"""
+        source, sink = self._remember(source), self._remember(sink)
+        self._editable('forward', source).add(sink)
+        self._editable('reverse', sink).add(source)
+    def remove_edge(self,source,sink):
+        """Forget the fitting from source to sink"""
+        source, sink = node_key(source), node_key(sink)
+        self._editable('forward', source).discard(sink)
+        self._editable('reverse', sink).discard(source)
+    def clear_sinks(self,record):
+        """Forget all fittings from record"""
+        key = node_key(record)
+        for sink in self._neighbour_keys('forward', key):
+            self.remove_edge(key, sink)
+    def clear_sources(self,record):
+        """Forget all fittings to record"""
+        key = node_key(record)
+        for source in self._neighbour_keys('reverse', key):
+            self.remove_edge(source, key)
+    def remove_node(self,record):
+        """Forget record and all of its fittings"""
+        self.clear_sinks(record)
+        self.clear_sources(record)
+        self._objects.pop(node_key(record), None)
+
+class PipeMapping( BasePipeMapping ):
+    """Cache for in-memory hierarchic structure handling
+    
+    Nodes are indexed by (content_type_id,pk) with set-based adjacency
+    """
+    def __init__(self,mapping=None,fitting_type=None,content_types=None):
+        super(PipeMapping,self).__init__(fitting_type=fitting_type)
+        if mapping is None:
+            mapping = Fitting.mapping(
+                fitting_type=self.fitting_type, content_types=content_types,
+            )
+        self.forward = {}
+        self.reverse = {}
+        for source,sinks in mapping.items():
+            for sink in sinks:
+                self.add_edge(source, sink)
+    @property
+    def mapping(self):
+        """source:[sinks] mapping of the (loaded) instances"""
+        result = {}
+        for source,sinks in self.forward.items():
+            if source in self._objects:
+                targets = [self._objects[sink] for sink in sorted(sinks) if sink in self._objects]
+                if targets:
+                    result[self._objects[source]] = targets
+        return result
+    def _neighbour_keys(self, direction, key):
+        return sorted(getattr(self,direction).get(key, ()))
+    def _editable(self, direction, key):
+        return getattr(self,direction).setdefault(key, set())
+    def nodes(self):
+        """Iterate over the (content_type_id,pk) keys of all fitted nodes"""
+        return iter(sorted(
+            set([key for (key,value) in self.forward.items() if value]).union(
+                [key for (key,value) in self.reverse.items() if value]
+            )
+        ))
+
+def _pack(key):
+    """Pack a (content_type_id,pk) key into a single 64-bit integer"""
+    return (key[0] << 32) | key[1]
+def _unpack(value):
+    return (value >> 32, value & 0xffffffff)
+def _adjacency(count, rows, columns):
+    """Build CSR-style (offsets,indices) arrays for the given edges
+    
+    The neighbours of node i are indices[offsets[i]:offsets[i+1]],
+    sorted, so that neighbour order matches node-key order.
+    """
+    offsets = array('q', [0]) * (count + 1)
+    for row in rows:
+        offsets[row+1] += 1
+    for i in range(count):
+        offsets[i+1] += offsets[i]
+    indices = array('q', [column for (row, column) in sorted(zip(rows, columns))])
+    return offsets, indices
+
+class CompactPipeMapping( BasePipeMapping ):
+    """ID-only cache for in-memory hierarchic structure handling
+    
+    Rather than loading every fitted instance up-front (as PipeMapping
+    does), this holds only packed (content_type_id,pk) node keys and 
+    CSR-style forward and reverse adjacency arrays. Instances are 
+    loaded (one query per content type) only when sources()/sinks() 
+    actually return them, and the edges themselves are only loaded 
+    on first use.
+    
+    Edits copy the affected node's neighbours into a per-node set which
+    then overrides the (immutable) arrays for that node.
+    
+    edges -- optional iterable of (source_type_id,source_id,sink_type_id,sink_id)
+        if not specified, the edges are loaded from the database
+    """
+    def __init__(self,edges=None,fitting_type=None):
+        super(CompactPipeMapping,self).__init__(fitting_type=fitting_type)
+        self._edges = edges
+        self._nodes = None
+        self._overrides = {'forward':{}, 'reverse':{}}
+    @classmethod
+    def from_arrays(cls, nodes, forward, reverse, fitting_type=None):
+        """Create a mapping from already-built node and adjacency arrays"""
+        mapping = cls(fitting_type=fitting_type)
+        mapping._nodes = nodes
+        mapping.forward = forward
+        mapping.reverse = reverse
+        return mapping
+    def arrays(self):
+        """Get the (nodes,forward,reverse) arrays, ignoring any edits"""
+        self._load()
+        return self._nodes, self.forward, self.reverse
+    def copy(self):
+        """Get an unedited mapping sharing our (read-only) arrays"""
+        return self.from_arrays(*self.arrays(), fitting_type=self.fitting_type)
+    def _load(self):
+        if self._nodes is not None:
+            return
+        with stats.measured('compact_mapping', self.fitting_type) as metrics:
+            self._load_edges()
+            metrics.update(edges=len(self.forward[1]), nodes=len(self._nodes))
+    def _load_edges(self):
+        edges = self._edges
+        if edges is None:
+            edges = Fitting.objects.filter(
+                fitting_type=self.fitting_type
+            ).values_list('source_type_id','source_id','sink_type_id','sink_id')
+        sources, sinks = array('q'), array('q')
+        for (source_type_id, source_id, sink_type_id, sink_id) in edges:
+            sources.append(_pack((source_type_id, source_id)))
+            sinks.append(_pack((sink_type_id, sink_id)))
+        nodes = array('q', sorted(set(sources).union(sinks)))
+        index = dict([(node,i) for (i,node) in enumerate(nodes)])
+        sources = [index[node] for node in sources]
+        sinks = [index[node] for node in sinks]
+        self.forward = _adjacency(len(nodes), sources, sinks)
+        self.reverse = _adjacency(len(nodes), sinks, sources)
+        self._nodes = nodes
+        self._edges = None
+    @property
+    def loaded(self):
+        """Have the edges been loaded (so that no queries are needed)?"""
+        return self._nodes is not None
+    def _position(self, key):
+        packed = _pack(key)
+        i = bisect.bisect_left(self._nodes, packed)
+        if i < len(self._nodes) and self._nodes[i] == packed:
+            return i
+        return None
+    def _stored_keys(self, direction, key):
+        """Get neighbour keys from the adjacency arrays"""
+        self._load()
+        i = self._position(key)
+        if i is None:
+            return []
+        offsets, indices = getattr(self, direction)
+        return [
+            _unpack(self._nodes[j]) 
+            for j in indices[offsets[i]:offsets[i+1]]
+        ]
+    def _neighbour_keys(self, direction, key):
+        override = self._overrides[direction].get(key)
+        if override is not None:
+            return sorted(override)
+        return self._stored_keys(direction, key)
+    def _editable(self, direction, key):
+        overrides = self._overrides[direction]
+        if key not in overrides:
+            overrides[key] = set(self._stored_keys(direction, key))
+        return overrides[key]
+    def nodes(self):
+        """Iterate over the (content_type_id,pk) keys of all fitted nodes"""
+        self._load()
+        if not (self._overrides['forward'] or self._overrides['reverse']):
+            return (_unpack(node) for node in self._nodes)
+        return iter(sorted([
+            key for key in set(map(_unpack,self._nodes)).union(
+                self._overrides['forward'], self._overrides['reverse']
+            )
+            if self._neighbour_keys('forward',key) or self._neighbour_keys('reverse',key)
+        ]))
 
 def with_cache( *cache_args,**cache_named ):
     """Use a PipeMapping cache on PipeElement to speed up hierarchy-heavy operations
@@ -178,20 +742,140 @@ def with_cache( *cache_args,**cache_named ):
         return with_wrapper 
     return wrapper 
 
+# {fitting_type: mapping} for the cache() blocks active in the current context,
+# a ContextVar so that concurrent threads/asyncio tasks do not share caches
+_pipe_mappings = contextvars.ContextVar('fitting_pipe_mappings', default={})
+
+def active_mapping(fitting_type=None):
+    """Get the mapping cached for fitting_type in the current context (or None)"""
+    return _pipe_mappings.get().get(fitting_type or Fitting.DEFAULT_FITTING_TYPE)
+
+def _forget_prefetched(records, fitting_type):
+    """Drop the prefetch_fittings() results of the instances in records"""
+    for record in records:
+        if isinstance(record, PipeElement):
+            record._forget_prefetched(fitting_type)
+
+def _fittings_changed(fitting_type, added=(), removed=(), cleared_sinks=(), cleared_sources=()):
+    """Apply a change made through the mutation APIs to the active mappings
+    
+    fitting_type -- fitting_type changed, None for all fitting_types
+    added, removed -- (source,sink) edges of instances or keys
+    cleared_sinks, cleared_sources -- records which lost all sinks/sources
+    """
+    added, removed = list(added), list(removed)
+    _forget_prefetched(
+        [node for edge in added+removed for node in edge] + list(cleared_sinks) + list(cleared_sources), 
+        fitting_type,
+    )
+    shared.fittings_changed(fitting_type)
+    closure.fittings_changed(
+        fitting_type, 
+        added=added, removed=removed, 
+        cleared=list(cleared_sinks)+list(cleared_sources),
+    )
+    mappings = _pipe_mappings.get()
+    if not mappings:
+        return
+    if fitting_type is None:
+        targets = list(mappings.values())
+    else:
+        targets = [mappings[fitting_type]] if fitting_type in mappings else []
+    for mapping in targets:
+        for record in cleared_sinks:
+            mapping.clear_sinks(record)
+        for record in cleared_sources:
+            mapping.clear_sources(record)
+        for (source,sink) in removed:
+            mapping.remove_edge(source,sink)
+        for (source,sink) in added:
+            mapping.add_edge(source,sink)
+
+def _cache_factory(args, named):
+    """Get (fitting_type, factory creating the mapping) for cache() arguments"""
+    named = dict(named)
+    if named.pop('shared',False):
+        named.pop('lazy',None)
+        mapping_class, names = shared.shared_mapping, ('fitting_type',)
+    elif named.pop('lazy',False):
+        mapping_class, names = CompactPipeMapping, ('edges','fitting_type')
+    else:
+        mapping_class, names = PipeMapping, ('mapping','fitting_type','content_types')
+    # positional arguments differ between the factories, so pass keywords
+    if len(args) > len(names):
+        raise TypeError("cache() takes at most %s positional arguments for %s"%(
+            len(names), mapping_class.__name__,
+        ))
+    for (name, value) in zip(names, args):
+        if name in named:
+            raise TypeError("cache() got multiple values for %r"%(name,))
+        named[name] = value
+    fitting_type = named['fitting_type'] = named.get('fitting_type') or Fitting.DEFAULT_FITTING_TYPE
+    return fitting_type, functools.partial(mapping_class, **named)
+
+def _cache_used(mapping, fitting_type):
+    """Report whether a read found an active mapping (see fitting.stats)"""
+    if stats.enabled():
+        if mapping is None:
+            stats.report('cache_miss', fitting_type, active=sorted(_pipe_mappings.get()))
+        else:
+            stats.report('cache_hit', fitting_type)
+
 @contextlib.contextmanager
 def cache( *args, **named ):
-    if not PipeElement._pipe_mapping:
-        PipeElement._pipe_mapping = PipeMapping(*args,**named)
-        delete = True
-    else:
-        delete = False
-    yield 
-    if delete:
-        try:
-            PipeElement._pipe_mapping = None
-        except AttributeError:
-            pass
+    """Use a PipeMapping cache on PipeElement for the duration of the block
     
+    Arguments are passed to the PipeMapping, cache() blocks for 
+    different fitting_types can be nested to cache each of them, 
+    nesting a block for an already-cached fitting_type re-uses the
+    current mapping.
+    
+    lazy -- if True, use an id-only CompactPipeMapping which only loads 
+        instances as they are requested
+    shared -- if True, use a CompactPipeMapping loaded via the cross-process
+        cache (see fitting.shared), implies lazy
+    
+    yields the mapping in use
+    """
+    fitting_type, factory = _cache_factory(args, named)
+    current = _pipe_mappings.get()
+    if fitting_type in current:
+        yield current[fitting_type]
+        return
+    with stats.measured('cache_build', fitting_type) as metrics:
+        mapping = factory()
+        metrics['mapping'] = mapping.__class__.__name__
+    mappings = dict(current)
+    mappings[fitting_type] = mapping
+    token = _pipe_mappings.set(mappings)
+    try:
+        yield mapping
+    finally:
+        _pipe_mappings.reset(token)
+
+@contextlib.asynccontextmanager
+async def acache( *args, **named ):
+    """Async cache(), for use with the PipeElement a* methods
+    
+    The mapping is created (and, for lazy mappings, its edges loaded)
+    in a thread, so that its use within the block performs no 
+    synchronous queries.
+    """
+    fitting_type, factory = _cache_factory(args, named)
+    current = _pipe_mappings.get()
+    if fitting_type in current:
+        yield current[fitting_type]
+        return
+    mapping = await sync_to_async(factory)()
+    if not mapping.loaded:
+        await sync_to_async(mapping._load)()
+    mappings = dict(current)
+    mappings[fitting_type] = mapping
+    token = _pipe_mappings.set(mappings)
+    try:
+        yield mapping
+    finally:
+        _pipe_mappings.reset(token)
 
 class PipeElement(object):
     """Mix-in providing pipe-fitting manipulations
@@ -201,40 +885,74 @@ class PipeElement(object):
     is really just one type of pipe can thus ignore the 
     fitting_type arguments entirely.
     """
-    _pipe_mapping = None
     DEFAULT_FITTING_TYPE = Fitting.DEFAULT_FITTING_TYPE
     def _sources(self, fitting_type=None):
         return Fitting.sources(self, fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE)
     def sources(self, fitting_type=None):
         """Retrieve all currently fitted sources (the actual objects)"""
         fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE
-        if self._pipe_mapping and self._pipe_mapping.fitting_type == fitting_type:
-            return self._pipe_mapping.sources( self )
+        prefetched = self.__dict__.get('_prefetched_fittings')
+        if prefetched and (fitting_type,'sources') in prefetched:
+            return prefetched[(fitting_type,'sources')]
+        mapping = active_mapping(fitting_type)
+        if mapping is not None:
+            _cache_used(mapping, fitting_type)
+            return mapping.sources( self )
+        _cache_used(mapping, fitting_type)
         result = []
         for f in self._sources(fitting_type):
             try:
-                result.append( f.source )
+                target = f.source
             except AttributeError:
+                target = None
+            if target is not None:
+                result.append(target)
+            elif orphans.delete_on_read():
+                # dangling reference, see fitting.orphans
                 f.delete()
+                stats.report('orphan_delete', fitting_type)
         return result
     def _sinks(self, fitting_type=None):
         return Fitting.sinks(self, fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE)
     def sinks(self, fitting_type=None):
         """Retrieve all current fitted sinks (the actual objects)"""
         fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE
-        if self._pipe_mapping and self._pipe_mapping.fitting_type == fitting_type:
-            return self._pipe_mapping.sinks( self )
+        prefetched = self.__dict__.get('_prefetched_fittings')
+        if prefetched and (fitting_type,'sinks') in prefetched:
+            return prefetched[(fitting_type,'sinks')]
+        mapping = active_mapping(fitting_type)
+        if mapping is not None:
+            _cache_used(mapping, fitting_type)
+            return mapping.sinks( self )
+        _cache_used(mapping, fitting_type)
         result = []
         for f in self._sinks(fitting_type):
             try:
-                result.append(f.sink)
+                target = f.sink
             except AttributeError:
+                target = None
+            if target is not None:
+                result.append(target)
+            elif orphans.delete_on_read():
+                # dangling reference, see fitting.orphans
                 f.delete()
+                stats.report('orphan_delete', fitting_type)
         return result
+    def _forget_prefetched(self, fitting_type=None):
+        """Drop results stored by prefetch_fittings() for fitting_type"""
+        prefetched = self.__dict__.get('_prefetched_fittings')
+        if prefetched:
+            fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
+            prefetched.pop((fitting_type,'sources'), None)
+            prefetched.pop((fitting_type,'sinks'), None)
     def detach_sources(self, fitting_type=None):
-        self._sources(fitting_type=fitting_type).delete()
+        self._forget_prefetched(fitting_type)
+        if self._sources(fitting_type=fitting_type).delete()[0]:
+            _fittings_changed(fitting_type or self.DEFAULT_FITTING_TYPE, cleared_sources=[self])
     def detach_sinks(self, fitting_type=None):
-        self._sinks(fitting_type=fitting_type).delete()
+        self._forget_prefetched(fitting_type)
+        if self._sinks(fitting_type=fitting_type).delete()[0]:
+            _fittings_changed(fitting_type or self.DEFAULT_FITTING_TYPE, cleared_sinks=[self])
     def detach(self, fitting_type=None):
         self.detach_sources(fitting_type=fitting_type)
         self.detach_sinks(fitting_type=fitting_type)
@@ -245,65 +963,333 @@ class PipeElement(object):
         
         clear -- if True, delete all current outgoing pipes
         """
+        fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
         if clear:
-            self._sinks(fitting_type=fitting_type).delete()
-        return Fitting.objects.create(
+            self.detach_sinks(fitting_type=fitting_type)
+        fitting = Fitting(
             source = self, 
             sink = other, 
-            fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE, 
+            fitting_type=fitting_type, 
         )
+        # _fittings_changed() notifies the shared cache, see shared.bump_on_save
+        fitting._notified = True
+        fitting.save(force_insert=True, using=Fitting.objects.db)
+        self._forget_prefetched(fitting_type)
+        if isinstance(other, PipeElement):
+            other._forget_prefetched(fitting_type)
+        _fittings_changed(fitting_type, added=[(self,other)])
+        return fitting
     # alias
     pipe_into = pipe_to
+    def pipe_many(self, others, clear=True, fitting_type=None):
+        """Pipe this element into each of others with a single bulk insert
+        
+        clear -- if True, delete all current outgoing pipes
+        """
+        return Fitting.objects.pipe_many(
+            self, others, 
+            clear=clear, 
+            fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE,
+        )
     def pipe_from(self, other, clear=True, fitting_type=None):
         """Pipe this element from another element
         
         clear -- if True, delete all current incoming pipes
         """
         if clear:
-            self._sources(fitting_type=fitting_type).delete()
+            self.detach_sources(fitting_type=fitting_type)
         return other.pipe_to(self, clear=False, fitting_type=fitting_type)
+    def pipe_from_many(self, others, clear=True, fitting_type=None):
+        """Pipe each of others into this element with a single bulk insert
+        
+        clear -- if True, delete all current incoming pipes
+        """
+        return Fitting.objects.pipe_from_many(
+            self, others, 
+            clear=clear, 
+            fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE,
+        )
+
+    async def asources(self, fitting_type=None):
+        """Async sources(), see fitting.aio"""
+        return await aio.aneighbours(self, 'sources', fitting_type)
+    async def asinks(self, fitting_type=None):
+        """Async sinks(), see fitting.aio"""
+        return await aio.aneighbours(self, 'sinks', fitting_type)
+    async def adetach_sources(self, fitting_type=None):
+        await aio.adetach(self, 'sources', fitting_type)
+    async def adetach_sinks(self, fitting_type=None):
+        await aio.adetach(self, 'sinks', fitting_type)
+    async def apipe_to(self, other, clear=True, fitting_type=None):
+        """Async pipe_to()"""
+        return await aio.apipe(self, other, clear=clear, fitting_type=fitting_type)
+    async def apipe_from(self, other, clear=True, fitting_type=None):
+        """Async pipe_from()"""
+        if clear:
+            await self.adetach_sources(fitting_type=fitting_type)
+        return await aio.apipe(other, self, clear=False, fitting_type=fitting_type)
 
     @classmethod
-    def no_sources(cls, fitting_type=None):
-        # find all instances of cls where there is no mapping to this 
-        # instance...
+    def _fittings_to(cls, end, fitting_type=None):
+        """Fittings whose end ('source' or 'sink') is the outer query's record"""
         ct = ContentType.objects.get_for_model(cls)
-        maps = Fitting.objects.filter(sink_type=ct).filter(
-            fitting_type=fitting_type or cls.DEFAULT_FITTING_TYPE
-        ).all()
-        ids = [f.target_id for f in maps]
-        return cls.objects.exclude(id__in=ids)
+        return Fitting.objects.filter(**{
+            'fitting_type': fitting_type or cls.DEFAULT_FITTING_TYPE,
+            '%s_type'%(end,): ct,
+            '%s_id'%(end,): models.OuterRef('pk'),
+        })
+    @classmethod
+    def no_sources(cls, fitting_type=None):
+        """Get a queryset of all instances of cls without sources (roots)"""
+        return cls.objects.filter(
+            ~models.Exists(cls._fittings_to('sink', fitting_type))
+        )
+    @classmethod
+    def no_sinks(cls, fitting_type=None):
+        """Get a queryset of all instances of cls without sinks (leaves)"""
+        return cls.objects.filter(
+            ~models.Exists(cls._fittings_to('source', fitting_type))
+        )
+    @classmethod
+    def isolated(cls, fitting_type=None):
+        """Get a queryset of all instances of cls without sources or sinks"""
+        return cls.objects.filter(
+            ~models.Exists(cls._fittings_to('sink', fitting_type)),
+            ~models.Exists(cls._fittings_to('source', fitting_type)),
+        )
+    @classmethod
+    def with_degrees(cls, queryset=None, fitting_type=None):
+        """Annotate queryset (default all instances) with in_degree and out_degree
+        
+        in_degree is the number of sources, out_degree the number of sinks
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        def degree(end):
+            counts = cls._fittings_to(end, fitting_type).order_by().values(
+                '%s_id'%(end,)
+            ).annotate(count=models.Count('pk')).values('count')
+            return functions.Coalesce(
+                models.Subquery(counts, output_field=models.IntegerField()), 0
+            )
+        return queryset.annotate(
+            in_degree=degree('sink'),
+            out_degree=degree('source'),
+        )
 
+    def _iter_related(self, direction, fitting_type=None, seen=None, max_depth=None):
+        """Iterate breadth-first over related records, loading them level by level"""
+        fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
+        seen = seen if seen is not None else set()
+        mapping = active_mapping(fitting_type)
+        _cache_used(mapping, fitting_type)
+        for (depth, keys) in traversal.levels(
+            self, fitting_type, direction, max_depth=max_depth, mapping=mapping,
+        ):
+            if mapping is not None:
+                records = mapping._instances(keys)
+            else:
+                records = self._hydrated(keys)
+            for record in records:
+                if record not in seen:
+                    seen.add(record)
+                    yield record
     def iter_ancestors(self,fitting_type=None,seen=None):
-        seen = seen or set()
-        for source in self.sources(fitting_type):
-            if source not in seen:
-                yield source 
-                seen.add(source)
-                for anc in source.iter_ancestors( fitting_type, seen ):
-                    yield anc 
-    def ancestors(self,fitting_type=None):
+        """Iterate breadth-first over all (transitive) sources
+        
+        Performs one query per level of the graph (plus one per content 
+        type of each level's records), or none with an active cache()
+        
+        seen -- optional set of records not to yield, updated as records are yielded
+        """
+        return self._iter_related('up', fitting_type, seen)
+    def ancestors(self,fitting_type=None,max_depth=None,single_query=False):
+        """Retrieve all (transitive) sources of this element
+        
+        single_query -- if True, find the ancestors with one recursive 
+            query and then load them with one query per content type 
+            (implied when max_depth is specified)
+        max_depth -- if not None, only follow this many fittings
+        
+        When the closure table is enabled for fitting_type (see 
+        fitting.closure) it is used unless single_query is passed.
+        """
+        fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
+        if closure.enabled(fitting_type) and not single_query:
+            return self._hydrated(closure.related(self, fitting_type, 'up', max_depth))
+        if single_query or max_depth is not None:
+            return self._reachable('up', fitting_type, max_depth)
         return list(self.iter_ancestors(fitting_type))
     def iter_descendants(self,fitting_type=None,seen=None):
-        seen = seen or set()
-        for source in self.sinks(fitting_type):
-            if source not in seen:
-                yield source 
-                seen.add(source)
-                for anc in source.iter_descendants( fitting_type, seen):
-                    yield anc 
-    def descendants(self,fitting_type=None):
+        """Iterate breadth-first over all (transitive) sinks
+        
+        See iter_ancestors()
+        """
+        return self._iter_related('down', fitting_type, seen)
+    def descendants(self,fitting_type=None,max_depth=None,single_query=False):
+        """Retrieve all (transitive) sinks of this element
+        
+        See ancestors() for the meaning of the arguments
+        """
+        fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
+        if closure.enabled(fitting_type) and not single_query:
+            return self._hydrated(closure.related(self, fitting_type, 'down', max_depth))
+        if single_query or max_depth is not None:
+            return self._reachable('down', fitting_type, max_depth)
         return list(self.iter_descendants(fitting_type))
+    def aiter_ancestors(self,fitting_type=None,seen=None):
+        """Async iter_ancestors(), use with async for"""
+        return aio.aiter_related(self, 'up', fitting_type, seen)
+    def aiter_descendants(self,fitting_type=None,seen=None):
+        """Async iter_descendants(), use with async for"""
+        return aio.aiter_related(self, 'down', fitting_type, seen)
+    async def aancestors(self,fitting_type=None,max_depth=None):
+        """Async ancestors()"""
+        return await aio.arelated(self, 'up', fitting_type, max_depth)
+    async def adescendants(self,fitting_type=None,max_depth=None):
+        """Async descendants()"""
+        return await aio.arelated(self, 'down', fitting_type, max_depth)
+    def _reachable(self, direction, fitting_type=None, max_depth=None):
+        return self._hydrated(Fitting.reachable(
+            self, 
+            fitting_type=fitting_type or self.DEFAULT_FITTING_TYPE, 
+            direction=direction, 
+            max_depth=max_depth,
+        ))
+    @staticmethod
+    def _hydrated(keys):
+        objects = Fitting.hydrate(keys)
+        return [objects[key] for key in keys if key in objects]
+    def neighbourhood(self, k=1, fitting_type=None, direction='both'):
+        """Retrieve all records within k fittings of this element
+        
+        direction -- 'down' (sinks), 'up' (sources) or 'both'
+        """
+        return list(self._iter_related(direction, fitting_type, max_depth=k))
+    def shortest_path(self, other, fitting_type=None, direction='down', max_depth=None):
+        """Retrieve the records on a shortest path of fittings to other
+        
+        returns [self, ..., other] or None if there is no such path
+        """
+        fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
+        keys = traversal.shortest_path(
+            self, other, fitting_type, direction=direction, max_depth=max_depth,
+        )
+        if keys is None:
+            return None
+        objects = Fitting.hydrate(keys[1:-1])
+        objects[keys[0]], objects[keys[-1]] = self, other
+        return [objects.get(key) for key in keys]
+    def is_reachable(self, other, fitting_type=None):
+        """Is other (transitively) downstream of this element?
+        
+        Uses the closure table if enabled for fitting_type, otherwise 
+        the active cache() mapping or a single recursive query.
+        """
+        fitting_type = fitting_type or self.DEFAULT_FITTING_TYPE
+        if closure.enabled(fitting_type):
+            return closure.is_reachable(self, other, fitting_type)
+        target = node_key(other)
+        mapping = active_mapping(fitting_type)
+        if mapping is None:
+            return target in Fitting.reachable(self, fitting_type=fitting_type)
+        seen, stack = set(), [node_key(self)]
+        while stack:
+            for sink in mapping.sink_keys(stack.pop()):
+                if sink == target:
+                    return True
+                if sink not in seen:
+                    seen.add(sink)
+                    stack.append(sink)
+        return False
+
+def prefetch_fittings(queryset, fitting_type=None, direction='both'):
+    """Load the sources and/or sinks of all the elements of queryset at once
+    
+    direction -- 'sources', 'sinks' or 'both'
+    
+    Performs one query for the fittings of the elements (per 
+    traversal.BATCH_SIZE elements), then one query per content type of
+    the fitted records (honouring their default_prefetch), after which
+    sources()/sinks() on the returned elements answer without further
+    queries.
+    
+    returns a list of the elements
+    """
+    if direction not in ('sources','sinks','both'):
+        raise ValueError("Unrecognized direction: %r"%(direction,))
+    fitting_type = fitting_type or Fitting.DEFAULT_FITTING_TYPE
+    elements = list(queryset)
+    keys = node_keys(elements)
+    members = set(keys)
+    # a fitting between elements of different batches is found twice
+    rows = set()
+    for batch in traversal._batches(members):
+        query = models.Q()
+        for (contenttype_id, ids) in batch.items():
+            if direction != 'sinks':
+                query |= models.Q(sink_type_id=contenttype_id, sink_id__in=ids)
+            if direction != 'sources':
+                query |= models.Q(source_type_id=contenttype_id, source_id__in=ids)
+        rows.update(Fitting.objects.filter(
+            query, fitting_type=fitting_type,
+        ).values_list('source_type_id','source_id','sink_type_id','sink_id'))
+    found = {'sources':{}, 'sinks':{}}
+    for (source_type_id,source_id,sink_type_id,sink_id) in rows:
+        source, sink = (source_type_id,source_id), (sink_type_id,sink_id)
+        if direction != 'sinks' and sink in members:
+            found['sources'].setdefault(sink, []).append(source)
+        if direction != 'sources' and source in members:
+            found['sinks'].setdefault(source, []).append(sink)
+    objects = Fitting.hydrate([
+        key for neighbours in found.values() for targets in neighbours.values() for key in targets
+    ])
+    for (element,key) in zip(elements,keys):
+        prefetched = element.__dict__.setdefault('_prefetched_fittings', {})
+        for which in ('sources','sinks'):
+            if direction in (which, 'both'):
+                prefetched[(fitting_type,which)] = [
+                    objects[target] for target in sorted(found[which].get(key, ()))
+                    if target in objects
+                ]
+    return elements
+
+class PipeElementQuerySet(models.QuerySet):
+    """QuerySet for PipeElement models which unlinks fittings in bulk on delete()
+    
+    Rather than unlinking each deleted record individually (from the 
+    pre_delete handler) the fittings for all of the deleted records 
+    are removed with one delete query per batch:
+    
+        class ProcessX(fitting_models.PipeElement, models.Model):
+            objects = fitting_models.PipeElementQuerySet.as_manager()
+    """
+    def delete(self):
+        pks = list(self.values_list('pk', flat=True))
+        model = self.model._meta.concrete_model
+        token = _bulk_unlinked.set(_bulk_unlinked.get() | set([(model,pk) for pk in pks]))
+        try:
+            with transaction.atomic(using=self.db):
+                Fitting.unlink(self.model, pks)
+                return super(PipeElementQuerySet, self).delete()
+        finally:
+            _bulk_unlinked.reset(token)
+    delete.alters_data = True
+    delete.queryset_only = True
+
+# (concrete model,pk) of the records whose fittings PipeElementQuerySet.delete()
+# has already unlinked, records cascade-deleted with them are still unlinked
+# by the pre_delete handler
+_bulk_unlinked = contextvars.ContextVar('fitting_bulk_unlinked', default=frozenset())
 
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, class_prepared
 from django.dispatch.dispatcher import receiver
-@receiver(pre_delete)
 def unlink_fittings_on_deletion(sender, instance=None,  **named):
     """Unlink any fitting registered for a to-delete sender
     
-    NOTE: this runs on *every* deletion of *any* record, this 
-    is a bit of a huge club to solve a minor issue, but it should
-    prevent dangling references and doesn't affect my use cases.
+    NOTE: this is only connected for PipeElement models (see 
+    register_pipe_element), use PipeElementQuerySet to unlink
+    the fittings of mass-deletions with a few bulk queries.
     """
     if getattr( instance, 'no_fittings', None ):
         return 
@@ -313,8 +1299,11 @@ def unlink_fittings_on_deletion(sender, instance=None,  **named):
                 instance.fitting_cleanup()
             except Exception:
                 log.exception("Failure cleaning up %s instance: %s", sender, instance )
+        if (instance._meta.concrete_model, instance.pk) in _bulk_unlinked.get():
+            # already unlinked by PipeElementQuerySet.delete()
+            return
         try:
-            ct = ContentType.objects.get_for_model(sender)
+            ContentType.objects.get_for_model(sender)
         except transaction.TransactionManagementError:
             # migration where get_for_model fails due to lack of transactionality
             return
@@ -324,7 +1313,25 @@ def unlink_fittings_on_deletion(sender, instance=None,  **named):
             # obviously not compatible, so skip it...
             return 
         try:
-            Fitting.objects.filter(source_type=ct, source_id=instance.pk).delete()
-            Fitting.objects.filter(sink_type=ct, sink_id =instance.pk).delete()
+            Fitting.unlink(sender, [instance.pk])
         except Exception:
             log.exception("Unable to cleanup Fittings after deletion, likely running in a migration")
+
+def register_pipe_element(model):
+    """Unlink fittings when instances of model are deleted
+    
+    This is done automatically for all (non-abstract) PipeElement models
+    """
+    pre_delete.connect(
+        unlink_fittings_on_deletion, 
+        sender=model, 
+        weak=False,
+        dispatch_uid='fitting.unlink_fittings_on_deletion',
+    )
+
+@receiver(class_prepared)
+def register_pipe_elements(sender, **named):
+    if issubclass(sender, PipeElement):
+        register_pipe_element(sender)
+
+from fitting import shared, closure, traversal, orphans, aio, stats
@@ -0,0 +1,98 @@
+"""Garbage collection of orphaned fittings
+
+Fittings whose source or sink record no longer exists (deleted with 
+raw SQL, with no_fittings set, in a migration...) are found with an 
+anti-join against each fitted model's table and deleted in chunks:
+
+    python manage.py fitting_gc --dry-run
+
+By default sources()/sinks() also delete orphans they happen to 
+encounter, set FITTING_DELETE_ORPHANS_ON_READ = False to keep reads 
+read-only and rely on the collector instead.
+"""
+import functools, operator
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from fitting import models
+
+def delete_on_read():
+    """Should sources()/sinks() delete the orphans they encounter?"""
+    return getattr(settings, 'FITTING_DELETE_ORPHANS_ON_READ', True)
+
+def _missing(end, contenttype_id):
+    """Get a condition matching fittings whose end record of contenttype_id is missing"""
+    condition = Q(**{'%s_type_id'%(end,): contenttype_id})
+    try:
+        model_cls = ContentType.objects.get_for_id(contenttype_id).model_class()
+    except ContentType.DoesNotExist:
+        model_cls = None
+    if model_cls is None:
+        # the whole model is gone, so every fitting to it is orphaned
+        return condition
+    return condition & ~Exists(
+        model_cls._base_manager.filter(pk=OuterRef('%s_id'%(end,)))
+    )
+
+def _contenttype_ids(fitting_type, end):
+    return sorted(set(
+        models.Fitting.objects.filter(fitting_type=fitting_type).order_by().values_list(
+            '%s_type_id'%(end,), flat=True
+        ).distinct()
+    ))
+
+def collect_orphans(fitting_type=None, chunk_size=1000, dry_run=False, progress=None):
+    """Find (and unless dry_run, delete) orphaned fittings
+    
+    Sweeps each fitting_type (default all) and each content type 
+    fitted as a source or sink, reading and deleting at most chunk_size 
+    fittings per query.
+    
+    progress -- optional callable(fitting_type, end, contenttype_id, count)
+        called after each chunk with the number of orphans in the chunk
+    
+    returns the number of orphaned fittings found, each counted once
+    even if both of its ends are missing
+    """
+    if fitting_type is None:
+        fitting_types = sorted(set(
+            models.Fitting.objects.order_by().values_list('fitting_type', flat=True).distinct()
+        ))
+    else:
+        fitting_types = [fitting_type]
+    total = 0
+    for fitting_type in fitting_types:
+        fittings = models.Fitting.objects.filter(fitting_type=fitting_type)
+        for end in ('source','sink'):
+            contenttype_ids = _contenttype_ids(fitting_type, end)
+            if end == 'sink':
+                # fittings missing both ends were found by the source pass
+                source_missing = [
+                    _missing('source', contenttype_id) 
+                    for contenttype_id in _contenttype_ids(fitting_type, 'source')
+                ]
+                if source_missing:
+                    fittings = fittings.exclude(functools.reduce(operator.or_, source_missing))
+            for contenttype_id in contenttype_ids:
+                orphans = fittings.filter(_missing(end, contenttype_id)).order_by('pk')
+                after = 0
+                while True:
+                    rows = list(orphans.filter(pk__gt=after).values_list(
+                        'pk','source_type_id','source_id','sink_type_id','sink_id'
+                    )[:chunk_size])
+                    if not rows:
+                        break
+                    after = rows[-1][0]
+                    if not dry_run:
+                        with transaction.atomic(using=models.Fitting.objects.db):
+                            models.Fitting.objects.filter(pk__in=[row[0] for row in rows]).delete()
+                            models._fittings_changed(fitting_type, removed=[
+                                ((row[1],row[2]),(row[3],row[4])) for row in rows
+                            ])
+                    total += len(rows)
+                    if progress is not None:
+                        progress(fitting_type, end, contenttype_id, len(rows))
+                    if len(rows) < chunk_size:
+                        break
+    return total
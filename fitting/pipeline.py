@@ -0,0 +1,230 @@
+"""Topological ordering and parallel execution of PipeElement graphs
+
+Both operate on the (content_type_id,pk) keys of a mapping (by default
+the active cache() mapping for the fitting_type, otherwise an id-only
+CompactPipeMapping), optionally restricted to a subgraph of nodes:
+
+    for level in execution_levels(fitting_type=1):
+        ...
+    results = run_pipeline(process, fitting_type=1, max_workers=8)
+"""
+import concurrent.futures, contextvars
+from django.db import close_old_connections, connections
+from fitting import models
+
+class CycleError(ValueError):
+    """Raised when a pipeline graph contains a cycle
+
+    cycle -- the (content_type_id,pk) keys forming the cycle
+    """
+    def __init__(self, cycle):
+        super(CycleError,self).__init__('Pipeline contains a cycle: %s'%(cycle,))
+        self.cycle = cycle
+
+class PipelineError(Exception):
+    """Raised by run_pipeline when one or more nodes failed
+
+    errors -- {key: exception} for the nodes which failed
+    results -- {key: result} for the nodes which succeeded
+    cancelled -- set of keys which were not run
+    """
+    def __init__(self, errors, results, cancelled):
+        super(PipelineError,self).__init__(
+            '%s pipeline node(s) failed, %s cancelled'%(len(errors),len(cancelled))
+        )
+        self.errors = errors
+        self.results = results
+        self.cancelled = cancelled
+
+def _graph(nodes=None, fitting_type=None, mapping=None):
+    """Get {key: [sink keys]} for nodes (default all nodes) of the mapping"""
+    if mapping is None:
+        mapping = models.active_mapping(fitting_type)
+        if mapping is None:
+            mapping = models.CompactPipeMapping(fitting_type=fitting_type)
+    if nodes is None:
+        keys = list(mapping.nodes())
+    else:
+        keys = models.node_keys(nodes)
+    members = set(keys)
+    return dict([
+        (key, [sink for sink in mapping.sink_keys(key) if sink in members])
+        for key in keys
+    ])
+
+def _find_cycle(graph, remaining):
+    """Find a cycle among remaining nodes (each of which has a remaining source)"""
+    reverse = {}
+    for key in remaining:
+        for sink in graph[key]:
+            if sink in remaining:
+                reverse.setdefault(sink,[]).append(key)
+    path, seen = [], {}
+    key = min(remaining)
+    while key not in seen:
+        seen[key] = len(path)
+        path.append(key)
+        key = reverse[key][0]
+    return list(reversed(path[seen[key]:]))
+
+def _levels(graph):
+    indegree = dict([(key,0) for key in graph])
+    for sinks in graph.values():
+        for sink in sinks:
+            indegree[sink] += 1
+    level = sorted([key for (key,count) in indegree.items() if not count])
+    levels = []
+    while level:
+        levels.append(level)
+        following = []
+        for key in level:
+            for sink in graph[key]:
+                indegree[sink] -= 1
+                if not indegree[sink]:
+                    following.append(sink)
+        level = sorted(following)
+    remaining = set([key for (key,count) in indegree.items() if count])
+    if remaining:
+        raise CycleError(_find_cycle(graph, remaining))
+    return levels
+
+def execution_levels(nodes=None, fitting_type=None, mapping=None):
+    """Get the nodes as levels which can each be run in parallel
+
+    Every node's sources are in earlier levels.
+
+    nodes -- instances or keys of the subgraph to order (default all nodes)
+
+    returns [[(content_type_id,pk),...],...], raises CycleError on cycles
+    """
+    return _levels(_graph(nodes, fitting_type, mapping))
+
+def topological_order(nodes=None, fitting_type=None, mapping=None):
+    """Get the nodes in an order where every node follows its sources
+
+    returns [(content_type_id,pk),...], raises CycleError on cycles
+    """
+    return [key for level in execution_levels(nodes, fitting_type, mapping) for key in level]
+
+def _run_in_thread(function, instance, opened):
+    """Call function(instance) in a worker thread, adding its connections to opened
+    
+    As at the end of a request, connections are only closed once past
+    their CONN_MAX_AGE (or unusable), so a worker re-uses its persistent
+    connections for the following nodes.
+    """
+    try:
+        return function(instance)
+    finally:
+        close_old_connections()
+        opened.update(connections.all(initialized_only=True))
+
+def _close(opened):
+    """Close the worker threads' connections once the workers have finished"""
+    for connection in opened:
+        # connections are per-thread, and would otherwise be abandoned
+        # with the executor's threads
+        connection.inc_thread_sharing()
+        try:
+            connection.close()
+        finally:
+            connection.dec_thread_sharing()
+
+def run_pipeline(
+    function, nodes=None, fitting_type=None, mapping=None,
+    max_workers=None, executor='thread', fail_fast=False,
+):
+    """Call function(instance) for each node once all of its sources have finished
+
+    Independent branches run concurrently, each node is scheduled as
+    soon as its last source completes. Nodes downstream of a failed
+    node are cancelled (not run).
+
+    executor -- 'thread', 'process' or a concurrent.futures.Executor,
+        note that with 'process' function must be picklable and should
+        not rely on database connections inherited from the parent;
+        thread workers run in a copy of the caller's context (so they see
+        its cache() mappings) and close their connections past CONN_MAX_AGE
+        after each node, the rest when a created executor shuts down
+    max_workers -- concurrency of the created executor
+    fail_fast -- if True, cancel all not-yet-started nodes on the first failure
+
+    returns {key: result}, raises PipelineError if any node failed and
+    CycleError (before running anything) if the graph has a cycle
+    """
+    graph = _graph(nodes, fitting_type, mapping)
+    _levels(graph)
+    instances = models.Fitting.hydrate(graph.keys())
+    indegree = dict([(key,0) for key in graph])
+    for sinks in graph.values():
+        for sink in sinks:
+            indegree[sink] += 1
+    if executor == 'thread':
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    elif executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        pool = executor
+    threaded = isinstance(pool, concurrent.futures.ThreadPoolExecutor)
+    results, errors, cancelled, pending, opened = {}, {}, set(), {}, set()
+    def cancel(key):
+        stack = [key]
+        while stack:
+            for sink in graph[stack.pop()]:
+                if sink not in cancelled:
+                    cancelled.add(sink)
+                    stack.append(sink)
+    def submit(key):
+        if key in cancelled:
+            return
+        if key not in instances:
+            # record deleted since the graph was loaded
+            cancelled.add(key)
+            cancel(key)
+            return
+        if threaded:
+            # a context can only be entered by one thread at a time, so copy per node
+            future = pool.submit(
+                contextvars.copy_context().run, _run_in_thread, function, instances[key], opened,
+            )
+        else:
+            future = pool.submit(function, instances[key])
+        pending[future] = key
+    try:
+        for key in sorted(graph):
+            if not indegree[key]:
+                submit(key)
+        while pending:
+            done, _ = concurrent.futures.wait(
+                list(pending), return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                key = pending.pop(future)
+                error = None if future.cancelled() else future.exception()
+                if future.cancelled():
+                    cancelled.add(key)
+                elif error is not None:
+                    errors[key] = error
+                    cancel(key)
+                    if fail_fast:
+                        for other in pending:
+                            other.cancel()
+                        cancelled.update([
+                            node for node in graph
+                            if node not in results and node not in errors
+                        ])
+                else:
+                    results[key] = future.result()
+                    for sink in graph[key]:
+                        indegree[sink] -= 1
+                        if not indegree[sink]:
+                            submit(sink)
+    finally:
+        if pool is not executor:
+            pool.shutdown(wait=True)
+            _close(opened)
+    cancelled.difference_update(results)
+    cancelled.difference_update(errors)
+    if errors:
+        raise PipelineError(errors, results, cancelled)
+    return results
@@ -0,0 +1,171 @@
+"""Cross-process PipeMapping cache via Django's cache framework
+
+Each fitting_type has a generation counter stored in the cache, which 
+is bumped (on commit) whenever its fittings are written through the 
+mutation APIs or saved. The id-only CompactPipeMapping arrays for the 
+current generation are stored in the cache, so that only the first 
+process to need a generation loads it from the database, and each 
+process keeps a small LRU of decoded mappings which it revalidates 
+against the generation counter.
+
+Fittings deleted or updated by other means (queryset delete()/update(),
+raw SQL) are not noticed, call bump(fitting_type) after such writes.
+(There is deliberately no post_delete receiver, as any receiver 
+disables Django's fast deletes of Fittings.)
+
+Enable by naming the cache to use in settings:
+
+    FITTING_SHARED_CACHE = 'default'
+    FITTING_SHARED_CACHE_TIMEOUT = 24*60*60 # for the stored arrays
+    FITTING_SHARED_CACHE_LOCAL_SIZE = 8 # decoded mappings per process
+
+then use `cache(fitting_type=..., shared=True)` or shared_mapping().
+"""
+import collections, threading, time, sys
+from array import array
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch.dispatcher import receiver
+from fitting import models
+
+EPOCH_KEY = 'fitting:epoch'
+GENERATION_KEY = 'fitting:generation:%s'
+ARRAYS_KEY = 'fitting:arrays:%s:%s'
+
+_local = collections.OrderedDict()
+_local_lock = threading.Lock()
+
+def enabled():
+    return bool(getattr(settings, 'FITTING_SHARED_CACHE', None))
+
+def _cache():
+    alias = getattr(settings, 'FITTING_SHARED_CACHE', None)
+    if not alias:
+        raise ImproperlyConfigured("FITTING_SHARED_CACHE is not set")
+    return caches[alias]
+
+def _counter(cache, key):
+    value = cache.get(key)
+    if value is None:
+        # initialized from the clock so that a counter which was evicted
+        # never returns to a value used by an earlier generation
+        cache.add(key, int(time.time()*1000), timeout=None)
+        value = cache.get(key)
+    return value
+
+def generation(fitting_type=None):
+    """Get the current generation token for fitting_type"""
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    cache = _cache()
+    return '%s.%s'%(
+        _counter(cache, EPOCH_KEY),
+        _counter(cache, GENERATION_KEY%(fitting_type,)),
+    )
+
+def bump(fitting_type=None):
+    """Invalidate the shared mappings for fitting_type (None for all)"""
+    cache = _cache()
+    key = EPOCH_KEY if fitting_type is None else GENERATION_KEY%(fitting_type,)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # not present, so the next read will start a new generation
+        pass
+
+class _Bump(object):
+    """on_commit() callback bumping fitting_type (None for all)"""
+    def __init__(self, fitting_type):
+        self.fitting_type = fitting_type
+        self.done = False
+    def __call__(self):
+        self.done = True
+        bump(self.fitting_type)
+
+def _pending(connection, fitting_type):
+    """Is a bump covering fitting_type already waiting for the commit?"""
+    for entry in getattr(connection, 'run_on_commit', ()):
+        callback = entry[1]
+        if (
+            isinstance(callback, _Bump) and not callback.done and 
+            callback.fitting_type in (None, fitting_type)
+        ):
+            return True
+    return False
+
+def fittings_changed(fitting_type=None):
+    """Bump fitting_type's generation once the current transaction commits
+    
+    Registers at most one bump per fitting_type per transaction, a 
+    savepoint rollback discards its callbacks so later changes register
+    again.
+    """
+    if enabled():
+        connection = transaction.get_connection(models.Fitting.objects.db)
+        if connection.in_atomic_block and _pending(connection, fitting_type):
+            return
+        transaction.on_commit(
+            _Bump(fitting_type), 
+            using=models.Fitting.objects.db,
+        )
+
+@receiver(post_save, sender=models.Fitting)
+def bump_on_save(sender, instance=None, **named):
+    """Fittings saved directly (rather than via the mutation APIs) also bump"""
+    if not getattr(instance, '_notified', False):
+        fittings_changed(instance.fitting_type)
+
+def _encode(mapping):
+    return (sys.byteorder,) + tuple([
+        arr.tobytes() for arr in (mapping._nodes,)+mapping.forward+mapping.reverse
+    ])
+
+def _decode(value, fitting_type):
+    byteorder, arrays = value[0], []
+    for data in value[1:]:
+        arr = array('q')
+        arr.frombytes(data)
+        if byteorder != sys.byteorder:
+            arr.byteswap()
+        arrays.append(arr)
+    nodes, forward_offsets, forward_indices, reverse_offsets, reverse_indices = arrays
+    return models.CompactPipeMapping.from_arrays(
+        nodes, 
+        (forward_offsets, forward_indices),
+        (reverse_offsets, reverse_indices),
+        fitting_type=fitting_type,
+    )
+
+def shared_mapping(fitting_type=None):
+    """Get a CompactPipeMapping for fitting_type via the shared cache
+    
+    The returned mapping is private to the caller (it shares only the
+    read-only arrays), so it can be edited by the write-through APIs.
+    """
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    token = generation(fitting_type)
+    with _local_lock:
+        entry = _local.get(fitting_type)
+        if entry is not None and entry[0] == token:
+            _local.move_to_end(fitting_type)
+            return entry[1].copy()
+    cache = _cache()
+    key = ARRAYS_KEY%(fitting_type, token)
+    value = cache.get(key)
+    if value is not None:
+        mapping = _decode(value, fitting_type)
+    else:
+        mapping = models.CompactPipeMapping(fitting_type=fitting_type)
+        mapping.arrays()
+        cache.set(
+            key, _encode(mapping), 
+            timeout=getattr(settings, 'FITTING_SHARED_CACHE_TIMEOUT', 24*60*60),
+        )
+    with _local_lock:
+        _local[fitting_type] = (token, mapping)
+        _local.move_to_end(fitting_type)
+        while len(_local) > getattr(settings, 'FITTING_SHARED_CACHE_LOCAL_SIZE', 8):
+            _local.popitem(last=False)
+    return mapping.copy()
@@ -0,0 +1,195 @@
+"""Compact columnar snapshots of the fittings of a fitting_type
+
+    python manage.py fitting_dump --fitting-type 1 graph.snapshot
+    python manage.py fitting_load graph.snapshot [--replace]
+
+A snapshot file is a magic line, a one-line JSON header (padded to a
+multiple of 8 bytes) and four int64 columns: source content type,
+source pk, sink content type and sink pk. Content types are stored as
+indices into the header's list of natural keys, so a snapshot can be
+restored into a database whose content type ids differ. The header
+also records the ids of the dumping database so that a snapshot can be
+turned into a CompactPipeMapping without any queries:
+
+    mapping = snapshot.load('graph.snapshot', mmap=True).mapping()
+"""
+import json, mmap as mmap_module, sys
+from array import array
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from fitting import models, closure
+
+MAGIC = b'FITTING-SNAPSHOT 1\n'
+COLUMNS = ('source_type','source_id','sink_type','sink_id')
+
+class SnapshotError(ValueError):
+    """Raised when a file is not a (compatible) snapshot"""
+
+class Snapshot(object):
+    """The fittings of one fitting_type as int columns
+
+    content_types -- [(app_label,model),...] natural keys, which the
+        source_type and sink_type columns index
+    content_type_ids -- the ids of content_types in the dumping database
+    columns -- {name: int sequence} for each of COLUMNS
+    """
+    def __init__(self, fitting_type, content_types, content_type_ids, columns):
+        self.fitting_type = fitting_type
+        self.content_types = content_types
+        self.content_type_ids = content_type_ids
+        self.columns = columns
+    def __len__(self):
+        return len(self.columns['source_id'])
+    def resolve(self):
+        """Get the ids of our content types in the current database"""
+        return [
+            ContentType.objects.get_by_natural_key(app_label, model).id
+            for (app_label, model) in self.content_types
+        ]
+    def rows(self, content_type_ids=None):
+        """Iterate over (source_type_id,source_id,sink_type_id,sink_id) rows
+
+        content_type_ids -- ids for our content types, default the ids
+            of the dumping database (see resolve())
+        """
+        if content_type_ids is None:
+            content_type_ids = self.content_type_ids
+        return zip(
+            [content_type_ids[i] for i in self.columns['source_type']],
+            self.columns['source_id'],
+            [content_type_ids[i] for i in self.columns['sink_type']],
+            self.columns['sink_id'],
+        )
+    def edges(self, content_type_ids=None):
+        """Iterate over ((source_type_id,source_id),(sink_type_id,sink_id)) edges"""
+        for (source_type_id,source_id,sink_type_id,sink_id) in self.rows(content_type_ids):
+            yield (source_type_id,source_id), (sink_type_id,sink_id)
+    def mapping(self, content_type_ids=None, fitting_type=None):
+        """Get an id-only CompactPipeMapping of the snapshot without querying the database"""
+        return models.CompactPipeMapping(
+            edges=self.rows(content_type_ids),
+            fitting_type=fitting_type or self.fitting_type,
+        )
+
+def take(fitting_type=None, chunk_size=10000):
+    """Read the fittings of fitting_type into a Snapshot"""
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    indices, content_type_ids = {}, []
+    columns = dict([(name, array('q')) for name in COLUMNS])
+    def index(contenttype_id):
+        if contenttype_id not in indices:
+            indices[contenttype_id] = len(content_type_ids)
+            content_type_ids.append(contenttype_id)
+        return indices[contenttype_id]
+    for (source_type_id,source_id,sink_type_id,sink_id) in models.Fitting.objects.filter(
+        fitting_type=fitting_type,
+    ).order_by(
+        'source_type_id','source_id','sink_type_id','sink_id'
+    ).values_list(
+        'source_type_id','source_id','sink_type_id','sink_id'
+    ).iterator(chunk_size=chunk_size):
+        columns['source_type'].append(index(source_type_id))
+        columns['source_id'].append(source_id)
+        columns['sink_type'].append(index(sink_type_id))
+        columns['sink_id'].append(sink_id)
+    content_types = []
+    for contenttype_id in content_type_ids:
+        content_type = ContentType.objects.get_for_id(contenttype_id)
+        content_types.append((content_type.app_label, content_type.model))
+    return Snapshot(fitting_type, content_types, content_type_ids, columns)
+
+def write(snapshot, path):
+    """Write snapshot to the file at path"""
+    header = json.dumps({
+        'fitting_type': snapshot.fitting_type,
+        'byteorder': sys.byteorder,
+        'edges': len(snapshot),
+        'columns': list(COLUMNS),
+        'content_types': [list(natural_key) for natural_key in snapshot.content_types],
+        'content_type_ids': list(snapshot.content_type_ids),
+    }).encode('utf-8')
+    # pad so that the columns start 8-byte aligned
+    padding = -(len(MAGIC) + len(header) + 1) % 8
+    with open(path, 'wb') as output:
+        output.write(MAGIC)
+        output.write(header + b' '*padding + b'\n')
+        for name in COLUMNS:
+            column = snapshot.columns[name]
+            if not isinstance(column, array):
+                column = array('q', column)
+            output.write(column.tobytes())
+
+def dump(fitting_type, path, chunk_size=10000):
+    """Write the fittings of fitting_type to a snapshot file, returns the Snapshot"""
+    snapshot = take(fitting_type, chunk_size=chunk_size)
+    write(snapshot, path)
+    return snapshot
+
+def load(path, mmap=False):
+    """Read the Snapshot in the file at path
+
+    mmap -- if True, memory-map the file and use read-only views of it
+        as the columns (rather than reading them into arrays), the
+        columns are copied if the file's byteorder differs
+    """
+    with open(path, 'rb') as source:
+        if source.readline() != MAGIC:
+            raise SnapshotError("%s is not a fitting snapshot"%(path,))
+        header = json.loads(source.readline().decode('utf-8'))
+        if header['columns'] != list(COLUMNS):
+            raise SnapshotError("%s has unsupported columns %s"%(path, header['columns']))
+        offset, count = source.tell(), header['edges']
+        swap = header['byteorder'] != sys.byteorder
+        if mmap and not swap and count:
+            view = memoryview(mmap_module.mmap(source.fileno(), 0, access=mmap_module.ACCESS_READ))
+            columns = dict([
+                (name, view[offset+i*count*8:offset+(i+1)*count*8].cast('q'))
+                for (i,name) in enumerate(COLUMNS)
+            ])
+        else:
+            columns = {}
+            for name in COLUMNS:
+                column = array('q')
+                column.frombytes(source.read(count*8))
+                if len(column) != count:
+                    raise SnapshotError("%s is truncated"%(path,))
+                if swap:
+                    column.byteswap()
+                columns[name] = column
+    return Snapshot(
+        header['fitting_type'],
+        [tuple(natural_key) for natural_key in header['content_types']],
+        header['content_type_ids'],
+        columns,
+    )
+
+def restore(snapshot, fitting_type=None, replace=False, batch_size=5000):
+    """Create the fittings of snapshot in the database
+
+    fitting_type -- fitting_type to create the fittings as, default the
+        snapshot's
+    replace -- if True, make the fittings of fitting_type match the
+        snapshot (see Fitting.sync), otherwise add the missing ones
+
+    Content types are matched by natural key, fittings are created with
+    batched bulk inserts in a single transaction. The closure table (if
+    enabled) is rebuilt once at the end rather than maintained for each
+    batch, and the shared cache is bumped once.
+
+    returns the number of fittings in the snapshot
+    """
+    fitting_type = fitting_type or snapshot.fitting_type
+    content_type_ids = snapshot.resolve()
+    with transaction.atomic(using=models.Fitting.objects.db), closure.deferred():
+        if replace:
+            models.Fitting.sync(fitting_type, snapshot.edges(content_type_ids), batch_size=batch_size)
+            return len(snapshot)
+        batch = []
+        for edge in snapshot.edges(content_type_ids):
+            batch.append(edge)
+            if len(batch) >= batch_size:
+                models.Fitting.objects.bulk_pipe(batch, fitting_type=fitting_type, batch_size=batch_size)
+                batch = []
+        if batch:
+            models.Fitting.objects.bulk_pipe(batch, fitting_type=fitting_type, batch_size=batch_size)
+    return len(snapshot)
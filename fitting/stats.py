@@ -0,0 +1,78 @@
+"""Instrumentation of graph operations
+
+Every instrumented operation sends the `operation` signal, with the
+operation name as the sender, the fitting_type (None when the operation
+spans all fitting_types) and the operation's metrics as keyword
+arguments:
+
+    from fitting import stats
+
+    @receiver(stats.operation)
+    def record(sender, fitting_type=None, **metrics):
+        statsd.incr('fitting.%s'%(sender,), tags=['fitting_type:%s'%(fitting_type,)])
+
+Operations and their metrics:
+
+    cache_hit, cache_miss -- sources()/sinks()/traversals which did (not)
+        find an active cache() mapping for the fitting_type, misses 
+        report the fitting_types which were cached as active
+    cache_build -- a cache() mapping was created: mapping (class name),
+        seconds, queries
+    mapping -- Fitting.mapping() loaded: edges, nodes, seconds, queries
+    compact_mapping -- a CompactPipeMapping loaded: edges, nodes, seconds, queries
+    hydrate -- records loaded: keys, records, seconds, queries
+    traversal -- a breadth-first traversal finished: direction, depth,
+        nodes (found), expanded (nodes whose fittings were read)
+    reachable -- a recursive query ran: direction, nodes, seconds, queries
+    sync -- Fitting.sync(): added, removed, seconds, queries
+    bulk_pipe -- fittings bulk-created: edges, seconds, queries
+    unlink -- fittings of deleted records removed (from the pre_delete
+        handler or PipeElementQuerySet.delete()): model, records,
+        fittings, seconds, queries
+    orphan_delete -- sources()/sinks() deleted a dangling fitting
+
+Nothing is measured unless a receiver is connected, so the disabled
+overhead is a check of the signal's receiver list.
+"""
+import contextlib, time
+from django.db import connections
+from django.dispatch import Signal
+from fitting import models
+
+operation = Signal()
+
+def enabled():
+    """Is anything listening for operations?"""
+    return bool(operation.receivers)
+
+def report(name, fitting_type=None, **metrics):
+    """Send operation name with metrics, if anything is listening"""
+    if operation.receivers:
+        operation.send(sender=name, fitting_type=fitting_type, **metrics)
+
+class _QueryCounter(object):
+    """connection.execute_wrapper() counting the queries run"""
+    def __init__(self):
+        self.count = 0
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+@contextlib.contextmanager
+def measured(name, fitting_type=None, using=None, **metrics):
+    """Report operation name with the seconds and queries the block took
+
+    yields the metrics dict, which the block may add to; if nothing is
+    listening nothing is measured (or reported)
+    """
+    if not operation.receivers:
+        yield metrics
+        return
+    counter = _QueryCounter()
+    connection = connections[using or models.Fitting.objects.db]
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        yield metrics
+    metrics['seconds'] = time.perf_counter() - start
+    metrics['queries'] = counter.count
+    report(name, fitting_type, **metrics)
@@ -1,4 +1,1102 @@
-from django.test import TestCase
-from django.core.urlresolvers import reverse
+import asyncio, io, json, os, tempfile, threading, time, unittest
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.db import connection, connections, transaction, models as db_models
+from django.contrib.contenttypes.models import ContentType
+from fitting import models, benchmark, stats, snapshot, analytics, closure, shared, pipeline, aio, orphans, export, views, traversal
 
+class Element(models.PipeElement, db_models.Model):
+    objects = models.PipeElementQuerySet.as_manager()
+    class Meta:
+        app_label = 'fitting'
 
+class OtherElement(models.PipeElement, db_models.Model):
+    class Meta:
+        app_label = 'fitting'
+
+class TreeElement(models.PipeElement, db_models.Model):
+    parent = db_models.ForeignKey('self', null=True, on_delete=db_models.CASCADE)
+    objects = models.PipeElementQuerySet.as_manager()
+    class Meta:
+        app_label = 'fitting'
+
+class DetailElement(models.PipeElement, db_models.Model):
+    name = db_models.CharField(max_length=32, default='')
+    notes = db_models.TextField(default='')
+    tree = db_models.ForeignKey(TreeElement, null=True, on_delete=db_models.CASCADE)
+    class Meta:
+        app_label = 'fitting'
+
+TEST_MODELS = [Element, OtherElement]
+TABLE_MODELS = TEST_MODELS + [TreeElement, DetailElement]
+
+class ElementTables(object):
+    """Mix-in creating the test models' tables for a TestCase"""
+    @classmethod
+    def setUpClass(cls):
+        # tables (and content types) are created outside of the test
+        # transactions, which sqlite's schema editor does not support
+        with connection.schema_editor() as editor:
+            for model_cls in TABLE_MODELS:
+                editor.create_model(model_cls)
+        ContentType.objects.get_for_models(*TABLE_MODELS)
+        super(ElementTables,cls).setUpClass()
+    @classmethod
+    def tearDownClass(cls):
+        super(ElementTables,cls).tearDownClass()
+        with connection.schema_editor() as editor:
+            for model_cls in TABLE_MODELS:
+                editor.delete_model(model_cls)
+
+    def graph(self, generator, size, model_classes=(Element,), fitting_type=None):
+        nodes = benchmark.create_nodes(list(model_classes), size)
+        models.Fitting.objects.bulk_pipe(generator(nodes), fitting_type=fitting_type)
+        return nodes
+    def rows(self, fitting_type=None):
+        return sorted(models.Fitting.objects.filter(
+            fitting_type=fitting_type or models.Fitting.DEFAULT_FITTING_TYPE,
+        ).values_list('source_type_id','source_id','sink_type_id','sink_id'))
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class QueryBudgetTests(ElementTables, TestCase):
+    """Query-count budgets for the traversal, mapping and mutation APIs
+
+    Budgets are checked at several graph sizes, as the number of queries
+    must depend on the depth of the graph and the number of content
+    types rather than on the number of nodes.
+    """
+    SIZES = (10, 60)
+
+    def test_generators(self):
+        nodes = list(range(10))
+        self.assertEqual(len(benchmark.chain(nodes)), 9)
+        self.assertEqual(len(benchmark.fan_out_in(nodes)), 16)
+        edges = benchmark.random_dag(nodes, seed=1)
+        self.assertEqual(len(edges), 20)
+        self.assertEqual(len(set(edges)), 20)
+        for (source, sink) in edges:
+            self.assertLess(source, sink)
+        created = benchmark.create_nodes(TEST_MODELS, 5)
+        self.assertEqual(
+            [record.__class__ for record in created],
+            [Element, OtherElement, Element, OtherElement, Element],
+        )
+
+    def test_measure(self):
+        self.graph(benchmark.chain, 5)
+        result, stats = benchmark.measure(models.Fitting.mapping)
+        self.assertEqual(len(result), 4)
+        self.assertEqual(stats['queries'], 2)
+        self.assertGreaterEqual(stats['seconds'], 0)
+        self.assertGreater(stats['peak_memory'], 0)
+
+    def test_run_suite(self):
+        records = benchmark.run_suite(TEST_MODELS, sizes=(8,))
+        self.assertEqual(
+            set([(record['graph'], record['content_types']) for record in records]),
+            set([(name, count) for (name, _) in benchmark.GRAPHS for count in (1,2)]),
+        )
+        for record in records:
+            for name in ('seconds','peak_memory','queries'):
+                self.assertIn(name, record)
+
+    def test_mapping(self):
+        for size in self.SIZES:
+            models.Fitting.objects.all().delete()
+            self.graph(benchmark.random_dag, size, TEST_MODELS)
+            # the fittings, then one query per content type
+            with self.assertNumQueries(3):
+                models.Fitting.mapping()
+            with self.assertNumQueries(3):
+                models.PipeMapping()
+            with self.assertNumQueries(1):
+                models.CompactPipeMapping().arrays()
+
+    def test_cached_reads(self):
+        for size in self.SIZES:
+            nodes = self.graph(benchmark.fan_out_in, size)
+            with models.cache():
+                with self.assertNumQueries(0):
+                    self.assertEqual(len(nodes[0].sinks()), size-2)
+                    self.assertEqual(len(nodes[-1].sources()), size-2)
+                    self.assertEqual(len(list(nodes[0].iter_descendants())), size-1)
+            with models.cache(lazy=True):
+                # the edges, then the records of the single content type
+                with self.assertNumQueries(2):
+                    nodes[0].sinks()
+
+    def test_prefetch_fittings(self):
+        for size in self.SIZES:
+            nodes = self.graph(benchmark.fan_out_in, size)
+            queryset = Element.objects.filter(pk__in=[node.pk for node in nodes])
+            with self.assertNumQueries(3):
+                # the elements, their fittings, the fitted records
+                records = list(models.prefetch_fittings(queryset))
+            with self.assertNumQueries(0):
+                for record in records:
+                    record.sources()
+                    record.sinks()
+        # large querysets query the fittings in batches
+        nodes = self.graph(benchmark.fan_out_in, 6, TEST_MODELS)
+        expected = [(node.sources(), node.sinks()) for node in nodes]
+        with mock.patch.object(traversal, 'BATCH_SIZE', 2):
+            with self.assertNumQueries(3+2):
+                # the fittings of each batch of 2 elements, the fitted records
+                records = models.prefetch_fittings(nodes)
+        with self.assertNumQueries(0):
+            self.assertEqual([(record.sources(), record.sinks()) for record in records], expected)
+
+    def test_prefetch_fittings_mutations(self):
+        first, second, third, fourth = nodes = benchmark.create_nodes([Element], 4)
+        def prefetched():
+            return list(models.prefetch_fittings(nodes))
+        prefetched()
+        first.pipe_many([second, third])
+        second.pipe_from_many([third, fourth], clear=False)
+        self.assertEqual(first.sinks(), [second, third])
+        self.assertEqual(second.sources(), [first, third, fourth])
+        self.assertEqual(fourth.sinks(), [second])
+        prefetched()
+        models.Fitting.sync(1, [(first, fourth), (third, second)])
+        self.assertEqual(first.sinks(), [fourth])
+        self.assertEqual(fourth.sources(), [first])
+        self.assertEqual(third.sinks(), [second])
+        prefetched()
+        models.Fitting.objects.pipe_many(third, [first], fitting_type=1)
+        self.assertEqual(third.sinks(), [first])
+        self.assertEqual(first.sources(), [third])
+
+    def test_iter_descendants(self):
+        for size in self.SIZES:
+            nodes = self.graph(benchmark.fan_out_in, size)
+            # per level, the fittings and the records, then the final (empty) level
+            with self.assertNumQueries(5):
+                self.assertEqual(len(list(nodes[0].iter_descendants())), size-1)
+            with self.assertNumQueries(5):
+                self.assertEqual(len(list(nodes[-1].iter_ancestors())), size-1)
+        nodes = self.graph(benchmark.chain, 6)
+        with self.assertNumQueries(2*5+1):
+            self.assertEqual(len(list(nodes[0].iter_descendants())), 5)
+
+    def test_descendants_single_query(self):
+        for size in self.SIZES:
+            nodes = self.graph(benchmark.fan_out_in, size, TEST_MODELS)
+            # the recursive query, then one query per content type
+            with self.assertNumQueries(3):
+                nodes[0].descendants(single_query=True)
+
+    def test_pipe_to(self):
+        first, second, third = benchmark.create_nodes(TEST_MODELS, 3)
+        with self.assertNumQueries(1):
+            first.pipe_to(second, clear=False)
+        with self.assertNumQueries(2):
+            first.pipe_to(third)
+        self.assertEqual(first.sinks(), [third])
+        # the delete and the bulk insert, within a savepoint
+        with self.assertNumQueries(4):
+            first.pipe_many([second, third])
+
+    def test_sync(self):
+        nodes = benchmark.create_nodes(TEST_MODELS, 6)
+        edges = benchmark.chain(nodes[:4])
+        def expected(edges):
+            return sorted([source + sink for (source, sink) in zip(
+                models.node_keys([source for (source, sink) in edges]),
+                models.node_keys([sink for (source, sink) in edges]),
+            )])
+        self.assertEqual(models.Fitting.sync(1, edges), (3, 0))
+        self.assertEqual(self.rows(), expected(edges))
+        # identical, only reads the current fittings (within a savepoint)
+        with self.assertNumQueries(3):
+            self.assertEqual(models.Fitting.sync(1, edges), (0, 0))
+        self.assertEqual(self.rows(), expected(edges))
+        # superset, keys are accepted as well as instances
+        superset = edges + [(models.node_key(nodes[3]), nodes[4]), (nodes[4], nodes[5])]
+        self.assertEqual(models.Fitting.sync(1, superset), (2, 0))
+        self.assertEqual(self.rows(), expected(superset))
+        # subset (plus one new edge)
+        subset = superset[1:3] + [(nodes[5], nodes[0])]
+        self.assertEqual(models.Fitting.sync(1, subset), (1, 3))
+        self.assertEqual(self.rows(), expected(subset))
+        # other fitting_types are untouched
+        models.Fitting.objects.bulk_pipe(edges, fitting_type=2)
+        self.assertEqual(models.Fitting.sync(1, []), (0, 3))
+        self.assertEqual(self.rows(), [])
+        self.assertEqual(self.rows(2), expected(edges))
+
+    def test_delete(self):
+        for size in self.SIZES:
+            nodes = self.graph(benchmark.fan_out_in, size)
+            # the deletion signal unlinks the fittings with a single query
+            with self.assertNumQueries(2):
+                nodes[0].delete()
+            self.assertEqual(nodes[1].sources(), [])
+            pks = [node.pk for node in nodes[1:]]
+            # the pks, one unlink query, then Django's collection and 
+            # delete queries (within a savepoint) for the whole queryset
+            with self.assertNumQueries(6):
+                Element.objects.filter(pk__in=pks).delete()
+            self.assertFalse(models.Fitting.objects.filter(
+                sink_type=ContentType.objects.get_for_model(Element), sink_id__in=pks,
+            ).exists())
+
+    def test_delete_cascade(self):
+        root = TreeElement.objects.create()
+        child = TreeElement.objects.create(parent=root)
+        grandchild = TreeElement.objects.create(parent=child)
+        other, = benchmark.create_nodes([Element], 1)
+        models.Fitting.objects.bulk_pipe([(root, other), (other, child), (grandchild, other)])
+        # records of the same model cascade-deleted with the queryset are
+        # unlinked by the pre_delete handler
+        TreeElement.objects.filter(pk=root.pk).delete()
+        self.assertEqual(TreeElement.objects.count(), 0)
+        self.assertEqual(self.rows(), [])
+
+    def test_instrumentation(self):
+        nodes = self.graph(benchmark.chain, 4)
+        events = []
+        def record(sender, fitting_type=None, **metrics):
+            events.append((sender, fitting_type, metrics))
+        stats.operation.connect(record)
+        try:
+            # measuring does not add queries
+            with self.assertNumQueries(2):
+                models.Fitting.mapping()
+            with models.cache(fitting_type=2):
+                list(nodes[0].iter_descendants())
+        finally:
+            stats.operation.disconnect(record)
+        # the first of each operation (cache() also builds a mapping for fitting_type 2)
+        operations = {}
+        for (sender, fitting_type, metrics) in events:
+            operations.setdefault(sender, (fitting_type, metrics))
+        self.assertEqual(operations['mapping'][1]['edges'], 3)
+        self.assertEqual(operations['mapping'][1]['nodes'], 4)
+        self.assertEqual(operations['mapping'][1]['queries'], 2)
+        self.assertEqual(operations['cache_miss'], (1, {'signal': stats.operation, 'active': [2]}))
+        self.assertEqual(operations['traversal'][1]['depth'], 3)
+        self.assertEqual(operations['traversal'][1]['nodes'], 3)
+        events[:] = []
+        models.Fitting.mapping()
+        self.assertEqual(events, [])
+
+class CacheContextTests(SimpleTestCase):
+    """cache() blocks are local to their thread or asyncio task"""
+    def cache(self):
+        # an id-only mapping of no edges, which needs no queries
+        return models.cache(edges=[], lazy=True)
+
+    def test_threads(self):
+        entered, exited = threading.Event(), threading.Event()
+        seen = []
+        def worker():
+            seen.append(models.active_mapping())
+            with self.cache() as mapping:
+                seen.append(models.active_mapping() is mapping)
+                entered.set()
+                exited.wait(5)
+            seen.append(models.active_mapping())
+        with self.cache() as mapping:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            entered.wait(5)
+            # the worker's block does not replace ours
+            self.assertIs(models.active_mapping(), mapping)
+            exited.set()
+            thread.join(5)
+            # nor does exiting it clear ours
+            self.assertIs(models.active_mapping(), mapping)
+        self.assertIsNone(models.active_mapping())
+        self.assertEqual(seen, [None, True, None])
+
+    def test_tasks(self):
+        async def main():
+            first_entered, second_done = asyncio.Event(), asyncio.Event()
+            async def first():
+                with self.cache() as mapping:
+                    first_entered.set()
+                    await second_done.wait()
+                    return models.active_mapping() is mapping
+            async def second():
+                await first_entered.wait()
+                outside = models.active_mapping()
+                with self.cache() as mapping:
+                    inside = models.active_mapping() is mapping
+                second_done.set()
+                return outside, inside, models.active_mapping()
+            return await asyncio.gather(first(), second())
+        self.assertEqual(asyncio.run(main()), [True, (None, True, None)])
+        self.assertIsNone(models.active_mapping())
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class HydratorTests(ElementTables, TestCase):
+    """Loading of fitted records (models.Hydrator)"""
+    def test_chunks(self):
+        elements = benchmark.create_nodes([Element], 10)
+        others = benchmark.create_nodes([OtherElement], 4)
+        keys = models.node_keys(elements + others)
+        # duplicate keys are loaded once, then one query per chunk of each content type
+        with self.assertNumQueries(1 + 1):
+            loaded = models.Hydrator().load(keys + keys[::-1])
+        self.assertEqual(sorted(loaded), sorted(keys))
+        self.assertEqual([loaded[key] for key in keys], elements + others)
+        with self.assertNumQueries(4 + 2):
+            self.assertEqual(len(models.Hydrator(chunk_size=3).load(keys + keys)), 14)
+        # missing records are omitted
+        missing = (keys[0][0], elements[-1].pk + 1000)
+        self.assertNotIn(missing, models.Fitting.hydrate(keys + [missing]))
+
+    def test_hints(self):
+        tree = TreeElement.objects.create()
+        detail = DetailElement.objects.create(name='detail', notes='long', tree=tree)
+        key = models.node_key(detail)
+        def load():
+            return models.Fitting.hydrate([key])[key]
+        with mock.patch.object(DetailElement, 'default_only', ('name',), create=True):
+            self.assertEqual(load().get_deferred_fields(), set(['notes', 'tree_id']))
+        with mock.patch.object(DetailElement, 'default_defer', ('notes',), create=True):
+            self.assertEqual(load().get_deferred_fields(), set(['notes']))
+        with mock.patch.object(DetailElement, 'default_select_related', ('tree',), create=True):
+            with self.assertNumQueries(1):
+                self.assertEqual(load().tree, tree)
+        with mock.patch.object(TreeElement, 'default_prefetch', ('detailelement_set',), create=True):
+            with self.assertNumQueries(2):
+                loaded = models.Fitting.hydrate(models.node_keys([tree]))
+            with self.assertNumQueries(0):
+                self.assertEqual(list(loaded[models.node_key(tree)].detailelement_set.all()), [detail])
+
+    def test_content_types(self):
+        nodes = self.graph(benchmark.chain, 6, TEST_MODELS)
+        keys = models.node_keys(nodes)
+        element_type = ContentType.objects.get_for_model(Element).id
+        for content_types in ([Element], [element_type]):
+            with self.assertNumQueries(1):
+                loaded = models.Fitting.hydrate(keys, content_types=content_types)
+            self.assertEqual(sorted(loaded), sorted(models.node_keys(nodes[::2])))
+        # fittings to or from other content types are omitted
+        self.assertEqual(models.Fitting.mapping(content_types=[Element]), {})
+        nodes[0].pipe_to(nodes[2], clear=False)
+        with self.assertNumQueries(2):
+            self.assertEqual(models.Fitting.mapping(content_types=[Element]), {nodes[0]: [nodes[2]]})
+        self.assertEqual(len(models.Fitting.mapping()), 5)
+
+    def test_custom_hydrator(self):
+        nodes = self.graph(benchmark.fan_out_in, 6)
+        class Skipping(models.Hydrator):
+            def queryset(self, model_cls):
+                return super(Skipping, self).queryset(model_cls).exclude(pk=nodes[1].pk)
+        hydrator = Skipping(chunk_size=2)
+        loaded = models.Fitting.hydrate(models.node_keys(nodes), hydrator=hydrator)
+        self.assertEqual(sorted(loaded), sorted(models.node_keys(nodes[:1] + nodes[2:])))
+        mapping = models.Fitting.mapping(hydrator=hydrator)
+        self.assertEqual(mapping[nodes[0]], nodes[2:5])
+        self.assertNotIn(nodes[1], mapping)
+        with mock.patch.object(models.Fitting, 'hydrator', hydrator):
+            self.assertEqual(models.Fitting.mapping(), mapping)
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class TraversalTests(ElementTables, TestCase):
+    """Breadth-first traversals and path searches (fitting.traversal)"""
+    def distances(self, start, direction):
+        """Reference breadth-first {key: depth} over the fittings, without start"""
+        adjacency = {}
+        for (source_type_id, source_id, sink_type_id, sink_id) in self.rows():
+            source, sink = (source_type_id, source_id), (sink_type_id, sink_id)
+            if direction != 'up':
+                adjacency.setdefault(source, []).append(sink)
+            if direction != 'down':
+                adjacency.setdefault(sink, []).append(source)
+        depths, frontier, depth = {}, [start], 0
+        while frontier:
+            depth += 1
+            following = []
+            for key in frontier:
+                for neighbour in adjacency.get(key, ()):
+                    if neighbour not in depths and neighbour != start:
+                        depths[neighbour] = depth
+                        following.append(neighbour)
+            frontier = following
+        return depths
+
+    def assertPath(self, path, source, target, direction, length):
+        self.assertEqual((path[0], path[-1]), (source, target))
+        self.assertEqual(len(path) - 1, length)
+        rows = set([(row[:2], row[2:]) for row in self.rows()])
+        for (first, second) in zip(path, path[1:]):
+            self.assertTrue({
+                'down': (first, second) in rows,
+                'up': (second, first) in rows,
+                'both': (first, second) in rows or (second, first) in rows,
+            }[direction])
+
+    def test_traverse(self):
+        nodes = self.graph(benchmark.random_dag, 30, TEST_MODELS)
+        for node in nodes[::3]:
+            key = models.node_key(node)
+            for direction in ('down', 'up', 'both'):
+                expected = self.distances(key, direction)
+                found = list(traversal.traverse(node, direction=direction))
+                self.assertEqual(dict(found), expected)
+                # breadth-first
+                self.assertEqual([depth for (_, depth) in found], sorted(expected.values()))
+                for k in (1, 2):
+                    self.assertEqual(
+                        traversal.neighbourhood(node, k, direction=direction),
+                        dict([(other, depth) for (other, depth) in expected.items() if depth <= k]),
+                    )
+                    self.assertEqual(
+                        sorted(models.node_keys(node.neighbourhood(k, direction=direction))),
+                        sorted([other for (other, depth) in expected.items() if depth <= k]),
+                    )
+                if len(found) > 2:
+                    # stops right after the first node the predicate accepts
+                    stop = found[len(found)//2][0]
+                    self.assertEqual(
+                        list(traversal.traverse(node, direction=direction, until=lambda key, depth: key == stop)),
+                        found[:len(found)//2+1],
+                    )
+        # with a cycle, the start node is reachable from itself
+        nodes[-1].pipe_to(nodes[0], clear=False)
+        self.assertIn(models.node_key(nodes[0]), dict(traversal.traverse(nodes[0])))
+        self.assertNotIn(models.node_key(nodes[0]), dict(traversal.traverse(nodes[0], direction='both')))
+
+    def test_shortest_path(self):
+        nodes = self.graph(benchmark.random_dag, 30, TEST_MODELS)
+        # a chain with a shortcut, ending in another content type
+        chain = benchmark.create_nodes(TEST_MODELS, 8)
+        models.Fitting.objects.bulk_pipe(benchmark.chain(chain) + [(chain[1], chain[5])])
+        self.assertEqual(
+            traversal.shortest_path(chain[0], chain[7]),
+            models.node_keys(chain[:2] + chain[5:]),
+        )
+        self.assertEqual(
+            traversal.shortest_path(chain[7], chain[0], direction='up'),
+            models.node_keys(chain[7:4:-1] + chain[1::-1]),
+        )
+        self.assertIsNone(traversal.shortest_path(chain[7], chain[0]))
+        self.assertIsNone(traversal.shortest_path(chain[0], nodes[0], direction='both'))
+        self.assertEqual(traversal.shortest_path(chain[3], chain[3]), models.node_keys(chain[3:4]))
+        self.assertEqual(chain[0].shortest_path(chain[7]), chain[:2] + chain[5:])
+        self.assertIsNone(chain[0].shortest_path(chain[7], max_depth=3))
+        self.assertEqual(len(chain[0].shortest_path(chain[7], max_depth=4)), 5)
+        keys = models.node_keys(nodes)
+        for source in keys[:10]:
+            for direction in ('down', 'up', 'both'):
+                expected = self.distances(source, direction)
+                for target in keys[::4]:
+                    if target == source:
+                        continue
+                    path = traversal.shortest_path(source, target, direction=direction)
+                    if target not in expected:
+                        self.assertIsNone(path)
+                        continue
+                    self.assertPath(path, source, target, direction, expected[target])
+                    length = expected[target]
+                    self.assertIsNone(traversal.shortest_path(source, target, direction=direction, max_depth=length-1))
+                    self.assertEqual(len(traversal.shortest_path(source, target, direction=direction, max_depth=length)), length+1)
+        with models.cache():
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    traversal.shortest_path(chain[0], chain[7]), models.node_keys(chain[:2] + chain[5:]),
+                )
+        with self.assertRaises(ValueError):
+            traversal.shortest_path(chain[0], chain[7], direction='sideways')
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class ExportTests(ElementTables, TestCase):
+    """Query-bounded export of fittings (fitting.export, fitting.views)"""
+    def expected(self, fitting_type=1):
+        return [
+            fitting.__json__() 
+            for fitting in models.Fitting.objects.filter(fitting_type=fitting_type).order_by('pk')
+        ]
+
+    def test_iter_fittings(self):
+        for size in (10, 60):
+            self.graph(benchmark.fan_out_in, size, TEST_MODELS)
+            self.graph(benchmark.chain, 3, fitting_type=2)
+            # the content types, then the fittings, regardless of their number
+            with self.assertNumQueries(2):
+                records = list(export.iter_fittings(1, chunk_size=7))
+            self.assertEqual(records, self.expected())
+            self.assertEqual(list(export.iter_fittings(2)), self.expected(2))
+            self.assertEqual(len(list(export.iter_fittings())), models.Fitting.objects.count())
+
+    def test_fitting_page(self):
+        self.graph(benchmark.chain, 21)
+        expected = self.expected()
+        types = export.content_type_table()
+        pages, after = [], None
+        while True:
+            with self.assertNumQueries(1):
+                records, after = export.fitting_page(1, after=after, limit=7, types=types)
+            pages.append(records)
+            if after is None:
+                break
+            self.assertEqual(after, records[-1]['pk'])
+        # 20 fittings, the last (empty) page ends the iteration
+        self.assertEqual([len(page) for page in pages], [7, 7, 6])
+        self.assertEqual([record for page in pages for record in page], expected)
+        records, after = export.fitting_page(1, limit=20)
+        self.assertEqual(records, expected)
+        self.assertEqual(export.fitting_page(1, after=after, limit=20), ([], None))
+
+    def test_stream_fittings(self):
+        self.assertEqual(list(export.stream_fittings(1)), ['[', ']'])
+        self.assertEqual(json.loads(''.join(export.stream_fittings(1))), [])
+        for size in (10, 60):
+            self.graph(benchmark.fan_out_in, size)
+            expected = self.expected()
+            with self.assertNumQueries(2):
+                chunks = list(export.stream_fittings(1, chunk_size=5))
+            self.assertEqual(len(chunks), 2 + -(-len(expected)//5))
+            self.assertEqual(json.loads(''.join(chunks)), expected)
+            self.assertEqual(json.loads(''.join(export.stream_fittings(1, chunk_size=len(expected)))), expected)
+        response = views.streaming_fittings(None, 1)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), expected)
+
+    def test_fitting_map(self):
+        nodes = self.graph(benchmark.fan_out_in, 6, TEST_MODELS)
+        self.graph(benchmark.chain, 3, fitting_type=2)
+        with self.assertNumQueries(2):
+            mapping = export.fitting_map(1)
+        self.assertEqual(mapping, views.current_fitting_map(None, 1))
+        self.assertEqual(views.current_fittings(None, 1), self.expected())
+        keys = []
+        for node in nodes[:5]:
+            content_type = ContentType.objects.get_for_model(node)
+            keys.append((content_type.app_label, content_type.model, node.pk))
+        self.assertEqual(sorted(mapping), sorted(keys))
+        self.assertEqual(len(mapping[keys[0]]), 4)
+        for (key, records) in mapping.items():
+            for record in records:
+                self.assertEqual((record['source']['app'], record['source']['type'], record['source']['pk']), key)
+        self.assertEqual(sum([len(records) for records in export.fitting_map().values()]), 8 + 2)
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class DegreeTests(ElementTables, TestCase):
+    """Root, leaf and degree querysets of PipeElement models"""
+    def test_degrees(self):
+        first, second, third, isolated = benchmark.create_nodes([Element], 4)
+        # fittings of another content type only count for its records
+        other, = benchmark.create_nodes([OtherElement], 1)
+        models.Fitting.objects.bulk_pipe([
+            (first, second), (first, other), (second, third), (other, third),
+        ])
+        models.Fitting.objects.bulk_pipe([(third, first)], fitting_type=2)
+        def pks(queryset):
+            return sorted(queryset.values_list('pk', flat=True))
+        self.assertEqual(pks(Element.no_sources()), sorted([first.pk, isolated.pk]))
+        self.assertEqual(pks(Element.no_sinks()), sorted([third.pk, isolated.pk]))
+        self.assertEqual(pks(Element.isolated()), [isolated.pk])
+        self.assertEqual(pks(OtherElement.no_sources()), [])
+        self.assertEqual(pks(OtherElement.no_sinks()), [])
+        self.assertEqual(pks(OtherElement.isolated()), [])
+        # fitting_type 2 only has the third -> first fitting
+        self.assertEqual(pks(Element.no_sources(fitting_type=2)), sorted([second.pk, third.pk, isolated.pk]))
+        self.assertEqual(pks(Element.no_sinks(fitting_type=2)), sorted([first.pk, second.pk, isolated.pk]))
+        self.assertEqual(pks(Element.isolated(fitting_type=2)), sorted([second.pk, isolated.pk]))
+        self.assertEqual(pks(OtherElement.isolated(fitting_type=2)), [other.pk])
+        with self.assertNumQueries(1):
+            degrees = dict([
+                (record.pk, (record.in_degree, record.out_degree))
+                for record in Element.with_degrees()
+            ])
+        self.assertEqual(degrees, {
+            first.pk: (0, 2), second.pk: (1, 1), third.pk: (2, 0), isolated.pk: (0, 0),
+        })
+        record, = OtherElement.with_degrees()
+        self.assertEqual((record.in_degree, record.out_degree), (1, 1))
+        degrees = dict([
+            (record.pk, (record.in_degree, record.out_degree))
+            for record in Element.with_degrees(
+                Element.objects.filter(pk__in=[first.pk, second.pk, third.pk]), fitting_type=2,
+            )
+        ])
+        self.assertEqual(degrees, {first.pk: (1, 0), second.pk: (0, 0), third.pk: (0, 1)})
+        self.assertEqual(list(Element.with_degrees(fitting_type=3).values_list(
+            'in_degree', 'out_degree',
+        ).distinct()), [(0, 0)])
+
+@override_settings(FITTING_CLOSURE_TYPES=[1], FITTING_SHARED_CACHE=None)
+class ClosureTests(ElementTables, TestCase):
+    """The closure table (fitting.closure) matches Fitting.reachable()"""
+    def assertClosure(self, nodes, max_depth=None):
+        for node in nodes:
+            for direction in ('down','up'):
+                self.assertEqual(
+                    sorted(closure.related(node, 1, direction, max_depth=max_depth)),
+                    sorted(models.Fitting.reachable(node, 1, direction, max_depth=max_depth)),
+                )
+    def closure_rows(self):
+        return sorted(models.FittingClosure.objects.filter(fitting_type=1).values_list(
+            'ancestor_type_id','ancestor_id','descendant_type_id','descendant_id','depth',
+        ))
+
+    def test_mutations(self):
+        nodes = self.graph(benchmark.random_dag, 12, TEST_MODELS)
+        self.assertClosure(nodes)
+        nodes[3].pipe_to(nodes[0])
+        self.assertClosure(nodes)
+        nodes[0].pipe_many(nodes[5:8])
+        self.assertClosure(nodes)
+        nodes[6].pipe_from_many(nodes[8:], clear=False)
+        self.assertClosure(nodes)
+        nodes[4].detach_sinks()
+        nodes[9].detach_sources()
+        self.assertClosure(nodes)
+        models.Fitting.sync(1, benchmark.chain(nodes[:6]) + [(nodes[2], nodes[10])])
+        self.assertClosure(nodes)
+        nodes[2].delete()
+        Element.objects.filter(pk__in=[nodes[4].pk, nodes[10].pk]).delete()
+        remaining = [node for node in nodes if node not in (nodes[2], nodes[4], nodes[10])]
+        self.assertClosure(remaining)
+        self.assertFalse(models.FittingClosure.objects.filter(
+            ancestor_type=ContentType.objects.get_for_model(Element), ancestor_id=nodes[2].pk,
+        ).exists())
+
+    def test_cycle(self):
+        nodes = self.graph(benchmark.chain, 5)
+        nodes[-1].pipe_to(nodes[0])
+        self.assertClosure(nodes)
+        nodes[2].detach_sinks()
+        self.assertClosure(nodes)
+
+    def test_max_depth(self):
+        nodes = self.graph(benchmark.random_dag, 15, TEST_MODELS)
+        for max_depth in (1, 2, 3):
+            self.assertClosure(nodes, max_depth=max_depth)
+
+    def test_rebuild(self):
+        nodes = self.graph(benchmark.random_dag, 15, TEST_MODELS)
+        expected = self.closure_rows()
+        models.FittingClosure.objects.all().delete()
+        self.assertEqual(closure.rebuild(1), len(expected))
+        self.assertEqual(self.closure_rows(), expected)
+        self.assertClosure(nodes)
+        # fittings created outside the mutation APIs are picked up by a rebuild
+        models.Fitting.objects.create(source=nodes[-1], sink=nodes[0])
+        closure.rebuild(1)
+        self.assertClosure(nodes)
+
+    def test_rebuild_threshold(self):
+        nodes = self.graph(benchmark.fan_out_in, 402)
+        source, sink = benchmark.create_nodes([OtherElement], 2)
+        with mock.patch.object(closure, 'rebuild', wraps=closure.rebuild) as rebuild:
+            # a batch over REBUILD_THRESHOLD, but small relative to the fitting_type
+            source.pipe_many(nodes[1:151])
+            self.assertEqual(rebuild.call_count, 0)
+            # a large part of the fitting_type
+            sink.pipe_from_many(nodes)
+            self.assertEqual(rebuild.call_count, 1)
+        self.assertClosure(nodes[:3] + nodes[-3:] + [source, sink])
+
+    def test_deferred(self):
+        nodes = benchmark.create_nodes(TEST_MODELS, 40)
+        with mock.patch.object(closure, 'rebuild', wraps=closure.rebuild) as rebuild:
+            with closure.deferred():
+                for i in range(0, 40, 8):
+                    models.Fitting.objects.bulk_pipe(benchmark.chain(nodes[max(i-1,0):i+8]))
+                    with closure.deferred():
+                        nodes[i].pipe_to(nodes[-1], clear=False, fitting_type=2)
+                nodes[5].detach_sinks()
+                self.assertEqual(models.FittingClosure.objects.count(), 0)
+            self.assertEqual(rebuild.call_count, 1)
+        self.assertClosure(nodes)
+        # nothing is rebuilt if the block raises
+        with self.assertRaises(RuntimeError), closure.deferred():
+            nodes[-1].pipe_to(nodes[0])
+            raise RuntimeError()
+        self.assertFalse(closure.is_reachable(nodes[-1], nodes[1], 1))
+        closure.rebuild(1)
+        self.assertTrue(closure.is_reachable(nodes[-1], nodes[1], 1))
+
+    def test_no_op_deletes(self):
+        nodes = self.graph(benchmark.chain, 30)
+        # nothing was deleted, so the closure records are left alone
+        with self.assertNumQueries(1):
+            nodes[-1].detach_sinks()
+        with self.assertNumQueries(1):
+            nodes[0].detach_sources()
+        isolated, = benchmark.create_nodes([OtherElement], 1)
+        # the fitting_types to unlink, the (empty) unlink and the delete itself
+        with self.assertNumQueries(3):
+            isolated.delete()
+        self.assertClosure(nodes)
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class OrphanTests(ElementTables, TestCase):
+    """Collection of fittings whose records are gone (fitting.orphans)"""
+    def orphaned(self):
+        """Chain fittings (in two fitting_types), then delete records without unlinking"""
+        nodes = self.graph(benchmark.chain, 6, TEST_MODELS)
+        models.Fitting.objects.bulk_pipe(benchmark.chain(nodes[:3]), fitting_type=2)
+        for node in nodes[1:3]:
+            node.no_fittings = True
+            node.delete()
+        # (0,1), (1,2) (both ends missing) and (2,3) of type 1, (0,1), (1,2) of type 2
+        return nodes
+
+    def test_collect(self):
+        nodes = self.orphaned()
+        chunks = []
+        def progress(fitting_type, end, contenttype_id, count):
+            chunks.append((fitting_type, end, count))
+        self.assertEqual(orphans.collect_orphans(dry_run=True, chunk_size=1, progress=progress), 5)
+        self.assertEqual(len(self.rows()) + len(self.rows(2)), 7)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(set([count for (_, _, count) in chunks]), set([1]))
+        self.assertEqual(orphans.collect_orphans(fitting_type=2, dry_run=True), 2)
+        self.assertEqual(orphans.collect_orphans(fitting_type=1, chunk_size=2), 3)
+        self.assertEqual(self.rows(), sorted([
+            models.node_key(source) + models.node_key(sink) for (source, sink) in benchmark.chain(nodes[3:])
+        ]))
+        self.assertEqual(len(self.rows(2)), 2)
+        self.assertEqual(orphans.collect_orphans(), 2)
+        self.assertEqual(orphans.collect_orphans(dry_run=True), 0)
+
+    def test_command(self):
+        self.orphaned()
+        output = io.StringIO()
+        call_command('fitting_gc', '--dry-run', '--fitting-type', '1', stdout=output)
+        self.assertEqual(output.getvalue().strip(), '3 orphaned fittings found')
+        output = io.StringIO()
+        call_command('fitting_gc', '--chunk-size', '1', verbosity=2, stdout=output)
+        lines = output.getvalue().strip().splitlines()
+        self.assertEqual(lines[-1], '5 orphaned fittings deleted')
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(len(self.rows()) + len(self.rows(2)), 2)
+
+    def test_delete_on_read(self):
+        nodes = self.orphaned()
+        with override_settings(FITTING_DELETE_ORPHANS_ON_READ=False):
+            self.assertEqual(nodes[0].sinks(), [])
+            self.assertEqual(nodes[3].sources(), [])
+            self.assertEqual(len(self.rows()), 5)
+        self.assertEqual(nodes[0].sinks(), [])
+        self.assertEqual(nodes[3].sources(), [])
+        self.assertEqual(len(self.rows()), 3)
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class AsyncTests(ElementTables, TestCase):
+    """The asyncio read and write APIs (fitting.aio)"""
+    async def test_reads(self):
+        nodes = await sync_to_async(self.graph)(benchmark.fan_out_in, 6, TEST_MODELS)
+        def sync_reads(node):
+            return (
+                node.sources(), node.sinks(),
+                list(node.iter_ancestors()), list(node.iter_descendants()),
+                node.descendants(max_depth=1), node.ancestors(),
+                list(models.traversal.levels(node, direction='both')),
+            )
+        for node in (nodes[0], nodes[1], nodes[5]):
+            self.assertEqual((
+                await node.asources(), await node.asinks(),
+                [record async for record in node.aiter_ancestors()],
+                [record async for record in node.aiter_descendants()],
+                await node.adescendants(max_depth=1), await node.aancestors(),
+                [level async for level in aio.alevels(node, direction='both')],
+            ), await sync_to_async(sync_reads)(node))
+        self.assertEqual(sorted(models.node_keys(await nodes[0].asinks())), sorted(models.node_keys(nodes[1:5])))
+        self.assertEqual(await aio.acontent_type_id(Element), models.node_key(nodes[0])[0])
+        self.assertIs(await aio.amodel_class(models.node_key(nodes[1])[0]), OtherElement)
+
+    async def test_writes(self):
+        nodes = await sync_to_async(self.graph)(benchmark.chain, 4)
+        await nodes[3].apipe_to(nodes[0])
+        self.assertEqual(await nodes[3].asinks(), nodes[:1])
+        await nodes[1].adetach_sinks()
+        self.assertEqual(await nodes[1].asinks(), [])
+        self.assertEqual(await nodes[2].asources(), [])
+        async with models.acache(lazy=True) as mapping:
+            await nodes[0].apipe_to(nodes[2])
+            # written through to the active mapping
+            self.assertEqual(mapping.sink_keys(nodes[0]), models.node_keys(nodes[2:3]))
+            self.assertEqual(await nodes[0].asinks(), nodes[2:3])
+            await nodes[3].adetach_sinks()
+            self.assertEqual(mapping.sink_keys(nodes[3]), [])
+        for fitting_type in (1, None):
+            # a sync block's mapping is loaded before the change is written through
+            with models.cache(lazy=True) as mapping:
+                self.assertFalse(mapping.loaded)
+                await aio.afittings_changed(fitting_type, added=[(nodes[3], nodes[2])])
+                self.assertTrue(mapping.loaded)
+                self.assertEqual(mapping.sink_keys(nodes[3]), models.node_keys(nodes[2:3]))
+        self.assertEqual(await sync_to_async(self.rows)(), sorted([
+            models.node_key(source) + models.node_key(sink)
+            for (source, sink) in [(nodes[0], nodes[2]), (nodes[2], nodes[3])]
+        ]))
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class PipelineTests(ElementTables, TestCase):
+    """Ordering and parallel execution of pipelines (fitting.pipeline)"""
+    def run_recorded(self, nodes, failing=(), **named):
+        """Run the pipeline, recording the order in which nodes finished"""
+        finished, lock = [], threading.Lock()
+        failing = models.node_keys(failing)
+        def process(record):
+            key = models.node_key(record)
+            if key in failing:
+                raise RuntimeError(key)
+            # nodes running alongside a failure give it time to cancel the rest
+            time.sleep(0.05)
+            with lock:
+                finished.append(key)
+            return models.active_mapping(1) is not None
+        return pipeline.run_pipeline(process, nodes, **named), finished
+
+    def test_order(self):
+        nodes = self.graph(benchmark.random_dag, 12, TEST_MODELS)
+        levels = pipeline.execution_levels(nodes)
+        position = dict([(key, i) for (i, level) in enumerate(levels) for key in level])
+        self.assertEqual(sorted(position), sorted(models.node_keys(nodes)))
+        with models.cache():
+            results, finished = self.run_recorded(nodes, max_workers=4)
+        # workers see the caller's cache() mapping
+        self.assertEqual(results, dict([(key, True) for key in models.node_keys(nodes)]))
+        order = pipeline.topological_order(nodes)
+        for (source, sinks) in pipeline._graph(nodes).items():
+            for sink in sinks:
+                self.assertLess(position[source], position[sink])
+                self.assertLess(order.index(source), order.index(sink))
+                self.assertLess(finished.index(source), finished.index(sink))
+
+    def test_connections(self):
+        nodes = self.graph(benchmark.fan_out_in, 6)
+        workers = set()
+        def process(record):
+            workers.add(threading.get_ident())
+            with connections[connection.alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+        backend = type(connections[connection.alias])
+        close = backend.close
+        for (max_age, expected) in ((0, 6), (None, 0)):
+            closed, lock = [], threading.Lock()
+            workers.clear()
+            def recorded(wrapper):
+                with lock:
+                    closed.append(threading.current_thread() is threading.main_thread())
+                return close(wrapper)
+            with mock.patch.dict(connections.settings[connection.alias], CONN_MAX_AGE=max_age):
+                with mock.patch.object(backend, 'close', recorded):
+                    pipeline.run_pipeline(process, nodes, max_workers=2)
+            # workers only close connections past CONN_MAX_AGE after each node...
+            self.assertEqual(closed.count(False), expected)
+            # ...and each worker's connection is closed once the pool shuts down
+            self.assertEqual(closed.count(True), len(workers))
+
+    def test_cycle(self):
+        nodes = self.graph(benchmark.chain, 4)
+        nodes[-1].pipe_to(nodes[1])
+        with self.assertRaises(pipeline.CycleError) as context:
+            self.run_recorded(nodes)
+        self.assertEqual(sorted(context.exception.cycle), models.node_keys(nodes[1:]))
+        with self.assertRaises(pipeline.CycleError):
+            pipeline.execution_levels(nodes)
+
+    def test_failure(self):
+        nodes = self.graph(benchmark.fan_out_in, 6)
+        keys = models.node_keys(nodes)
+        # only the nodes downstream of the failure are cancelled
+        with self.assertRaises(pipeline.PipelineError) as context:
+            self.run_recorded(nodes, failing=nodes[1:2], max_workers=2)
+        error = context.exception
+        self.assertEqual(list(error.errors), keys[1:2])
+        self.assertEqual(sorted(error.results), [keys[0]] + keys[2:5])
+        self.assertEqual(error.cancelled, set(keys[5:]))
+        # fail_fast also cancels the not-yet-started siblings
+        with self.assertRaises(pipeline.PipelineError) as context:
+            self.run_recorded(nodes, failing=nodes[1:2], max_workers=1, fail_fast=True)
+        error = context.exception
+        self.assertEqual(list(error.errors), keys[1:2])
+        self.assertTrue(set(keys[3:]) <= error.cancelled)
+        self.assertEqual(
+            sorted(list(error.results) + list(error.errors) + list(error.cancelled)), keys,
+        )
+
+@override_settings(
+    FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE='fitting',
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'fitting': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'fitting-tests',
+        },
+    },
+)
+class SharedCacheTests(ElementTables, TestCase):
+    """Generations and mappings of the cross-process cache (fitting.shared)"""
+    def setUp(self):
+        shared._cache().clear()
+        shared._local.clear()
+    def tearDown(self):
+        shared._local.clear()
+
+    def test_generation(self):
+        # TestCase never commits, so run the bump registered by the setup
+        with self.captureOnCommitCallbacks(execute=True):
+            nodes = self.graph(benchmark.chain, 4)
+        token = shared.generation(1)
+        with self.assertNumQueries(1):
+            mapping = shared.shared_mapping(1)
+        self.assertEqual(mapping.sink_keys(nodes[0]), models.node_keys(nodes[1:2]))
+        # decoded once, then reused from the LRU (as a private copy)
+        decoded = shared._local[1][1]
+        with self.assertNumQueries(0):
+            self.assertIsNot(shared.shared_mapping(1), mapping)
+        self.assertIs(shared._local[1][1], decoded)
+        # rolled back changes do not bump
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    nodes[-1].pipe_to(nodes[0])
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(shared.generation(1), token)
+        # committed changes bump, and yield a fresh mapping
+        with self.captureOnCommitCallbacks(execute=True):
+            nodes[-1].pipe_to(nodes[0])
+        self.assertNotEqual(shared.generation(1), token)
+        with self.assertNumQueries(1):
+            mapping = shared.shared_mapping(1)
+        self.assertEqual(mapping.sink_keys(nodes[-1]), models.node_keys(nodes[:1]))
+        # as do fittings saved directly
+        token = shared.generation(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Fitting.objects.create(source=nodes[0], sink=nodes[2])
+        self.assertNotEqual(shared.generation(1), token)
+        # queryset deletes keep Django's fast path, and must bump explicitly
+        token = shared.generation(1)
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True) as callbacks:
+            models.Fitting.objects.filter(sink_id=nodes[2].pk, source_id=nodes[0].pk).delete()
+        self.assertEqual(callbacks, [])
+        shared.bump(1)
+        self.assertNotEqual(shared.generation(1), token)
+
+    def test_bump_once(self):
+        nodes = benchmark.create_nodes([Element], 6)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                nodes[0].pipe_to(nodes[1])
+                nodes[1].pipe_many(nodes[2:4])
+                nodes[4].pipe_to(nodes[5], fitting_type=2)
+                models.Fitting.objects.create(source=nodes[2], sink=nodes[5])
+        # one bump per fitting_type
+        self.assertEqual(sorted([callback.fitting_type for callback in callbacks]), [1, 2])
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        nodes[0].detach_sinks()
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+                # the rolled back savepoint's bump is discarded
+                nodes[1].detach_sinks()
+        self.assertEqual([callback.fitting_type for callback in callbacks], [1])
+        # a bump for all fitting_types covers each of them
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                models.Fitting.unlink(Element, [nodes[4].pk])
+                nodes[0].pipe_to(nodes[2])
+        self.assertEqual([callback.fitting_type for callback in callbacks], [None])
+
+    def test_cache(self):
+        nodes = self.graph(benchmark.chain, 3, fitting_type=2)
+        with models.cache(2, shared=True) as mapping:
+            self.assertEqual(mapping.fitting_type, 2)
+            with self.assertNumQueries(1):
+                # the records, the edges are already loaded
+                self.assertEqual(nodes[0].sinks(fitting_type=2), nodes[1:2])
+            self.assertNotIn(1, models._pipe_mappings.get())
+        with models.cache(None, 2, lazy=True) as mapping:
+            self.assertEqual(mapping.fitting_type, 2)
+        with self.assertRaises(TypeError):
+            with models.cache(2, fitting_type=2, shared=True):
+                pass
+
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class SnapshotTests(ElementTables, TestCase):
+    """Dumping, loading and restoring snapshots (fitting.snapshot)"""
+    def test_round_trip(self):
+        self.graph(benchmark.random_dag, 20, TEST_MODELS)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with self.assertNumQueries(1):
+                snapshot.dump(1, path)
+            expected = sorted(models.CompactPipeMapping().nodes())
+            for mmap in (False, True):
+                loaded = snapshot.load(path, mmap=mmap)
+                self.assertEqual(len(loaded), 40)
+                with self.assertNumQueries(0):
+                    self.assertEqual(sorted(loaded.mapping().nodes()), expected)
+            self.assertEqual(snapshot.restore(loaded, fitting_type=2), 40)
+            self.assertEqual(self.rows(2), self.rows(1))
+            models.Fitting.objects.bulk_pipe(benchmark.chain(expected[:3][::-1]), fitting_type=2)
+            snapshot.restore(loaded, fitting_type=2, replace=True)
+            self.assertEqual(self.rows(2), self.rows(1))
+        finally:
+            os.remove(path)
+
+    @override_settings(FITTING_CLOSURE_TYPES=[2])
+    def test_restore_closure(self):
+        nodes = self.graph(benchmark.random_dag, 150, TEST_MODELS)
+        loaded = snapshot.take(1)
+        self.assertEqual(len(loaded), 300)
+        for replace in (False, True):
+            models.Fitting.objects.filter(fitting_type=2).delete()
+            models.FittingClosure.objects.all().delete()
+            with mock.patch.object(closure, 'rebuild', wraps=closure.rebuild) as rebuild:
+                snapshot.restore(loaded, fitting_type=2, replace=replace, batch_size=101)
+            self.assertEqual(rebuild.call_count, 1)
+            self.assertEqual(self.rows(2), self.rows(1))
+            for node in nodes[:5]:
+                self.assertEqual(
+                    sorted(closure.related(node, 2)), sorted(models.Fitting.reachable(node, 2)),
+                )
+
+@unittest.skipIf(analytics.numpy is None, 'analytics requires numpy')
+@override_settings(FITTING_CLOSURE_TYPES=(), FITTING_SHARED_CACHE=None)
+class AnalyticsTests(ElementTables, TestCase):
+    """Vectorized analytics over the adjacency export (fitting.analytics)"""
+    def test_analytics(self):
+        nodes = self.graph(benchmark.fan_out_in, 6, TEST_MODELS)
+        others = self.graph(benchmark.chain, 3)
+        models.Fitting.objects.bulk_pipe([(others[-1], others[0])])
+        with self.assertNumQueries(1):
+            adj = analytics.adjacency()
+        self.assertEqual(adj.keys(), sorted(models.node_keys(nodes + others)))
+        in_degree, out_degree = analytics.degrees(adj)
+        self.assertEqual(out_degree[adj.index([nodes[0]])[0]], 4)
+        self.assertEqual(in_degree[adj.index([nodes[-1]])[0]], 4)
+        self.assertEqual(analytics.hotspots(adj, 1), [(models.node_key(nodes[0]), 4)])
+        self.assertEqual(sorted(analytics.component_sizes(adj)), [3, 6])
+        self.assertTrue(analytics.has_cycle(adj))
+        if analytics.csgraph is not None:
+            self.assertEqual(analytics.cyclic_nodes(adj), sorted(models.node_keys(others)))
+            self.assertEqual(
+                list(analytics.reachability_counts(adj, [nodes[0], others[0]])), [5, 3],
+            )
+
+    def test_reachability_counts(self):
+        nodes = self.graph(benchmark.random_dag, 40, TEST_MODELS)
+        if analytics.csgraph is not None:
+            # a cycle back through one of the DAG's fittings
+            (source, sink) = benchmark.random_dag(nodes)[40]
+            models.Fitting.objects.bulk_pipe([(sink, source)])
+        adj = analytics.adjacency()
+        self.assertEqual(analytics.has_cycle(adj), analytics.csgraph is not None)
+        for direction in ('down', 'up'):
+            expected = [
+                len(models.Fitting.reachable(node, direction=direction)) for node in nodes
+            ]
+            with mock.patch.object(analytics, 'REACHABILITY_MEMORY', 64):
+                self.assertEqual(
+                    list(analytics.reachability_counts(adj, nodes, direction)), expected,
+                )
@@ -0,0 +1,211 @@
+"""Frontier-batched breadth-first traversal of fitting graphs
+
+Rather than querying the fittings of each node in turn, each level of
+the traversal is expanded with one Fitting query (per BATCH_SIZE nodes
+of the frontier), so the number of queries scales with the depth of
+the graph rather than with the number of nodes. When a cache()
+mapping is active for the fitting_type it is used instead, without
+any queries.
+
+Nodes are (content_type_id,pk) keys, directions are 'down' (sinks),
+'up' (sources) or 'both'.
+"""
+from django.db.models import Q
+from fitting import models, stats
+
+BATCH_SIZE = 500
+DIRECTIONS = ('down','up','both')
+
+def _mapping(fitting_type, mapping=None):
+    if mapping is None:
+        mapping = models.active_mapping(fitting_type)
+    return mapping
+
+def _batches(keys):
+    """Yield {content_type_id: [pk,...]} for batches of BATCH_SIZE keys"""
+    keys = sorted(keys)
+    for i in range(0,len(keys),BATCH_SIZE):
+        batch = {}
+        for (contenttype_id, id) in keys[i:i+BATCH_SIZE]:
+            batch.setdefault(contenttype_id, []).append(id)
+        yield batch
+
+def expand(frontier, fitting_type=None, direction='down', mapping=None):
+    """Get {key: [neighbour keys]} for each key of frontier
+
+    Uses mapping (default the active cache() mapping) if available,
+    otherwise one query per BATCH_SIZE keys of the frontier.
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError("Unrecognized direction: %r"%(direction,))
+    fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+    frontier = set(frontier)
+    result = dict([(key,[]) for key in frontier])
+    mapping = _mapping(fitting_type, mapping)
+    if mapping is not None:
+        for key in frontier:
+            if direction != 'up':
+                result[key].extend(mapping.sink_keys(key))
+            if direction != 'down':
+                result[key].extend(mapping.source_keys(key))
+        return result
+    for batch in _batches(frontier):
+        _collect(result, frontier, direction, _edge_query(batch, fitting_type, direction))
+    return result
+
+def _edge_query(batch, fitting_type, direction='down'):
+    """Get the (source_type_id,source_id,sink_type_id,sink_id) rows for a _batches() batch"""
+    query = Q()
+    for (contenttype_id, ids) in batch.items():
+        if direction != 'up':
+            query |= Q(source_type_id=contenttype_id, source_id__in=ids)
+        if direction != 'down':
+            query |= Q(sink_type_id=contenttype_id, sink_id__in=ids)
+    return models.Fitting.objects.filter(
+        query, fitting_type=fitting_type,
+    ).order_by(
+        'source_type_id','source_id','sink_type_id','sink_id'
+    ).values_list('source_type_id','source_id','sink_type_id','sink_id')
+
+def _collect(result, frontier, direction, rows):
+    for (source_type_id,source_id,sink_type_id,sink_id) in rows:
+        source, sink = (source_type_id,source_id), (sink_type_id,sink_id)
+        if direction != 'up' and source in frontier:
+            result[source].append(sink)
+        if direction != 'down' and sink in frontier:
+            result[sink].append(source)
+
+def traverse(start, fitting_type=None, direction='down', max_depth=None, until=None, mapping=None):
+    """Iterate breadth-first over the nodes reachable from start
+
+    start -- instance/key or list (or set) of instances/keys to start from
+    max_depth -- if not None, only follow this many fittings
+    until -- predicate called as until(key,depth) for each node found,
+        the traversal stops (after yielding that node) when it is true
+
+    Start nodes are only yielded if they are reachable from a start
+    node through a cycle (never for direction 'both').
+
+    yields (key,depth) with depth >= 1, level by level
+    """
+    for (depth, level) in levels(start, fitting_type, direction, max_depth, mapping):
+        for key in level:
+            yield key, depth
+            if until is not None and until(key, depth):
+                return
+
+class _Levels(object):
+    """Bookkeeping of a breadth-first traversal, shared by levels() and aio.alevels()"""
+    def __init__(self, keys, fitting_type=None, direction='down', max_depth=None):
+        self.fitting_type = fitting_type or models.Fitting.DEFAULT_FITTING_TYPE
+        self.direction = direction
+        self.max_depth = max_depth
+        self.frontier = set(keys)
+        self.expanded = set(self.frontier)
+        # ignoring direction, every start node is trivially reachable from itself
+        self.found = set(self.frontier) if direction == 'both' else set()
+        self.depth = self.deepest = self.nodes = 0
+    def more(self):
+        """Is there a frontier left to expand?"""
+        return bool(self.frontier) and (self.max_depth is None or self.depth < self.max_depth)
+    def advance(self, expanded):
+        """Record the expand() result for the frontier, returns the next level's new keys"""
+        self.depth += 1
+        level = []
+        for (key, targets) in sorted(expanded.items()):
+            for target in targets:
+                if target not in self.found:
+                    self.found.add(target)
+                    level.append(target)
+        if level:
+            self.deepest, self.nodes = self.depth, self.nodes + len(level)
+        self.frontier = set([key for key in level if key not in self.expanded])
+        self.expanded.update(self.frontier)
+        return level
+    def report(self):
+        stats.report(
+            'traversal', self.fitting_type,
+            direction=self.direction, depth=self.deepest, nodes=self.nodes, 
+            expanded=len(self.expanded),
+        )
+
+def levels(start, fitting_type=None, direction='down', max_depth=None, mapping=None):
+    """Iterate breadth-first over the levels of nodes reachable from start
+    
+    See traverse() for the arguments
+    
+    yields (depth,[key,...]) for each level, the query for a level
+    is only run when it is requested
+    """
+    if not isinstance(start, (list,set,frozenset)):
+        start = [start]
+    state = _Levels(models.node_keys(start), fitting_type, direction, max_depth)
+    try:
+        while state.more():
+            level = state.advance(expand(state.frontier, fitting_type, direction, mapping))
+            if level:
+                yield state.depth, level
+    finally:
+        state.report()
+
+def neighbourhood(start, k=1, fitting_type=None, direction='both', mapping=None):
+    """Get {key: depth} for all nodes within k fittings of start"""
+    return dict(traverse(start, fitting_type, direction, max_depth=k, mapping=mapping))
+
+def shortest_path(source, target, fitting_type=None, direction='down', max_depth=None, mapping=None):
+    """Find a shortest path of fittings from source to target
+
+    Searches breadth-first from both ends at once (expanding whichever
+    frontier is smaller), direction 'down' follows sinks from source,
+    'up' sources and 'both' ignores the direction of the fittings.
+
+    returns [source key, ..., target key] or None if there is no path
+        (within max_depth fittings)
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError("Unrecognized direction: %r"%(direction,))
+    source, target = models.node_key(source), models.node_key(target)
+    if source == target:
+        return [source]
+    backward = {'down':'up','up':'down','both':'both'}[direction]
+    # parents[key] is the neighbour through which key was reached
+    forward_parents, backward_parents = {source: None}, {target: None}
+    forward_depths, backward_depths = {source: 0}, {target: 0}
+    forward_frontier, backward_frontier = set([source]), set([target])
+    length = 0
+    while forward_frontier and backward_frontier:
+        if max_depth is not None and length >= max_depth:
+            return None
+        length += 1
+        if len(forward_frontier) <= len(backward_frontier):
+            frontier, parents, found, others, way = (
+                forward_frontier, forward_parents, forward_depths, backward_depths, direction
+            )
+        else:
+            frontier, parents, found, others, way = (
+                backward_frontier, backward_parents, backward_depths, forward_depths, backward
+            )
+        following = set()
+        meeting = None
+        for (key, targets) in sorted(expand(frontier, fitting_type, way, mapping).items()):
+            for neighbour in targets:
+                if neighbour not in parents:
+                    parents[neighbour] = key
+                    found[neighbour] = found[key] + 1
+                    following.add(neighbour)
+                    if neighbour in others and (
+                        meeting is None or others[neighbour] < others[meeting]
+                    ):
+                        meeting = neighbour
+        if meeting is not None:
+            path = [meeting]
+            while forward_parents[path[0]] is not None:
+                path.insert(0, forward_parents[path[0]])
+            while backward_parents[path[-1]] is not None:
+                path.append(backward_parents[path[-1]])
+            return path
+        if frontier is forward_frontier:
+            forward_frontier = following
+        else:
+            backward_frontier = following
+    return None
@@ -1,9 +1,10 @@
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import gettext_lazy as _
 assert _
 import logging
+from django.http import StreamingHttpResponse
 #from django.conf.urls.defaults import patterns, include, url
 log = logging.getLogger( __name__ )
-from . import models
+from . import models, export
 
 def current_fittings(request,  fitting_type=None,  cls=models.Fitting):
     """Retrieve the full set of current fitting elements
@@ -16,37 +17,33 @@ def current_fittings(request,  fitting_type=None,  cls=models.Fitting):
             'fittings': current_fittings( request, fitting_type, cls ),
         }
     """
-    fittings = cls.objects
-    if fitting_type:
-        fittings = fittings.filter( 
-            fitting_type=fitting_type, 
-        )
-    return [ f.__json__() for f in fittings.all() ]
+    return list(export.iter_fittings(fitting_type, cls))
 
 def current_fitting_map(request,  fitting_type=None,  cls=models.Fitting):
-    """Retrieve the full set of current fitting elements
+    """Retrieve the current fitting elements keyed by source
     
     This is a view-fragment intended to allow you to pull the 
     fitting data-set:
     
         return {
             'success': True,
-            'fittings': current_fittings( request, fitting_type, cls ),
+            'fittings': current_fitting_map( request, fitting_type, cls ),
         }
+    
+    keys are (source app_label, source model, source pk)
+    """
+    return export.fitting_map(fitting_type, cls)
+
+def streaming_fittings(request, fitting_type=None, cls=models.Fitting):
+    """Stream the full set of current fitting elements as a JSON array
+    
+    Uses constant memory regardless of the number of fittings
     """
-    fittings = cls.objects
-    if fitting_type:
-        fittings = fittings.filter( 
-            fitting_type=fitting_type, 
-        )
-    mapping = {}
-    for fitting in fittings.objects.all():
-        mapping.setdefault(
-            (fitting.source.app_label, fitting.source.model,  fitting.source_id), 
-            []
-        ).append( fitting.__json__() )
-    return mapping
+    return StreamingHttpResponse(
+        export.stream_fittings(fitting_type, cls),
+        content_type='application/json',
+    )
 
 
-from django.utils.translation import ugettext as _
+from django.utils.translation import gettext as _
 assert _
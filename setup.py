@@ -43,6 +43,9 @@ if __name__ == "__main__":
             'django-annoying',
             #'south',
         ],
+        extras_require={
+            'analytics': ['numpy', 'scipy'],
+        },
         scripts = [
         ],
         entry_points = dict(